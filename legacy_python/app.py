@@ -1,10 +1,17 @@
 import streamlit as st
-import google.generativeai as genai
-import json
-import io
-import io
-from PIL import Image
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import history_utils # Import History Utils
+import image_utils # Encoded Image Pass-through
+import cache_utils # Response Cache
+import model_health # Circuit Breaker Stats
+import client_pool # Per-key Model Clients
+import call_scheduler # Shared Rate Limiter & Priority Queue
+import metrics_utils # Latency / Payload Spans
+import history_retention # Size / Age Budgets for history_data
+import single_flight # Coalescing of Identical In-flight Requests
+import pipeline # Prompt Builders & Phases (shared with batch_runner)
+from pipeline import STYLE_PROMPTS, ARCHETYPES
 
 # ==========================================
 # 0. Session State Initialization (Earliest)
@@ -17,17 +24,37 @@ if "needs_draft_gen" not in st.session_state: st.session_state.needs_draft_gen =
 
 # Settings State
 if "api_key" not in st.session_state: st.session_state.api_key = ""
+if "client_id" not in st.session_state: st.session_state.client_id = uuid.uuid4().hex # Fair-queuing identity of this browser session
 if "selected_text_model" not in st.session_state: st.session_state.selected_text_model = "gemini-2.5-pro"
 if "selected_image_model" not in st.session_state: st.session_state.selected_image_model = "nano-banana-pro-preview"
 if "fallback_list_text" not in st.session_state: st.session_state.fallback_list_text = ["gemini-2.5-pro"]
 if "fallback_list_image" not in st.session_state: st.session_state.fallback_list_image = ["nano-banana-pro-preview"]
+if "use_response_cache" not in st.session_state: st.session_state.use_response_cache = True
+if "use_hedging" not in st.session_state: st.session_state.use_hedging = True
 # Style Selection State
 if "selected_style_key" not in st.session_state: st.session_state.selected_style_key = "ビジネス・プロ (Business Pro)"
+if "style_renders" not in st.session_state: st.session_state.style_renders = {}
+if "history_page" not in st.session_state: st.session_state.history_page = 0
+if "use_speculative_draft" not in st.session_state: st.session_state.use_speculative_draft = False
+if "speculative_job" not in st.session_state: st.session_state.speculative_job = None
+if "trace" not in st.session_state: st.session_state.trace = metrics_utils.Trace() # Spans of this session (saved into metadata.json)
+if "show_diagnostics" not in st.session_state: st.session_state.show_diagnostics = False
+# Project in history: saves after the first one become revisions of this session
+if "history_session_id" not in st.session_state: st.session_state.history_session_id = None
+if "revisions" not in st.session_state: st.session_state.revisions = []
+if "current_revision" not in st.session_state: st.session_state.current_revision = None
+# Whose history this browser session sees (None = shared history_data root, see history_utils.resolve_namespace)
+if "history_namespace" not in st.session_state: st.session_state.history_namespace = history_utils.resolve_namespace()
+# History storage codec for lossless images (see image_utils.STORAGE_CODECS)
+if "storage_codec" not in st.session_state: st.session_state.storage_codec = "original"
+if "storage_quality" not in st.session_state: st.session_state.storage_quality = image_utils.STORAGE_QUALITY
 
 # Input State
 if "ref_images" not in st.session_state: st.session_state.ref_images = []
 if "is_ref_mandatory" not in st.session_state: st.session_state.is_ref_mandatory = False
 if "additional_inst" not in st.session_state: st.session_state.additional_inst = ""
+if "ref_max_edge" not in st.session_state: st.session_state.ref_max_edge = image_utils.REF_MAX_EDGE
+if "ref_max_pixels" not in st.session_state: st.session_state.ref_max_pixels = image_utils.REF_MAX_PIXELS
 
 
 # ==========================================
@@ -149,67 +176,68 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- Constants ---
-STYLE_PROMPTS = {
-    "ビジネス・プロ (Business Pro)": "Style: Professional Corporate Vector Art. Features: Clean lines, trustworthy blue and grey color palette, sans-serif typography. Vibe: Reliable, efficient.",
-    "テック・フューチャー (Tech Future)": "Style: Futuristic Cyberpunk. Features: Neon glowing lines (cyan/magenta), dark grid background, holographic effects. Vibe: High-tech, data-driven.",
-    "フラット・モダン (Flat Modern)": "Style: Vibrant Flat Design. Features: Bright and bold colors, high contrast, simple geometric shapes, flat shading. Vibe: Energetic, infographic style.",
-    "ホワイトボード (Whiteboard Sketch)": "Style: Whiteboard Marker Sketch. Features: Organic shaky lines, handwritten fonts, white background, casual marker strokes. Vibe: Friendly, brainstorming.",
-    "ミニマル・ライン (Minimal Line)": "Style: Sophisticated Line Art. Features: Ultra-thin lines, generous whitespace, monochrome or limited pastel palette. Vibe: Elegant, modern.",
-    "3Dアイソメトリック (3D Isometric)": "Style: 3D Isometric Render. Features: Orthographic projection, soft lighting, floating elements. Vibe: Tech startup, playful but structural.",
-    "コミック・ストーリー (Comic Style)": "Style: Japanese Black & White Manga. Features: Ink lines, screentones, speed lines, comic bubbles. Vibe: Impactful, storytelling.",
-    "クレイ・3D (Clay 3D)": "Style: 3D Claymorphism. Features: Soft rounded shapes, plastic/clay texture, warm lighting. Vibe: Warm, tactile, playful.",
-    "ピクセル・レトロ (Pixel Retro)": "Style: 8-bit Pixel Art. Features: Low resolution pixels, limited color palette. Vibe: Nostalgic, digital retro.",
-    "アーティスティック (Watercolor)": "Style: Watercolor Illustration. Features: Soft color bleeding, textured paper background. Vibe: Organic, artistic."
-}
-
-ARCHETYPES = [
-    "AIにおまかせ (自動最適化)",
-    "プロセスフロー (手順・流れ)",
-    "比較・対比 (A vs B)",
-    "構造・解剖図 (構成要素)",
-    "タイムライン (時系列)",
-    "サイクル図 (循環)",
-    "マインドマップ (放射状)",
-    "ピラミッド階層 (構造)"
-]
+MAX_PARALLEL_RENDERS = 4 # Upper bound for concurrent style renders
+HISTORY_PAGE_SIZE = 20 # Sessions per page in the history popover
+HISTORY_GRID_COLUMNS = 2 # Thumbnails per row in the history popover
 
 # --- Helper Functions ---
 
-def parse_image_response(response):
-    try:
-        if hasattr(response, 'parts') and response.parts:
-            image_data = response.parts[0].inline_data.data
-            return Image.open(io.BytesIO(image_data))
-        if hasattr(response, 'text'):
-            raise ValueError("Response is text, not image.")
-    except Exception as e:
-        raise RuntimeError(f"Failed to parse image from response: {e}")
-
-def generate_with_fallback(model_names, prompt):
-    last_error = None
-    if not model_names: 
-        raise ValueError("No models available.")
-    for model_name in model_names:
-        try:
-            model = genai.GenerativeModel(model_name)
-            response = model.generate_content(prompt)
-            return response, model_name
-        except Exception as e:
-            last_error = e
-            continue
-    raise last_error
+def final_inputs():
+    """
+    Prompt inputs of pipeline.run_final from the session (captured up front for worker threads).
+    """
+    return {
+        "final_prompt": st.session_state.final_prompt,
+        "ref_images": st.session_state.get("ref_images"),
+        "is_ref_mandatory": getattr(st.session_state, "is_ref_mandatory", False),
+    }
+
+def render_styles_parallel(style_keys, on_done):
+    """
+    Renders several styles concurrently and calls on_done(style_key, image, error) as each finishes.
+    Worker threads never touch st.session_state; everything they need is captured up front.
+    """
+    model_names = list(st.session_state.fallback_list_image)
+    use_cache = st.session_state.get("use_response_cache", True)
+    hedge = st.session_state.get("use_hedging", True)
+    api_key = st.session_state.get("api_key") or None
+    session = st.session_state.client_id
+    trace = st.session_state.trace
+    inputs = final_inputs()
+
+    def render_one(key):
+        image, _ = pipeline.run_final(model_names, style_key=key, **inputs, use_cache=use_cache, hedge=hedge,
+                                      api_key=api_key, session=session, trace=trace)
+        return image
+
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_RENDERS) as pool:
+        futures = {pool.submit(render_one, key): key for key in style_keys}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                on_done(key, future.result(), None)
+            except Exception as e:
+                on_done(key, None, e)
+
+def queue_notice():
+    """
+    on_queue callback for generate_with_fallback: shows this request's place in the shared queue.
+    """
+    slot = st.empty()
+
+    def on_queue(position):
+        if position:
+            slot.caption(f"⏳ 混雑しているため順番待ちです（{position}番目）")
+        else:
+            slot.empty()
+    return on_queue
 
 @st.cache_data(ttl=300)
 def get_available_models(api_key_input):
     if not api_key_input: return []
     try:
-        genai.configure(api_key=api_key_input)
-        models = []
-        for m in genai.list_models():
-            if 'generateContent' in m.supported_generation_methods:
-                name = m.name.replace("models/", "")
-                models.append(name)
-        return models
+        # Listed with a pooled per-key client; no process-global genai.configure
+        return client_pool.list_model_names(api_key_input)
     except Exception:
         return []
 
@@ -299,23 +327,81 @@ with col_tools:
     with c_hist:
         with st.popover("🕒", use_container_width=True):
             st.markdown("### 📜 履歴 (History)")
-            history_items = history_utils.get_history_list()
+            search_query = st.text_input("履歴を検索", key="history_query", placeholder="タイトル・見出し・スタイルなど", label_visibility="collapsed")
+            total_items = history_utils.count_history()
+            last_page = max(0, (total_items - 1) // HISTORY_PAGE_SIZE)
+            page = min(st.session_state.history_page, last_page)
+            if search_query.strip():
+                history_items = history_utils.search_history(search_query)
+                st.caption(f"検索結果 {len(history_items)}件")
+            else:
+                history_items = history_utils.get_history_list(limit=HISTORY_PAGE_SIZE, offset=page * HISTORY_PAGE_SIZE)
             if not history_items:
-                st.caption("履歴はありません")
+                st.caption("該当する履歴はありません" if search_query.strip() else "履歴はありません")
+            elif last_page > 0 and not search_query.strip():
+                c_prev, c_page, c_next = st.columns([1, 2, 1])
+                if c_prev.button("◀", key="hist_prev", disabled=page == 0):
+                    st.session_state.history_page = page - 1
+                    st.rerun()
+                c_page.caption(f"{page + 1} / {last_page + 1} ページ ({total_items}件)")
+                if c_next.button("▶", key="hist_next", disabled=page >= last_page):
+                    st.session_state.history_page = page + 1
+                    st.rerun()
             
-            for item in history_items:
-                ts = item['timestamp']
-                formatted_ts = f"{ts[4:6]}/{ts[6:8]} {ts[9:11]}:{ts[11:13]}"
-                
-                # Use a container for each item
-                with st.container():
-                    st.markdown(f"**{formatted_ts}**")
-                    st.caption(f"{item['title'][:15]}...")
-                    if st.button("復元", key=f"hist_{item['id']}", use_container_width=True):
-                        if history_utils.load_session(item['id']):
-                            st.success("読み込み完了")
+            # Visual grid: thumbnails are small WebP blobs, full images are only read on restore
+            history_utils.request_thumbnails(history_items)
+            for row_start in range(0, len(history_items), HISTORY_GRID_COLUMNS):
+                cols = st.columns(HISTORY_GRID_COLUMNS)
+                for col, item in zip(cols, history_items[row_start:row_start + HISTORY_GRID_COLUMNS]):
+                    ts = item['timestamp']
+                    formatted_ts = f"{ts[4:6]}/{ts[6:8]} {ts[9:11]}:{ts[11:13]}"
+                    with col:
+                        thumb = history_utils.read_thumbnail(item['thumbnail']) if item.get('thumbnail') else None
+                        if thumb:
+                            st.image(thumb, use_container_width=True)
+                        else:
+                            st.caption("🖼️ (プレビューなし)")
+                        st.markdown(f"**{formatted_ts}**")
+                        st.caption(f"{item['title'][:15]}...")
+                        c_load, c_pin, c_del = st.columns([2, 1, 1])
+                        if c_load.button("復元", key=f"hist_{item['id']}", use_container_width=True):
+                            if history_utils.load_session(item['id']):
+                                st.success("読み込み完了")
+                                st.rerun()
+                        if c_pin.button("📌" if item.get('pinned') else "📍", key=f"hist_pin_{item['id']}", use_container_width=True,
+                                        type="primary" if item.get('pinned') else "secondary",
+                                        help="固定を解除します" if item.get('pinned') else "固定すると自動整理で削除されません"):
+                            history_utils.set_pinned(item['id'], not item.get('pinned'))
+                            st.rerun()
+                        if c_del.button("🗑", key=f"hist_del_{item['id']}", use_container_width=True, help="この履歴を削除します"):
+                            if item['id'] == st.session_state.history_session_id:
+                                # The open project still shows these images; keep them in memory
+                                history_utils.detach_images(st.session_state)
+                                st.session_state.history_session_id = None
+                                st.session_state.revisions = []
+                                st.session_state.current_revision = None
+                            history_utils.delete_session(item['id'])
                             st.rerun()
-                    st.divider()
+                st.divider()
+
+            # Background Save Status
+            save_status = history_utils.get_save_status()
+            if save_status["pending"]:
+                st.caption(f"💾 保存中... ({save_status['pending']}件)")
+            if save_status["errors"]:
+                for _, label, msg in save_status["errors"]:
+                    st.warning(f"保存に失敗しました: {msg}")
+                if st.button("エラー表示を消去", key="hist_clear_errors", use_container_width=True):
+                    history_utils.clear_save_errors()
+                    st.rerun()
+
+            if st.button("履歴インデックスを再構築", key="hist_rebuild", use_container_width=True):
+                added, removed = history_utils.rebuild_history_index()
+                st.success(f"再構築しました (更新 {added} / 削除 {removed})")
+
+            if st.button("画像ストレージを最適化", key="hist_optimize", use_container_width=True, help="古い形式の画像を共有ストアへ移し、どの履歴からも使われていない画像を削除します"):
+                migrated, removed, freed = history_utils.optimize_storage()
+                st.success(f"移行 {migrated}件 / 不要画像 {removed}件を削除 ({freed / 1e6:.1f} MB)")
 
     # --- Settings Popover (Gear Icon) ---
     with c_conf:
@@ -333,6 +419,12 @@ with col_tools:
                 st.session_state.clear()
                 st.rerun()
 
+            # Response Cache
+            st.session_state.use_response_cache = st.checkbox("生成結果をキャッシュする", value=st.session_state.use_response_cache, help="同じ構成・スタイル・参考画像の再生成は保存済みの結果を即座に返します。他のユーザーが同じ内容を生成中なら、その結果を待って共有します")
+            if st.button("キャッシュを消去", use_container_width=True):
+                cache_utils.clear_cache()
+                st.success("キャッシュを消去しました")
+
             st.markdown("---")
             st.caption("AIモデル設定")
 
@@ -359,6 +451,65 @@ with col_tools:
             st.session_state.fallback_list_text = [st.session_state.selected_text_model] + [m for m in opts_txt if m != st.session_state.selected_text_model]
             st.session_state.fallback_list_image = [st.session_state.selected_image_model] + [m for m in opts_img if m != st.session_state.selected_image_model]
 
+            # Reference Image Budget
+            edge_opts = [768, 1024, 1536, 2048]
+            curr_edge = st.session_state.ref_max_edge if st.session_state.ref_max_edge in edge_opts else image_utils.REF_MAX_EDGE
+            st.session_state.ref_max_edge = st.selectbox("参考画像の最大サイズ (px)", edge_opts, index=edge_opts.index(curr_edge), help="アップロード時に一度だけ縮小・圧縮し、全ての生成リクエストで再利用します")
+            pixel_opts = [512 * 1024, 1024 * 1024, 1536 * 1024, 2048 * 1024, 2048 * 2048]
+            curr_pixels = st.session_state.ref_max_pixels if st.session_state.ref_max_pixels in pixel_opts else image_utils.REF_MAX_PIXELS
+            st.session_state.ref_max_pixels = st.selectbox("参考画像の最大画素数", pixel_opts, index=pixel_opts.index(curr_pixels), format_func=lambda p: f"{p / 1e6:.1f} MP", help="最大サイズに加えて適用される上限です。正方形に近い画像ほど小さく縮小されます")
+
+            # Speculative Draft
+            st.session_state.use_speculative_draft = st.checkbox("ドラフトを先行生成する (投機実行)", value=st.session_state.use_speculative_draft, help="構成案が届いた時点でドラフト生成を開始します。構成を編集した場合は破棄されます")
+
+            # Hedging & Model Health
+            st.session_state.use_hedging = st.checkbox("応答が遅いモデルは次のモデルと並行実行する", value=st.session_state.use_hedging, help="優先モデルが通常の応答時間を超えた場合、次のモデルにも同時に依頼し、先に返った結果を使います")
+            health = model_health.get_health_snapshot()
+            if health:
+                with st.expander("モデルの稼働状況"):
+                    for h in health:
+                        state_icon = {"closed": "🟢", "half_open": "🟡", "open": "🔴"}.get(h["state"], "⚪")
+                        p50 = f"{h['p50_latency']}s" if h["p50_latency"] is not None else "-"
+                        st.caption(f"{state_icon} {h['model']} | エラー率 {h['error_rate']:.0%} | 中央値 {p50}")
+                    pool = client_pool.pool_size()
+                    st.caption(f"接続プール: APIキー {pool['keys']} / モデル {pool['models']}")
+                    st.caption(f"順番待ちのリクエスト: {call_scheduler.queue_length()}")
+
+            # History Storage Codec
+            codec_labels = {
+                "original": "そのまま保存 (PNG等)",
+                "webp_lossless": "WebP (可逆圧縮)",
+                "webp": "WebP (非可逆・高圧縮)",
+                "avif": "AVIF (非可逆・最高圧縮)",
+            }
+            codec_opts = [c for c in codec_labels if image_utils.codec_available(c)]
+            curr_codec = st.session_state.storage_codec if st.session_state.storage_codec in codec_opts else "original"
+            st.session_state.storage_codec = st.selectbox("履歴の画像形式", codec_opts, index=codec_opts.index(curr_codec), format_func=codec_labels.get, help="PNGで届いた画像を保存時に変換します (JPEG/WebPはそのまま)。変換はバックグラウンドで行われます")
+            if st.session_state.storage_codec in ("webp", "avif"):
+                st.session_state.storage_quality = st.slider("画質", 50, 100, int(st.session_state.storage_quality), step=5)
+
+            # History Retention
+            with st.expander("履歴の保存上限"):
+                # Deployment setting (BLUEPRINT_RETENTION_* environment variables), shown read-only
+                if history_retention.enabled():
+                    limits = []
+                    if history_retention.MAX_BYTES:
+                        limits.append(f"画像の合計 {history_retention.MAX_BYTES / 1024 ** 3:g} GB")
+                    if history_retention.MAX_AGE_DAYS:
+                        limits.append(f"保存期間 {history_retention.MAX_AGE_DAYS:g} 日")
+                    if history_retention.MAX_SESSIONS:
+                        limits.append(f"最大 {history_retention.MAX_SESSIONS} 件")
+                    st.caption("上限: " + " / ".join(limits) + "。超えた場合、最後に復元・保存した日時が古い履歴から削除します。")
+                    st.caption("📌 固定した履歴と、直近1時間以内に使った履歴は削除されません。保存のたびにバックグラウンドで整理します。")
+                    if st.button("今すぐ整理", key="retention_run", use_container_width=True):
+                        result = history_utils.enforce_retention()
+                        st.success(f"{result['evicted']}件の履歴を削除しました ({result['bytes_freed'] / 1e6:.1f} MB)")
+                else:
+                    st.caption("上限は設定されていません (履歴は自動削除されません)。上限はサーバーの環境変数 BLUEPRINT_RETENTION_MAX_GB / BLUEPRINT_RETENTION_MAX_AGE_DAYS / BLUEPRINT_RETENTION_MAX_SESSIONS で設定します。")
+
+            # Diagnostics
+            st.session_state.show_diagnostics = st.checkbox("診断パネルを表示する", value=st.session_state.show_diagnostics, help="各フェーズ・各モデル呼び出しの所要時間とデータ量をページ下部に表示します")
+
 
 # ==========================================
 # 3. Main Workflow
@@ -434,62 +585,62 @@ if st.session_state.phase == "input":
             st.error("右上 ⚙️ からAPIキーを入力してください")
         else:
             with st.spinner("解析中..."):
+                # New project: timings and the history revision chain start over
+                st.session_state.trace.clear()
+                st.session_state.history_session_id = None
+                st.session_state.revisions = []
+                st.session_state.current_revision = None
+
                 # Save Inputs
                 st.session_state.is_ref_mandatory = is_ref_mandatory
                 st.session_state.additional_inst = additional_inst
                 
-                # Process Images
-                pil_images = []
+                # Process Images (normalized once, reused by every later request)
+                ref_images = []
                 if uploaded_files:
-                    for f in uploaded_files:
+                    for f in uploaded_files[:4]:
                         try:
-                            pil_images.append(Image.open(f))
+                            ref_images.append(image_utils.prepare_reference_image(
+                                f, max_edge=st.session_state.ref_max_edge,
+                                max_pixels=st.session_state.ref_max_pixels))
                         except: pass
-                    st.session_state.ref_images = pil_images
-                
-                # Construct Prompt
-                base_prompt_text = f"""
-                あなたは優秀な情報デザイナーです。以下のテキストを可視化・図解するための構成案を作成し、
-                **JSON形式のみ** で出力してください。
-                
-                【テキスト】
-                {input_text}
+                    st.session_state.ref_images = ref_images
                 
-                【指定構造】
-                {archetype}
-
-                【追加指示】
-                {additional_inst}
-                """
-                
-                if st.session_state.ref_images:
-                     base_prompt_text += "\n\n【参考画像】\n添付された画像を参考に、その雰囲気や構造要素を取り入れてください。"
-                     is_madatory_str = "必須" if is_ref_mandatory else "任意"
-                     base_prompt_text += f"\n(画像の要素反映は「{is_madatory_str}」です)"
-
-                base_prompt_text += f"""
-                
-                【出力JSON】
-                {{
-                    "main_title": "タイトル",
-                    "summary": "要約(1文)",
-                    "recommended_style": "デザイン指示",
-                    "archetype_name": "{archetype}",
-                    "steps": [
-                        {{ "label": "見出し", "visual_desc": "絵の指示" }}
-                    ]
-                }}
-                """
-
-                # Prepare Content
-                content = [base_prompt_text]
-                if st.session_state.ref_images:
-                    content.extend(st.session_state.ref_images)
+                # Live preview of the Step 2 form, filled while the structure streams in
+                preview_slot = st.empty()
+                streamed = {"steps": []}
+
+                def on_struct_event(event):
+                    if event[0] == "restart": # Next model in the chain: start over
+                        streamed.clear()
+                        streamed["steps"] = []
+                    elif event[0] == "step":
+                        streamed["steps"].append(event[2])
+                    elif event[1] != "steps":
+                        streamed[event[1]] = event[2]
+                    with preview_slot.container():
+                        st.markdown("##### 02. 構成案 (生成中...)")
+                        st.markdown(f"**タイトル:** {streamed.get('main_title', '')}")
+                        st.markdown(f"**サブタイトル:** {streamed.get('summary', '')}")
+                        for i, step in enumerate(streamed["steps"]):
+                            st.markdown(f"**Step {i+1}. {step.get('label', '')}** — {step.get('visual_desc', '')}")
 
                 try:
-                    res, used = generate_with_fallback(st.session_state.fallback_list_text, content)
-                    cleaned = res.text.replace("```json", "").replace("```", "").strip()
-                    st.session_state.draft_data = json.loads(cleaned)
+                    st.session_state.draft_data, used = pipeline.run_structure_stream(
+                        st.session_state.fallback_list_text, input_text, archetype, additional_inst,
+                        st.session_state.ref_images, is_ref_mandatory, on_event=on_struct_event, on_queue=queue_notice())
+
+                    # Speculative draft from the unedited structure
+                    pipeline.discard_speculative_draft(st.session_state.speculative_job)
+                    st.session_state.speculative_job = None
+                    if st.session_state.use_speculative_draft:
+                        st.session_state.speculative_job = pipeline.start_speculative_draft(
+                            st.session_state.fallback_list_image, st.session_state.draft_data,
+                            ref_images=st.session_state.ref_images, is_ref_mandatory=is_ref_mandatory,
+                            layout_feedback=st.session_state.layout_feedback,
+                            use_cache=st.session_state.use_response_cache, hedge=st.session_state.use_hedging,
+                            api_key=st.session_state.api_key or None,
+                            session=st.session_state.client_id, priority="speculative", trace=st.session_state.trace)
                     st.session_state.phase = "struct"
                     st.rerun()
                 except Exception as e:
@@ -514,7 +665,7 @@ elif st.session_state.phase == "struct":
         for idx, img in enumerate(st.session_state.ref_images):
             if idx < 6:
                 with cols[idx]:
-                    st.image(img, use_container_width=True)
+                    st.image(image_utils.display_source(img), use_container_width=True)
         st.markdown("---")
 
     data = st.session_state.draft_data
@@ -525,9 +676,8 @@ elif st.session_state.phase == "struct":
         retake_instr = col_r1.text_input("修正指示")
         if col_r2.button("再生成"):
             try:
-                p = f"修正指示: {retake_instr}\n現在のJSON: {json.dumps(data, ensure_ascii=False)}"
-                res, _ = generate_with_fallback(st.session_state.fallback_list_text, p)
-                st.session_state.draft_data = json.loads(res.text.replace("```json", "").replace("```", "").strip())
+                # Patch first (only the changes come back), full regeneration as fallback
+                st.session_state.draft_data, _, _ = pipeline.run_retake(st.session_state.fallback_list_text, data, retake_instr, on_queue=queue_notice())
                 st.rerun()
             except: st.error("Failed")
 
@@ -544,16 +694,22 @@ elif st.session_state.phase == "struct":
             v = st.text_input(f"指示 {i+1}", value=step['visual_desc'])
             updated_steps.append({"label": l, "visual_desc": v})
     data["steps"] = updated_steps
+
+    # Drop the speculative draft as soon as the structure no longer matches it
+    if st.session_state.speculative_job and not pipeline.speculative_matches(
+            st.session_state.speculative_job, pipeline.build_final_prompt(data), st.session_state.layout_feedback):
+        pipeline.discard_speculative_draft(st.session_state.speculative_job)
+        st.session_state.speculative_job = None
     
     col1, col2 = st.columns([1,1])
     if col1.button("戻る", type="secondary"):
         st.session_state.phase = "input"
         st.rerun()
     if col2.button("ドラフト作成 →", type="primary"):
-        steps_str = "\n".join([f"{i+1}. {s['label']}: {s['visual_desc']}" for i, s in enumerate(updated_steps)])
-        st.session_state.final_prompt = f"Title: {new_title}\nSummary: {new_summary}\nStyle: {data.get('recommended_style')}\nStructure: {data.get('archetype_name')}\nSteps:\n{steps_str}\nTarget Language: Japanese."
+        st.session_state.final_prompt = pipeline.build_final_prompt(data)
         st.session_state.phase = "draft"
         st.session_state.needs_draft_gen = True
+        st.session_state.style_renders = {}
         st.rerun()
 
 # --- Step 3: Draft ---
@@ -563,25 +719,30 @@ elif st.session_state.phase == "draft":
     
     if st.session_state.needs_draft_gen:
         with st.spinner("ラフスケッチ生成中..."):
-            try:
-                base = st.session_state.final_prompt
-                fb = f" Fix layout: {st.session_state.layout_feedback}" if st.session_state.layout_feedback else ""
-                override = " [DRAFT MODE] Simple Black & White sketch wireframe."
-                
-                # Construct Content with Images
-                prompt_content = [base + fb + override]
-                if "ref_images" in st.session_state and st.session_state.ref_images:
-                    prompt_content.extend(st.session_state.ref_images)
-                    if getattr(st.session_state, "is_ref_mandatory", False):
-                        prompt_content[0] += "\n\nIMPORTANT: You MUST include the character/style from the attached reference images in this draft sketch."
-                
-                res, _ = generate_with_fallback(st.session_state.fallback_list_image, prompt_content)
-                st.session_state.draft_image = parse_image_response(res)
-                st.session_state.needs_draft_gen = False
-            except Exception as e: st.error(str(e))
+            # Use the speculative render if it was built from exactly this prompt
+            spec_job = st.session_state.speculative_job
+            st.session_state.speculative_job = None
+            if pipeline.speculative_matches(spec_job, st.session_state.final_prompt, st.session_state.layout_feedback):
+                try:
+                    st.session_state.draft_image, _ = pipeline.adopt_speculative_draft(spec_job, on_queue=queue_notice())
+                    st.session_state.needs_draft_gen = False
+                except Exception:
+                    pass # Fall through to a regular render
+            else:
+                pipeline.discard_speculative_draft(spec_job)
+
+            if st.session_state.needs_draft_gen:
+                try:
+                    st.session_state.draft_image, _ = pipeline.run_draft(
+                        st.session_state.fallback_list_image, st.session_state.final_prompt,
+                        ref_images=st.session_state.get("ref_images"),
+                        is_ref_mandatory=getattr(st.session_state, "is_ref_mandatory", False),
+                        layout_feedback=st.session_state.layout_feedback, on_queue=queue_notice())
+                    st.session_state.needs_draft_gen = False
+                except Exception as e: st.error(str(e))
 
     if st.session_state.draft_image:
-        st.image(st.session_state.draft_image, caption="Draft", use_container_width=True)
+        st.image(image_utils.display_source(st.session_state.draft_image), caption="Draft", use_container_width=True)
 
     col_f1, col_f2 = st.columns([4, 1])
     layout_fb = col_f1.text_input("レイアウト修正指示")
@@ -603,6 +764,7 @@ elif st.session_state.phase == "design":
     # Grid Layout: 5 Columns for compact view
     style_keys = list(STYLE_PROMPTS.keys())
     cols = st.columns(5)
+    thumb_slots = {}
     
     for i, style_name in enumerate(style_keys):
         col = cols[i % 5]
@@ -649,7 +811,44 @@ elif st.session_state.phase == "design":
                     st.session_state.selected_style_key = style_name
                     st.rerun()
 
+                # Thumbnail slot (filled live by the multi-style render)
+                thumb_slots[style_name] = st.empty()
+                if style_name in st.session_state.style_renders:
+                    thumb_slots[style_name].image(image_utils.display_source(st.session_state.style_renders[style_name]), use_container_width=True)
+                    if st.button("この画像を採用", key=f"adopt_{i}", use_container_width=True):
+                        st.session_state.selected_style_key = style_name
+                        st.session_state.final_image = st.session_state.style_renders[style_name]
+                        image_utils.precompute_renditions(st.session_state.final_image)
+                        history_utils.save_session(st.session_state, st.session_state.final_image)
+                        st.rerun()
+
     st.markdown("---")
+
+    # Multi-Style Comparison
+    with st.expander("🖼️ 複数スタイルを一括で描画して比較"):
+        compare_keys = st.multiselect("比較するスタイル", style_keys, default=[], format_func=lambda k: k.split('(')[0])
+        col_m1, col_m2 = st.columns(2)
+        run_keys = []
+        if col_m1.button("選択したスタイルを描画", use_container_width=True, disabled=not compare_keys):
+            run_keys = compare_keys
+        if col_m2.button("全スタイルを描画", use_container_width=True):
+            run_keys = style_keys
+
+        if run_keys:
+            progress = st.progress(0.0, text=f"0 / {len(run_keys)} 完了")
+            done = []
+
+            def on_style_done(key, img, err):
+                done.append(key)
+                if img is not None:
+                    st.session_state.style_renders[key] = img
+                    thumb_slots[key].image(image_utils.display_source(img), use_container_width=True)
+                else:
+                    thumb_slots[key].caption(f"⚠️ 失敗: {err}")
+                progress.progress(len(done) / len(run_keys), text=f"{len(done)} / {len(run_keys)} 完了")
+
+            render_styles_parallel(run_keys, on_style_done)
+            st.rerun()
     
     # Generate Section
     st.markdown(f"#### 🎨 選択中のスタイル: **{st.session_state.selected_style_key.split('(')[0]}**")
@@ -659,20 +858,10 @@ elif st.session_state.phase == "design":
         if st.button("🚀 完成画像を生成する", type="primary", use_container_width=True):
             with st.spinner(f"「{st.session_state.selected_style_key}」で清書中..."):
                 try:
-                    base = st.session_state.final_prompt
-                    style_instr = STYLE_PROMPTS[st.session_state.selected_style_key]
-                    prompt_text = f"{base}\n[FINAL STYLE] {style_instr}\nHigh Quality Render."
-                    
-                    # Construct Content with Images
-                    prompt_content = [prompt_text]
-                    if "ref_images" in st.session_state and st.session_state.ref_images:
-                        prompt_content.extend(st.session_state.ref_images)
-                        # Add emphasis if mandatory
-                        if getattr(st.session_state, "is_ref_mandatory", False):
-                             prompt_content[0] += "\n\nCRITICAL: The character/object from the reference images MUST appear in the final output as the main subject."
-
-                    res, used = generate_with_fallback(st.session_state.fallback_list_image, prompt_content)
-                    st.session_state.final_image = parse_image_response(res)
+                    st.session_state.final_image, used = pipeline.run_final(
+                        st.session_state.fallback_list_image, style_key=st.session_state.selected_style_key,
+                        **final_inputs(), on_queue=queue_notice())
+                    image_utils.precompute_renditions(st.session_state.final_image)
                     
                     # Auto Save
                     history_utils.save_session(st.session_state, st.session_state.final_image)
@@ -687,7 +876,32 @@ elif st.session_state.phase == "design":
     # Final Image & Download & Back Navigation
     if "final_image" in st.session_state and st.session_state.final_image:
         st.success("✅ 生成が完了しました")
-        st.image(st.session_state.final_image, caption="Final Output", use_container_width=True)
+        st.image(image_utils.display_source(st.session_state.final_image), caption="Final Output", use_container_width=True)
+
+        # Revision chain of this project: jump back to any earlier output
+        history_utils.sync_revisions(st.session_state) # Numbers as written (no-op while saves are queued)
+        revisions = st.session_state.revisions or []
+        if len(revisions) > 1 and st.session_state.history_session_id:
+            rev_labels = {
+                r["rev"]: f"r{r['rev']} ・ {(r.get('style') or '').split('(')[0]}" + (f" ・ {r['modification'][:20]}" if r.get("modification") else "")
+                for r in revisions
+            }
+            rev_keys = list(rev_labels)
+            current_rev = st.session_state.current_revision if st.session_state.current_revision in rev_labels else rev_keys[-1]
+            picked_rev = st.selectbox("リビジョン", rev_keys, index=rev_keys.index(current_rev), format_func=rev_labels.get)
+            if picked_rev != current_rev:
+                try:
+                    history_utils.flush_saves(10) # The revision may still be in the write queue
+                    picked = next(r for r in revisions if r["rev"] == picked_rev)
+                    img, revision = history_utils.load_revision(st.session_state.history_session_id, picked_rev, revision_id=picked.get("id"))
+                    st.session_state.final_image = img
+                    if revision.get("style") in STYLE_PROMPTS:
+                        st.session_state.selected_style_key = revision["style"]
+                    st.session_state.current_revision = picked_rev
+                    history_utils.sync_revisions(st.session_state) # Maps it to the written number
+                    image_utils.precompute_renditions(img)
+                    st.rerun()
+                except Exception as e: st.error(f"Failed to load revision: {e}")
         
         # --- Refinement Section ---
         st.markdown("### 🛠️ 仕上がりを微調整")
@@ -699,23 +913,14 @@ elif st.session_state.phase == "design":
             if col_ref2.button("修正を実行", type="primary"):
                 with st.spinner("修正中..."):
                     try:
-                        base = st.session_state.final_prompt
-                        style_instr = STYLE_PROMPTS[st.session_state.selected_style_key]
-                        # Append modification instruction
-                        prompt_text = f"{base}\n[FINAL STYLE] {style_instr}\n[MODIFICATION] {refine_inst}\nHigh Quality Render."
-                        
-                        # Construct Content with Images (Reuse logic)
-                        prompt_content = [prompt_text]
-                        if "ref_images" in st.session_state and st.session_state.ref_images:
-                            prompt_content.extend(st.session_state.ref_images)
-                            if getattr(st.session_state, "is_ref_mandatory", False):
-                                 prompt_content[0] += "\n\nCRITICAL: The character/object from the reference images MUST appear in the final output as the main subject."
-
-                        res, used = generate_with_fallback(st.session_state.fallback_list_image, prompt_content)
-                        st.session_state.final_image = parse_image_response(res)
+                        # Append modification instruction (run_final makes it a "refine" call)
+                        st.session_state.final_image, used = pipeline.run_final(
+                            st.session_state.fallback_list_image, style_key=st.session_state.selected_style_key,
+                            **final_inputs(), modification=refine_inst, on_queue=queue_notice())
+                        image_utils.precompute_renditions(st.session_state.final_image)
                         
-                        # Auto Save
-                        history_utils.save_session(st.session_state, st.session_state.final_image)
+                        # Auto Save (a new revision of this project)
+                        history_utils.save_session(st.session_state, st.session_state.final_image, modification=refine_inst)
                         st.rerun()
                     except Exception as e: st.error(str(e))
         # --------------------------
@@ -727,21 +932,9 @@ elif st.session_state.phase == "design":
             fmt = st.radio("保存形式", ["PNG", "JPEG"], horizontal=True)
         
         with col_dl2:
-            buf = io.BytesIO()
-            img_to_save = st.session_state.final_image.copy()
-            
-            if fmt == "PNG":
-                mime_type = "image/png"
-                ext = "png"
-                img_to_save.save(buf, format="PNG")
-            else:
-                mime_type = "image/jpeg"
-                ext = "jpg"
-                if img_to_save.mode in ("RGBA", "P"):
-                    img_to_save = img_to_save.convert("RGB")
-                img_to_save.save(buf, format="JPEG", quality=95)
-                
-            byte_im = buf.getvalue()
+            # Served straight from the model's bytes when the format already matches,
+            # otherwise from the rendition cache (encoded once per image)
+            byte_im, mime_type, ext = image_utils.get_download_bytes(st.session_state.final_image, fmt, quality=95)
             
             st.download_button(
                 label=f"📥 画像をダウンロード (. {ext})",
@@ -768,3 +961,23 @@ elif st.session_state.phase == "design":
                  st.session_state.phase = "input"
                  st.session_state.clear()
                  st.rerun()
+
+
+# ==========================================
+# 4. Diagnostics
+# ==========================================
+if st.session_state.get("show_diagnostics"):
+    with st.expander("🩺 診断パネル", expanded=True):
+        st.markdown("**このセッションの記録 (新しい順)**")
+        spans = list(reversed(st.session_state.trace.snapshot()))
+        if spans:
+            st.dataframe(spans, use_container_width=True, hide_index=True)
+        else:
+            st.caption("まだ記録がありません")
+        st.markdown("**プロセス全体の集計 (秒)**")
+        summary = metrics_utils.get_summary()
+        if summary:
+            st.dataframe(summary, use_container_width=True, hide_index=True)
+        flights = single_flight.get_stats()
+        st.caption(f"同一リクエストの共有: {flights['shared']}件 (実行 {flights['calls']}件 / 再実行 {flights['retried']}件 / 実行中 {flights['in_flight']}件・待機 {flights['waiting']}件)")
+        st.caption(f"Prometheus 形式: {metrics_utils.METRICS_FILE} ({metrics_utils.FLUSH_INTERVAL:.0f}秒ごとに更新)")
@@ -0,0 +1,189 @@
+"""
+Headless batch runner: input -> struct -> draft -> design for every line of a JSONL file.
+
+    python batch_runner.py topics.jsonl --concurrency 4 --out history_data
+
+Each input line:
+    {"id": "optional-stable-id", "text": "...", "archetype": "...", "style": "...",
+     "ref_images": ["path/to/ref.png"], "additional_inst": "...", "is_ref_mandatory": false}
+
+Results are written in the usual history_data session layout. Progress is appended to a
+checkpoint file, so re-running the same command after a crash skips finished jobs and
+reuses structures that were already generated.
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import history_utils
+import image_utils
+import metrics_utils
+import pipeline
+
+CHECKPOINT_FILE = "batch_checkpoint.jsonl"
+
+_checkpoint_lock = threading.Lock()
+
+
+def job_id_for(job):
+    if job.get("id"):
+        return str(job["id"])
+    canonical = json.dumps(job, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()[:12]
+
+
+def read_jobs(path):
+    jobs = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Skipping line {line_no}: {e}")
+                continue
+            if not job.get("text"):
+                print(f"Skipping line {line_no}: no text")
+                continue
+            jobs.append(job)
+    return jobs
+
+
+def load_checkpoint(path):
+    """
+    Returns {job_id: state} where state holds the latest phase outputs of each job.
+    """
+    state = {}
+    if not os.path.exists(path):
+        return state
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # torn last line after a crash
+            entry = state.setdefault(rec["job"], {})
+            entry[rec["phase"]] = rec
+    return state
+
+
+def append_checkpoint(path, record):
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    with _checkpoint_lock:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def run_job(job, job_id, prior, args, gen_options):
+    ref_images = [image_utils.prepare_reference_image(p) for p in job.get("ref_images", [])]
+    archetype = job.get("archetype") or pipeline.ARCHETYPES[0]
+    style = job.get("style") if job.get("style") in pipeline.STYLE_PROMPTS else pipeline.DEFAULT_STYLE
+    is_ref_mandatory = bool(job.get("is_ref_mandatory", False))
+    additional_inst = job.get("additional_inst", "")
+    trace = metrics_utils.Trace()  # Per-job spans, saved into the session's metadata.json
+    gen_options = dict(gen_options, trace=trace)
+
+    # 1. Structure (reused from the checkpoint when a previous run got this far)
+    if "struct" in prior:
+        draft_data = prior["struct"]["draft_data"]
+    else:
+        draft_data, _ = pipeline.run_structure(
+            args.text_models, job["text"], archetype, additional_inst,
+            ref_images, is_ref_mandatory, **gen_options)
+        append_checkpoint(args.checkpoint, {"job": job_id, "phase": "struct", "draft_data": draft_data})
+
+    final_prompt = pipeline.build_final_prompt(draft_data)
+
+    # 2. Draft (optional; repeated calls are served by the response cache)
+    draft_image = None
+    if args.draft:
+        draft_image, _ = pipeline.run_draft(args.image_models, final_prompt, ref_images, is_ref_mandatory, **gen_options)
+
+    # 3. Final render
+    final_image, used = pipeline.run_final(args.image_models, final_prompt, style, ref_images, is_ref_mandatory, **gen_options)
+
+    # 4. Persist in the history_data layout
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    session_id = f"session_{timestamp}_{hashlib.sha1(job_id.encode('utf-8')).hexdigest()[:8]}"
+    session_state = {
+        "phase": "design",
+        "draft_data": draft_data,
+        "selected_style_key": style,
+        "final_prompt": final_prompt,
+        "is_ref_mandatory": is_ref_mandatory,
+        "additional_inst": additional_inst,
+        "ref_images": ref_images,
+        "trace": trace,
+    }
+    snapshot = history_utils.snapshot_session(session_state, final_image, session_id=session_id, draft_image=draft_image)
+    history_utils.write_snapshot(snapshot)
+
+    append_checkpoint(args.checkpoint, {"job": job_id, "phase": "done", "session_id": session_id, "model": used})
+    return session_id
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate blueprints in bulk from a JSONL file")
+    parser.add_argument("input", help="JSONL file with one job per line")
+    parser.add_argument("--out", default=history_utils.HISTORY_DIR, help="History directory to write sessions into")
+    parser.add_argument("--checkpoint", default=None, help=f"Checkpoint file (default: <out>/{CHECKPOINT_FILE})")
+    parser.add_argument("--concurrency", type=int, default=4, help="Jobs processed in parallel")
+    parser.add_argument("--text-models", default="gemini-2.5-pro", help="Comma separated fallback chain for structure")
+    parser.add_argument("--image-models", default="nano-banana-pro-preview", help="Comma separated fallback chain for images")
+    parser.add_argument("--draft", action="store_true", help="Also render the draft sketch (saved as draft_output.*)")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the response cache")
+    parser.add_argument("--no-hedge", action="store_true", help="Disable hedged requests")
+    parser.add_argument("--api-key", default=os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY"))
+    args = parser.parse_args(argv)
+
+    if not args.api_key:
+        parser.error("API key required (--api-key or GEMINI_API_KEY)")
+
+    history_utils.HISTORY_DIR = args.out
+    history_utils.init_history()
+    args.checkpoint = args.checkpoint or os.path.join(args.out, CHECKPOINT_FILE)
+    args.text_models = [m.strip() for m in args.text_models.split(",") if m.strip()]
+    args.image_models = [m.strip() for m in args.image_models.split(",") if m.strip()]
+    gen_options = {"use_cache": not args.no_cache, "hedge": not args.no_hedge, "api_key": args.api_key}
+
+    jobs = read_jobs(args.input)
+    progress = load_checkpoint(args.checkpoint)
+    todo = []
+    for job in jobs:
+        job_id = job_id_for(job)
+        if "done" in progress.get(job_id, {}):
+            continue
+        todo.append((job, job_id))
+    print(f"{len(jobs)} jobs, {len(jobs) - len(todo)} already done, {len(todo)} to run")
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+        futures = {
+            pool.submit(run_job, job, job_id, progress.get(job_id, {}), args, gen_options): job_id
+            for job, job_id in todo
+        }
+        for n, future in enumerate(as_completed(futures), 1):
+            job_id = futures[future]
+            try:
+                session_id = future.result()
+                print(f"[{n}/{len(todo)}] {job_id} -> {session_id}")
+            except Exception as e:
+                failed += 1
+                append_checkpoint(args.checkpoint, {"job": job_id, "phase": "error", "error": str(e)})
+                print(f"[{n}/{len(todo)}] {job_id} failed: {e}")
+
+    metrics_utils.flush_metrics()
+    print(f"Finished: {len(todo) - failed} ok, {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,518 @@
+"""
+Benchmarks the app's own overhead against a local fake Gemini backend.
+
+    python benchmark.py                                  # all suites, default sizes
+    python benchmark.py --suites history --sizes 100,10000
+    python benchmark.py --compare bench_results/<old commit>.json
+
+Suites:
+    phases    end-to-end latency of struct / retake / draft / final through the real pipeline
+    fallback  attempts, latency and circuit-breaker skips with a flaky primary model
+    save      write_snapshot throughput and background save_session submit / flush time
+    history   get_history_list / count_history / read_session at each --sizes history size
+    memory    peak traced memory of one full session (pipeline + snapshot + write)
+    coalesce  upstream calls saved when --concurrency identical draft requests arrive at once
+
+The fake backend sleeps for --latency (+ --jitter) per call and fails with the configured
+rate, so results measure this code rather than the network. Everything runs in a temp
+directory. Results are written as JSON tagged with the git commit, so runs can be compared.
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import tracemalloc
+import subprocess
+from datetime import datetime
+from PIL import Image
+import cache_utils
+import call_scheduler
+import client_pool
+import history_utils
+import history_index
+import metrics_utils
+import pipeline
+import single_flight
+
+RESULTS_DIR = "bench_results"
+DEFAULT_SIZES = "100,10000,100000"
+
+STRUCT_JSON = json.dumps({
+    "main_title": "ベンチマーク用の構成",
+    "summary": "フェイクバックエンドが返す固定の構成案",
+    "recommended_style": "Clean vector",
+    "archetype_name": pipeline.ARCHETYPES[1],
+    "steps": [{"label": f"ステップ{i + 1}", "visual_desc": f"要素 {i + 1} のアイコンと矢印"} for i in range(5)],
+}, ensure_ascii=False)
+PATCH_JSON = json.dumps([{"op": "replace", "path": "/steps/0/label", "value": "修正後の見出し"}], ensure_ascii=False)
+
+
+# --- Fake Backend ---
+
+class _FakeBlob:
+    def __init__(self, mime_type, data):
+        self.mime_type = mime_type
+        self.data = data
+
+
+class _FakePart:
+    def __init__(self, text="", inline_data=None):
+        self.text = text
+        self.inline_data = inline_data
+
+
+class _FakeResponse:
+    def __init__(self, parts):
+        self.parts = parts
+
+    @property
+    def text(self):
+        texts = [p.text for p in self.parts if p.text]
+        if not texts:
+            raise ValueError("Response has no text parts.")
+        return "".join(texts)
+
+
+class _FakeStream(_FakeResponse):
+    CHUNK_CHARS = 40
+
+    def __iter__(self):
+        text = self.text
+        for i in range(0, len(text), self.CHUNK_CHARS):
+            yield _FakeResponse([_FakePart(text=text[i:i + self.CHUNK_CHARS])])
+
+    def resolve(self):
+        pass
+
+
+class FakeBackend:
+    """
+    Model factory for client_pool.set_model_factory. Text models answer with the canned
+    structure (or a JSON Patch for retakes); model names containing "image" answer with
+    image_bytes. failure_rates maps model name -> probability of raising.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, failure_rates=None, image_bytes=b"", seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rates = failure_rates or {}
+        self.image_bytes = image_bytes
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def __call__(self, model_name, api_key=None):
+        return FakeModel(self, model_name)
+
+    def _simulate(self, model_name):
+        with self._lock:
+            self.calls[model_name] = self.calls.get(model_name, 0) + 1
+            delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0.0)
+            fail = self._rng.random() < self.failure_rates.get(model_name, 0.0)
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise RuntimeError(f"Fake failure from {model_name}")
+
+
+class FakeModel:
+    def __init__(self, backend, model_name):
+        self.backend = backend
+        self.model_name = model_name
+
+    def generate_content(self, prompt, stream=False):
+        self.backend._simulate(self.model_name)
+        first = prompt[0] if isinstance(prompt, list) else prompt
+        if "image" in self.model_name:
+            parts = [_FakePart(inline_data=_FakeBlob("image/png", self.backend.image_bytes))]
+        elif "JSON Patch" in first:
+            parts = [_FakePart(text=PATCH_JSON)]
+        else:
+            parts = [_FakePart(text=STRUCT_JSON)]
+        return _FakeStream(parts) if stream else _FakeResponse(parts)
+
+
+def make_png(kilobytes, seed=0):
+    """
+    Noise PNG of roughly the requested size (noise does not compress).
+    """
+    side = max(8, int((kilobytes * 1024 / 3) ** 0.5))
+    noise = random.Random(seed).randbytes(side * side * 3)
+    buf = io.BytesIO()
+    Image.frombytes("RGB", (side, side), noise).save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
+
+# --- Helpers ---
+
+def _stats(values):
+    if not values:
+        return {"n": 0}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {
+        "n": len(values),
+        "mean": round(sum(values) / len(values), 6),
+        "p50": round(pick(0.5), 6),
+        "p95": round(pick(0.95), 6),
+        "max": round(values[-1], 6),
+    }
+
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _gen_options(trace=None):
+    return {"use_cache": False, "hedge": False, "api_key": None, "session": "benchmark", "trace": trace}
+
+
+def _run_session(text_models, image_models, trace=None):
+    """
+    One full pass through the pipeline. Returns ({phase: seconds}, session_state, final_image).
+    """
+    opts = _gen_options(trace)
+    timings = {}
+    draft_data, t = _timed(lambda: pipeline.run_structure_stream(
+        text_models, "ベンチマーク入力テキスト", pipeline.ARCHETYPES[0], on_event=lambda e: None, **opts)[0])
+    timings["struct"] = t
+    draft_data, t = _timed(lambda: pipeline.run_retake(text_models, draft_data, "最初の見出しを変更", **opts)[0])
+    timings["retake"] = t
+    final_prompt = pipeline.build_final_prompt(draft_data)
+    _, t = _timed(pipeline.run_draft, image_models, final_prompt, **opts)
+    timings["draft"] = t
+    (final_image, _), t = _timed(pipeline.run_final, image_models, final_prompt, pipeline.DEFAULT_STYLE, **opts)
+    timings["final"] = t
+    session_state = {
+        "phase": "design",
+        "draft_data": draft_data,
+        "selected_style_key": pipeline.DEFAULT_STYLE,
+        "final_prompt": final_prompt,
+        "trace": trace,
+    }
+    return timings, session_state, final_image
+
+
+# --- Suites ---
+
+def bench_phases(args, backend):
+    backend.failure_rates = {}
+    per_phase = {"struct": [], "retake": [], "draft": [], "final": []}
+    totals = []
+    for _ in range(args.iterations):
+        timings, _, _ = _run_session(["phases-text"], ["phases-image"])
+        for phase, t in timings.items():
+            per_phase[phase].append(t)
+        totals.append(sum(timings.values()))
+    result = {phase: _stats(values) for phase, values in per_phase.items()}
+    result["end_to_end"] = _stats(totals)
+    # Time spent outside the (fake) model: 4 calls per session
+    result["overhead_per_session"] = _stats([t - 4 * backend.latency for t in totals])
+    return result
+
+
+def bench_fallback(args, backend):
+    primary, secondary = "fallback-primary", "fallback-secondary"
+    backend.failure_rates = {primary: args.failure_rate}
+    calls_before = dict(backend.calls)
+    trace = metrics_utils.Trace()
+    latencies, failures = [], 0
+    for _ in range(args.iterations * 5):
+        try:
+            _, t = _timed(pipeline.run_structure, [primary, secondary], "fallback", pipeline.ARCHETYPES[0], **_gen_options(trace))
+            latencies.append(t)
+        except Exception:
+            failures += 1
+    calls = {m: backend.calls.get(m, 0) - calls_before.get(m, 0) for m in (primary, secondary)}
+    attempts = [s.get("attempts", 0) for s in trace.snapshot() if s["name"] == "generate"]
+    requests = args.iterations * 5
+    backend.failure_rates = {}
+    return {
+        "requests": requests,
+        "failed": failures,
+        "latency": _stats(latencies),
+        "mean_attempts": round(sum(attempts) / len(attempts), 3) if attempts else 0,
+        "primary_calls": calls[primary],
+        "secondary_calls": calls[secondary],
+        # Requests that never reached the flaky primary because its circuit was open
+        "primary_skipped": requests - calls[primary],
+    }
+
+
+def bench_save(args, backend, workdir):
+    history_utils.HISTORY_DIR = os.path.join(workdir, "history_save")
+    history_utils.init_history()
+    _, session_state, final_image = _run_session(["save-text"], ["save-image"])
+    session_state["ref_images"] = [final_image, final_image]
+    payload = len(final_image.data) * 3
+
+    durations = []
+    for i in range(args.save_count):
+        snapshot = history_utils.snapshot_session(session_state, final_image, session_id=f"session_sync_{i:06d}")
+        _, t = _timed(history_utils.write_snapshot, snapshot)
+        durations.append(t)
+    total = sum(durations)
+
+    # A fresh project per call, like the write_snapshot loop (save_session would otherwise
+    # append each save as a revision of the first session)
+    submits = []
+    start = time.perf_counter()
+    for _ in range(args.save_count):
+        for key in ("history_session_id", "revisions", "current_revision"):
+            session_state.pop(key, None)
+        _, t = _timed(history_utils.save_session, session_state, final_image)
+        submits.append(t)
+    history_utils.flush_saves()
+    background_total = time.perf_counter() - start
+
+    # Refinements: every save appends a revision to one session, whose metadata.json grows
+    appends = []
+    for i in range(args.save_count):
+        snapshot = history_utils.snapshot_session(session_state, final_image, session_id="session_revisions", modification=f"rev {i}")
+        _, t = _timed(history_utils.write_snapshot, snapshot)
+        appends.append(t)
+
+    return {
+        "sessions": args.save_count,
+        "bytes_per_session": payload,
+        "write_snapshot": _stats(durations),
+        "sessions_per_sec": round(args.save_count / total, 2) if total else None,
+        "mb_per_sec": round(payload * args.save_count / total / 1e6, 2) if total else None,
+        "save_session_submit": _stats(submits),
+        "background_total_sec": round(background_total, 4),
+        "revision_append": _stats(appends),
+    }
+
+
+def _populate_history(history_dir, count, image_bytes):
+    os.makedirs(history_dir, exist_ok=True)
+    for i in range(count):
+        session_dir = os.path.join(history_dir, f"session_20240101_000000_{i:07d}")
+        os.makedirs(session_dir, exist_ok=True)
+        meta = {
+            "timestamp": f"20240101_{i % 240000:06d}",
+            "input_text": f"ベンチマーク {i}",
+            "phase": "design",
+            "archetype": pipeline.ARCHETYPES[i % len(pipeline.ARCHETYPES)],
+            "selected_style": pipeline.DEFAULT_STYLE,
+            "draft_data": json.loads(STRUCT_JSON),
+            "final_prompt": "",
+        }
+        with open(os.path.join(session_dir, "metadata.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        with open(os.path.join(session_dir, "final_output.png"), "wb") as f:
+            f.write(image_bytes)
+
+
+def bench_history(args, backend, workdir):
+    small_png = make_png(1)
+    results = {}
+    for size in args.sizes:
+        history_dir = os.path.join(workdir, f"history_{size}")
+        _, populate = _timed(_populate_history, history_dir, size, small_png)
+        history_utils.HISTORY_DIR = history_dir
+
+        # The first listing builds the SQLite index from the session folders
+        _, first_list = _timed(history_utils.get_history_list, limit=20)
+        pages = [_timed(history_utils.get_history_list, limit=20)[1] for _ in range(args.iterations)]
+        deep = [_timed(history_utils.get_history_list, limit=20, offset=size // 2)[1] for _ in range(args.iterations)]
+        _, full = _timed(history_utils.get_history_list)
+        counts = [_timed(history_utils.count_history)[1] for _ in range(args.iterations)]
+        rng = random.Random(size)
+        ids = [s["id"] for s in history_utils.get_history_list(limit=min(size, 1000))]
+        loads = [_timed(history_utils.read_session, rng.choice(ids))[1] for _ in range(args.iterations)] if ids else []
+        _, rebuild = _timed(history_index.rebuild_index, history_dir)
+
+        results[str(size)] = {
+            "populate_sec": round(populate, 3),
+            "first_list_with_index_build_sec": round(first_list, 4),
+            "list_first_page": _stats(pages),
+            "list_middle_page": _stats(deep),
+            "list_all_sec": round(full, 4),
+            "count": _stats(counts),
+            "read_session": _stats(loads),
+            "rebuild_index_noop_sec": round(rebuild, 4),
+        }
+        shutil.rmtree(history_dir, ignore_errors=True)
+    return results
+
+
+def bench_memory(args, backend, workdir):
+    history_utils.HISTORY_DIR = os.path.join(workdir, "history_memory")
+    history_utils.init_history()
+    peaks = []
+    tracemalloc.start()
+    try:
+        for i in range(max(3, args.iterations // 4)):
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            _, session_state, final_image = _run_session(["memory-text"], ["memory-image"], trace=metrics_utils.Trace())
+            snapshot = history_utils.snapshot_session(session_state, final_image, session_id=f"session_mem_{i:04d}")
+            history_utils.write_snapshot(snapshot)
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append((peak - base) / 1024)
+    finally:
+        tracemalloc.stop()
+    return {"image_kb": args.image_kb, "peak_kib_per_session": _stats(peaks)}
+
+
+def bench_coalesce(args, backend, workdir):
+    # A workshop: everyone renders the shared template at the same moment
+    cache_dir = cache_utils.CACHE_DIR
+    cache_utils.CACHE_DIR = os.path.join(workdir, "cache_coalesce")
+    model = "coalesce-image"
+    latency = backend.latency
+    backend.latency = max(latency, 0.05)  # Calls must overlap for there to be anything to share
+    calls_before = backend.calls.get(model, 0)
+    stats_before = single_flight.get_stats()
+    latencies = []
+    lock = threading.Lock()
+    try:
+        for i in range(args.iterations):
+            # A new prompt per round, so only in-flight sharing (not the cache) can save calls
+            prompt = f"coalesce round {i}"
+            barrier = threading.Barrier(args.concurrency)
+
+            def request():
+                barrier.wait()
+                _, t = _timed(pipeline.run_draft, [model], prompt, **dict(_gen_options(), use_cache=True))
+                with lock:
+                    latencies.append(t)
+
+            threads = [threading.Thread(target=request) for _ in range(args.concurrency)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+    finally:
+        backend.latency = latency
+        cache_utils.CACHE_DIR = cache_dir
+    stats = single_flight.get_stats()
+    requests = args.iterations * args.concurrency
+    upstream = backend.calls.get(model, 0) - calls_before
+    return {
+        "requests": requests,
+        "upstream_calls": upstream,
+        "shared": stats["shared"] - stats_before["shared"],
+        "calls_saved_ratio": round(1 - upstream / requests, 3) if requests else 0,
+        "latency": _stats(latencies),
+    }
+
+
+SUITES = {
+    "phases": lambda args, backend, workdir: bench_phases(args, backend),
+    "fallback": lambda args, backend, workdir: bench_fallback(args, backend),
+    "save": bench_save,
+    "history": bench_history,
+    "memory": bench_memory,
+    "coalesce": bench_coalesce,
+}
+
+
+# --- Reporting ---
+
+def git_revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except Exception:
+        return None, None
+
+
+def _flatten(obj, prefix=""):
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            yield from _flatten(v, f"{prefix}.{k}" if prefix else k)
+    elif isinstance(obj, (int, float)) and not isinstance(obj, bool):
+        yield prefix, obj
+
+
+def compare(baseline, current):
+    """
+    Prints every numeric result next to the baseline with the relative change.
+    """
+    old = dict(_flatten(baseline.get("results", {})))
+    print(f"\nCompared with {baseline['meta'].get('commit')} ({baseline['meta'].get('timestamp')})")
+    for key, value in _flatten(current["results"]):
+        if key.endswith(".n"):
+            continue  # sample counts, not measurements
+        if key in old and old[key]:
+            change = (value - old[key]) / old[key] * 100
+            print(f"  {key:60s} {old[key]:>12.4f} -> {value:>12.4f}  ({change:+.1f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the app against a local fake model backend")
+    parser.add_argument("--suites", default=",".join(SUITES), help="Comma separated: " + ", ".join(SUITES))
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="History sizes for the history suite")
+    parser.add_argument("--iterations", type=int, default=20, help="Repetitions per measurement")
+    parser.add_argument("--latency", type=float, default=0.0, help="Fake model latency per call (seconds)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra uniform random latency (seconds)")
+    parser.add_argument("--failure-rate", type=float, default=0.3, help="Failure rate of the primary model in the fallback suite")
+    parser.add_argument("--image-kb", type=int, default=512, help="Size of the fake generated image")
+    parser.add_argument("--save-count", type=int, default=50, help="Sessions written by the save suite")
+    parser.add_argument("--concurrency", type=int, default=8, help="Simultaneous identical requests in the coalesce suite")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help=f"Result file (default: {RESULTS_DIR}/<commit>.json)")
+    parser.add_argument("--compare", default=None, help="Earlier result file to compare against")
+    args = parser.parse_args(argv)
+    args.sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    suites = [s.strip() for s in args.suites.split(",") if s.strip()]
+    unknown = [s for s in suites if s not in SUITES]
+    if unknown:
+        parser.error(f"Unknown suites: {', '.join(unknown)}")
+
+    backend = FakeBackend(latency=args.latency, jitter=args.jitter, image_bytes=make_png(args.image_kb, args.seed), seed=args.seed)
+    client_pool.set_model_factory(backend)
+    # The fake backend has no quota: keep the scheduler from pacing the benchmark
+    call_scheduler.DEFAULT_RPM = 10 ** 9
+    call_scheduler.BURST = 10 ** 9
+
+    workdir = tempfile.mkdtemp(prefix="blueprint_bench_")
+    original_history_dir = history_utils.HISTORY_DIR
+    metrics_utils.METRICS_FILE = os.path.join(workdir, "metrics.prom")
+    commit, dirty = git_revision()
+    report = {
+        "meta": {
+            "commit": commit,
+            "dirty": dirty,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        },
+        "results": {},
+    }
+    try:
+        for name in suites:
+            print(f"Running {name}...", flush=True)
+            report["results"][name] = SUITES[name](args, backend, workdir)
+    finally:
+        history_utils.HISTORY_DIR = original_history_dir
+        client_pool.set_model_factory(None)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    out = args.out or os.path.join(RESULTS_DIR, f"{(commit or 'unknown')[:12]}{'-dirty' if dirty else ''}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(report["results"], ensure_ascii=False, indent=2))
+    print(f"Saved results to {out}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
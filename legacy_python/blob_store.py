@@ -0,0 +1,435 @@
+import os
+import time
+import json
+import hashlib
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import history_index
+import history_writer
+import image_utils
+from image_utils import FileImage, make_thumbnail
+
+BLOB_DIR = "blobs"
+GC_GRACE = 60.0  # Seconds a fresh / just reused blob is protected (its session may not be indexed yet)
+LEGACY_FINAL = ("final_output", "draft_output")
+IMAGE_EXTS = ("png", "jpg", "webp")
+COPY_CHUNK = 1024 * 1024  # Bytes per read when streaming blobs
+REENCODE_EXTS = ("png", "gif")  # Blobs the bulk re-encode converts (lossless sources only)
+
+
+def blob_path(history_dir, name):
+    # <history_dir>/blobs/ab/ab12...ef.png
+    return os.path.join(history_dir, BLOB_DIR, name[:2], name)
+
+
+def put_blob(history_dir, data, ext, digest=None):
+    """
+    Stores bytes under their SHA-256 name unless an identical blob already exists.
+    Returns (name, created).
+    """
+    name = f"{digest or hashlib.sha256(data).hexdigest()}.{ext}"
+    path = blob_path(history_dir, name)
+    if touch_blob(history_dir, name):
+        return name, False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    history_writer.atomic_write_bytes(path, data)
+    return name, True
+
+
+def put_blob_file(history_dir, name, fileobj):
+    """
+    Streams a blob whose name is already known (archive import) into the store, verifying
+    that the content hashes to the name. Returns True if it was written, False if present.
+    """
+    if touch_blob(history_dir, name):
+        return False
+    path = blob_path(history_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+    try:
+        h = hashlib.sha256()
+        with os.fdopen(fd, "wb") as f:
+            for chunk in iter(lambda: fileobj.read(COPY_CHUNK), b""):
+                h.update(chunk)
+                f.write(chunk)
+        if h.hexdigest() != name.rsplit(".", 1)[0]:
+            raise ValueError(f"Blob {name} does not match its content hash")
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+
+def file_digest(path):
+    """
+    SHA-256 of a file, read in chunks.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def touch_blob(history_dir, name):
+    """
+    Refreshes the blob's mtime so a concurrent GC treats it as in use. False if it does not exist.
+    """
+    try:
+        os.utime(blob_path(history_dir, name))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def read_blob(history_dir, name):
+    """
+    Lazy handle: nothing is read until the image is displayed or sent to the model.
+    """
+    return FileImage(blob_path(history_dir, name), digest=name.rsplit(".", 1)[0])
+
+
+def put_thumbnail(history_dir, img):
+    """
+    Stores the history-grid preview of img. Returns (name, created).
+    """
+    return put_blob(history_dir, make_thumbnail(img), "webp")
+
+
+def iter_blobs(history_dir):
+    """
+    Yields (name, path) for every stored blob.
+    """
+    root = os.path.join(history_dir, BLOB_DIR)
+    if not os.path.isdir(root):
+        return
+    for shard in os.listdir(root):
+        shard_dir = os.path.join(root, shard)
+        if not os.path.isdir(shard_dir):
+            continue
+        for name in os.listdir(shard_dir):
+            if not name.startswith(".tmp_"):
+                yield name, os.path.join(shard_dir, name)
+
+
+def _remove_if_stale(path, now, grace):
+    try:
+        if now - os.path.getmtime(path) < grace:
+            return 0
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+
+def _refs_current(history_dir):
+    """
+    True when blob_refs can be trusted for deletion. A missing or dirty index (a failed
+    upsert left a session's references out) is rebuilt from metadata.json first.
+    """
+    if history_index.index_exists(history_dir) and not history_index.is_dirty(history_dir):
+        return True
+    try:
+        history_index.rebuild_index(history_dir)
+    except Exception as e:
+        print(f"Skipping blob GC, the index could not be rebuilt: {e}")
+        return False
+    return not history_index.is_dirty(history_dir)
+
+
+def release_blobs(history_dir, names, grace=GC_GRACE):
+    """
+    Deletes the given blobs that no session references any more (called after a session delete).
+    Returns (removed, freed_bytes).
+    """
+    if not _refs_current(history_dir):
+        return 0, 0
+    now = time.time()
+    removed = freed = 0
+    for name, count in history_index.blob_refcounts(history_dir, names).items():
+        if count == 0:
+            size = _remove_if_stale(blob_path(history_dir, name), now, grace)
+            if size:
+                removed += 1
+                freed += size
+    return removed, freed
+
+
+def collect_garbage(history_dir, grace=GC_GRACE):
+    """
+    Full sweep: deletes every unreferenced blob older than grace. Returns (removed, freed_bytes).
+    """
+    # Without an up-to-date index every blob of an unindexed session would look unreferenced
+    if not _refs_current(history_dir):
+        return 0, 0
+    referenced = history_index.blob_refcounts(history_dir)
+    now = time.time()
+    removed = freed = 0
+    for name, path in iter_blobs(history_dir):
+        if name not in referenced:
+            size = _remove_if_stale(path, now, grace)
+            if size:
+                removed += 1
+                freed += size
+    return removed, freed
+
+
+def store_stats(history_dir):
+    count = total = 0
+    for _, path in iter_blobs(history_dir):
+        count += 1
+        total += os.path.getsize(path)
+    return {"blobs": count, "bytes": total}
+
+
+# --- Migration of the per-session layout ---
+
+def legacy_files(session_dir):
+    """
+    {"ref_images": [paths], "final_output": path, "draft_output": path} of the old layout.
+    """
+    found = {"ref_images": [], "final_output": None, "draft_output": None}
+    ref_dir = os.path.join(session_dir, "ref_images")
+    if os.path.isdir(ref_dir):
+        for file in sorted(os.listdir(ref_dir)):
+            if file.startswith("ref_") and file.endswith(IMAGE_EXTS):
+                found["ref_images"].append(os.path.join(ref_dir, file))
+    for key in LEGACY_FINAL:
+        for ext in IMAGE_EXTS:
+            path = os.path.join(session_dir, f"{key}.{ext}")
+            if os.path.exists(path):
+                found[key] = path
+                break
+    return found
+
+
+def _remove_legacy(session_dir, found):
+    for path in found["ref_images"] + [found[k] for k in LEGACY_FINAL if found[k]]:
+        os.remove(path)
+    ref_dir = os.path.join(session_dir, "ref_images")
+    if os.path.isdir(ref_dir) and not os.listdir(ref_dir):
+        os.rmdir(ref_dir)
+
+
+def migrate_session(history_dir, session_id):
+    """
+    Moves one session's image files into the blob store and points metadata.json at them,
+    adding the history thumbnail if the session has none. Order: blobs, metadata, index, then the old files, so a crash never loses an image.
+    Returns the number of image files moved (0 if already migrated).
+    """
+    with history_writer.session_lock(history_dir, session_id):
+        return _migrate_session(history_dir, session_id)
+
+
+def _migrate_session(history_dir, session_id):
+    session_dir = os.path.join(history_dir, session_id)
+    meta_path = os.path.join(session_dir, "metadata.json")
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    found = legacy_files(session_dir)
+
+    if "images" not in meta:
+        def store(path):
+            with open(path, "rb") as f:
+                data = f.read()
+            return put_blob(history_dir, data, path.rsplit(".", 1)[-1].lower())[0]
+
+        meta["images"] = {
+            "ref_images": [store(p) for p in found["ref_images"]],
+            "final_output": store(found["final_output"]) if found["final_output"] else None,
+            "draft_output": store(found["draft_output"]) if found["draft_output"] else None,
+        }
+        meta["images"]["formats"] = {name: name.rsplit(".", 1)[-1] for name in history_index.blobs_from_meta(meta)}
+        # Thumbnail backfilled while the session still had the old layout
+        if meta.get("thumbnail"):
+            meta["images"]["thumbnail"] = meta.pop("thumbnail")
+            meta["images"]["formats"][meta["images"]["thumbnail"]] = "webp"
+        changed = True
+    else:
+        changed = False
+
+    # Sessions saved before thumbnails existed get one here
+    changed = _add_thumbnail(history_dir, session_id, meta, found) or changed
+
+    if changed:
+        history_writer.atomic_write_json(meta_path, meta)
+        history_index.upsert_session(history_dir, session_id, meta)
+
+    # Also clears files left behind by an interrupted earlier migration
+    _remove_legacy(session_dir, found)
+    return len(found["ref_images"]) + sum(1 for k in LEGACY_FINAL if found[k])
+
+
+def _add_thumbnail(history_dir, session_id, meta, found):
+    """
+    Stores a thumbnail of the session's output if it has none and records it in meta:
+    under "images" for blob-layout sessions, top-level for the per-folder layout (whose
+    files stay where they are). Returns True if meta changed.
+    """
+    images = meta.get("images")
+    if images is not None:
+        if images.get("thumbnail"):
+            return False
+        source = images.get("final_output") or images.get("draft_output")
+        source = read_blob(history_dir, source) if source else None
+    else:
+        if meta.get("thumbnail"):
+            return False
+        source = found["final_output"] or found["draft_output"]
+        source = FileImage(source) if source else None
+    if source is None:
+        return False
+    try:
+        name = put_thumbnail(history_dir, source)[0]
+    except Exception as e:
+        print(f"Failed to create thumbnail for {session_id}: {e}")
+        return False
+    if images is not None:
+        images["thumbnail"] = name
+        images.setdefault("formats", {})[name] = "webp"
+    else:
+        meta["thumbnail"] = name
+    return True
+
+
+def backfill_thumbnail(history_dir, session_id):
+    """
+    Adds the history thumbnail to a session saved before thumbnails existed. Only the
+    thumbnail blob and its metadata entry are written; the session's layout is left alone
+    (migrate_session is the explicit conversion). Returns True if a thumbnail was added.
+    """
+    with history_writer.session_lock(history_dir, session_id):
+        session_dir = os.path.join(history_dir, session_id)
+        meta_path = os.path.join(session_dir, "metadata.json")
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        found = legacy_files(session_dir) if "images" not in meta else None
+        if not _add_thumbnail(history_dir, session_id, meta, found):
+            return False
+        history_writer.atomic_write_json(meta_path, meta)
+        history_index.upsert_session(history_dir, session_id, meta)
+        return True
+
+
+def migrate_history(history_dir):
+    """
+    Migrates every session directory. Returns (sessions_migrated, files_moved, failures).
+    """
+    sessions = files = 0
+    failures = []
+    if not os.path.isdir(history_dir):
+        return sessions, files, failures
+    if not history_index.index_exists(history_dir):
+        # Build it first; a fresh index holding only migrated sessions would hide the rest
+        history_index.rebuild_index(history_dir)
+    for item in sorted(os.listdir(history_dir)):
+        if not os.path.isfile(os.path.join(history_dir, item, "metadata.json")):
+            continue
+        try:
+            moved = migrate_session(history_dir, item)
+        except Exception as e:
+            print(f"Failed to migrate {item}: {e}")
+            failures.append(item)
+            continue
+        if moved:
+            sessions += 1
+            files += moved
+    return sessions, files, failures
+
+
+# --- Bulk re-encode into a storage codec ---
+
+def _reencode_blob(job):
+    # Runs in a worker process: writes the converted blob, returns what the parent needs
+    history_dir, name, codec, quality = job
+    img = read_blob(history_dir, name)
+    encoded, label = image_utils.encode_for_storage(img, codec, quality)
+    if encoded is img:
+        return name, name, label, 0, 0
+    new_name, _ = put_blob(history_dir, encoded.data, encoded.ext, encoded.digest)
+    return name, new_name, label, os.path.getsize(blob_path(history_dir, name)), len(encoded.data)
+
+
+def _remap_meta(meta, mapping, labels):
+    images = meta["images"]
+    images["ref_images"] = [mapping.get(n, n) for n in images.get("ref_images") or []]
+    for key in LEGACY_FINAL:
+        if images.get(key):
+            images[key] = mapping.get(images[key], images[key])
+    for revision in meta.get("revisions") or []:
+        if revision.get("final_output"):
+            revision["final_output"] = mapping.get(revision["final_output"], revision["final_output"])
+    formats = {mapping.get(n, n): label for n, label in (images.get("formats") or {}).items()}
+    formats.update({n: labels[n] for n in history_index.blobs_from_meta(meta) if n in labels})
+    images["formats"] = formats
+
+
+def reencode_history(history_dir, codec, quality=image_utils.STORAGE_QUALITY, workers=None):
+    """
+    Converts every lossless (PNG / GIF) blob to codec in a process pool, points the sessions
+    at the new blobs and lets GC drop the old ones. Same crash-safe order as the migration:
+    new blobs, then metadata and index, then deletion. Run it while the app is idle.
+    Returns {"converted", "sessions", "bytes_before", "bytes_after"}.
+    """
+    if not image_utils.codec_available(codec) or codec == "original":
+        raise ValueError(f"Codec not available for re-encoding: {codec}")
+    if not history_index.index_exists(history_dir):
+        history_index.rebuild_index(history_dir)
+    names = [name for name, _ in iter_blobs(history_dir) if name.rsplit(".", 1)[-1] in REENCODE_EXTS]
+    referenced = history_index.blob_refcounts(history_dir, names)
+    jobs = [(history_dir, name, codec, quality) for name in names if referenced.get(name)]
+
+    mapping, labels = {}, {}
+    before = after = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for old, new, label, old_size, new_size in pool.map(_reencode_blob, jobs, chunksize=4):
+            if new != old:
+                mapping[old] = new
+                labels[new] = label
+                before += old_size
+                after += new_size
+
+    sessions = 0
+    for session_id in history_index.sessions_referencing(history_dir, list(mapping)):
+        meta_path = os.path.join(history_dir, session_id, "metadata.json")
+        try:
+            with history_writer.session_lock(history_dir, session_id):
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                _remap_meta(meta, mapping, labels)
+                history_writer.atomic_write_json(meta_path, meta)
+                history_index.upsert_session(history_dir, session_id, meta)
+            sessions += 1
+        except Exception as e:
+            print(f"Failed to re-encode {session_id}: {e}")
+    collect_garbage(history_dir)
+    return {"converted": len(mapping), "sessions": sessions, "bytes_before": before, "bytes_after": after}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Content-addressed image store for history sessions")
+    parser.add_argument("--dir", default="history_data", help="History directory")
+    parser.add_argument("--migrate", action="store_true", help="Move per-session image files into the blob store")
+    parser.add_argument("--gc", action="store_true", help="Delete blobs no session references")
+    parser.add_argument("--grace", type=float, default=GC_GRACE, help="Keep unreferenced blobs younger than this (seconds)")
+    parser.add_argument("--reencode", choices=[c for c in image_utils.STORAGE_CODECS if c != "original"], help="Convert PNG / GIF blobs to this codec")
+    parser.add_argument("--quality", type=int, default=image_utils.STORAGE_QUALITY, help="Quality for lossy codecs")
+    parser.add_argument("--workers", type=int, default=None, help="Re-encode processes (default: CPU count)")
+    args = parser.parse_args()
+
+    if args.migrate:
+        sessions, files, failures = migrate_history(args.dir)
+        print(f"Migrated {sessions} sessions ({files} files), {len(failures)} failed")
+    if args.reencode:
+        result = reencode_history(args.dir, args.reencode, quality=args.quality, workers=args.workers)
+        print(f"Re-encoded {result['converted']} blobs in {result['sessions']} sessions: "
+              f"{result['bytes_before'] / 1e6:.1f} MB -> {result['bytes_after'] / 1e6:.1f} MB")
+    if args.gc:
+        removed, freed = collect_garbage(args.dir, grace=args.grace)
+        print(f"Removed {removed} unreferenced blobs ({freed / 1e6:.1f} MB)")
+    stats = store_stats(args.dir)
+    print(f"{stats['blobs']} blobs, {stats['bytes'] / 1e6:.1f} MB in {os.path.join(args.dir, BLOB_DIR)}")
@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import history_writer
+
+CACHE_DIR = "response_cache"
+CACHE_MAX_BYTES = 512 * 1024 * 1024  # Size budget for the whole cache (LRU eviction above this)
+
+# How long a cached response stays valid, per workflow phase (seconds)
+PHASE_TTLS = {
+    "struct": 24 * 3600,
+    "retake": 24 * 3600,
+    "draft": 7 * 24 * 3600,
+    "final": 30 * 24 * 3600,
+    "refine": 30 * 24 * 3600,
+}
+DEFAULT_TTL = 24 * 3600
+
+_lock = threading.Lock()
+
+
+class CachedBlob:
+    def __init__(self, mime_type, data):
+        self.mime_type = mime_type
+        self.data = data
+
+
+class CachedPart:
+    def __init__(self, text="", inline_data=None):
+        self.text = text
+        self.inline_data = inline_data
+
+
+class CachedResponse:
+    """
+    Minimal stand-in for a GenerateContentResponse rebuilt from the cache.
+    Exposes the same `.parts` / `.text` surface the app reads.
+    """
+    def __init__(self, parts):
+        self.parts = parts
+
+    @property
+    def text(self):
+        texts = [p.text for p in self.parts if p.text]
+        if not texts:
+            raise ValueError("Response has no text parts.")
+        return "".join(texts)
+
+
+def init_cache():
+    if not os.path.exists(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+
+
+def _hash_part(h, part):
+    if isinstance(part, str):
+        h.update(b"T")
+        h.update(part.encode("utf-8"))
+    elif isinstance(part, (bytes, bytearray)):
+        h.update(b"B")
+        h.update(hashlib.sha256(part).digest())
+    elif hasattr(part, "digest") and hasattr(part, "mime_type"):
+        # EncodedImage: content hash is computed once and memoized on the object
+        h.update(b"E")
+        h.update(part.digest.encode("utf-8"))
+    elif hasattr(part, "tobytes") and hasattr(part, "size"):
+        # PIL image: hash decoded pixels so re-opened files map to the same key
+        h.update(b"I")
+        h.update(f"{part.mode}:{part.size}".encode("utf-8"))
+        h.update(hashlib.sha256(part.tobytes()).digest())
+    else:
+        h.update(b"R")
+        h.update(repr(part).encode("utf-8"))
+
+
+def make_cache_key(model_name, prompt):
+    """
+    Content address for a request: model name + full prompt text + a hash of each image.
+    """
+    h = hashlib.sha256()
+    h.update(model_name.encode("utf-8"))
+    parts = prompt if isinstance(prompt, (list, tuple)) else [prompt]
+    for part in parts:
+        h.update(b"\x00")
+        _hash_part(h, part)
+    return h.hexdigest()
+
+
+def make_request_key(model_names, prompt, kind="generate"):
+    """
+    Key of a whole fallback-chain request (single_flight): kind + model chain + the same
+    prompt / image hashing as make_cache_key.
+    """
+    h = hashlib.sha256()
+    h.update(kind.encode("utf-8"))
+    for name in model_names:
+        h.update(b"\x01")
+        h.update(name.encode("utf-8"))
+    parts = prompt if isinstance(prompt, (list, tuple)) else [prompt]
+    for part in parts:
+        h.update(b"\x00")
+        _hash_part(h, part)
+    return h.hexdigest()
+
+
+def _entry_paths(key):
+    entry_dir = os.path.join(CACHE_DIR, key[:2])
+    return entry_dir, os.path.join(entry_dir, f"{key}.json")
+
+
+def _extract_parts(response):
+    parts = []
+    for part in getattr(response, "parts", None) or []:
+        inline = getattr(part, "inline_data", None)
+        if inline is not None and getattr(inline, "data", None):
+            parts.append({"mime_type": inline.mime_type, "data": bytes(inline.data)})
+        else:
+            parts.append({"text": getattr(part, "text", "") or ""})
+    return parts
+
+
+def get_cached(model_name, prompt, phase=None):
+    """
+    Returns a CachedResponse for this request, or None on miss / expiry.
+    """
+    key = make_cache_key(model_name, prompt)
+    entry_dir, meta_path = _entry_paths(key)
+    if not os.path.exists(meta_path):
+        return None
+
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+
+        ttl = PHASE_TTLS.get(phase, DEFAULT_TTL)
+        if time.time() - meta.get("created_at", 0) > ttl:
+            _remove_entry(key)
+            return None
+
+        parts = []
+        for p in meta.get("parts", []):
+            if "blob" in p:
+                with open(os.path.join(entry_dir, p["blob"]), "rb") as f:
+                    parts.append(CachedPart(inline_data=CachedBlob(p["mime_type"], f.read())))
+            else:
+                parts.append(CachedPart(text=p.get("text", "")))
+
+        # Mark as recently used (mtime drives LRU eviction)
+        os.utime(meta_path, None)
+        return CachedResponse(parts)
+    except Exception as e:
+        print(f"Failed to read cache entry {key}: {e}")
+        return None
+
+
+def put_cached(model_name, prompt, response, phase=None):
+    """
+    Stores the raw response payload (text and inline image bytes) under the request key.
+    """
+    parts = _extract_parts(response)
+    if not parts:
+        return
+
+    key = make_cache_key(model_name, prompt)
+    entry_dir, meta_path = _entry_paths(key)
+    try:
+        with _lock:
+            init_cache()
+            os.makedirs(entry_dir, exist_ok=True)
+            meta_parts = []
+            for i, p in enumerate(parts):
+                if "data" in p:
+                    blob_name = f"{key}_{i}.bin"
+                    history_writer.atomic_write_bytes(os.path.join(entry_dir, blob_name), p["data"])
+                    meta_parts.append({"mime_type": p["mime_type"], "blob": blob_name})
+                else:
+                    meta_parts.append(p)
+
+            meta = {
+                "model": model_name,
+                "phase": phase,
+                "created_at": time.time(),
+                "parts": meta_parts,
+            }
+            # Blobs first, then the meta that references them: a reader never sees a torn entry
+            history_writer.atomic_write_bytes(meta_path, json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+
+            _evict_locked()
+    except Exception as e:
+        print(f"Failed to write cache entry {key}: {e}")
+
+
+def _remove_entry(key):
+    entry_dir, meta_path = _entry_paths(key)
+    if not os.path.exists(entry_dir):
+        return
+    for name in os.listdir(entry_dir):
+        if name.startswith(key):
+            try:
+                os.remove(os.path.join(entry_dir, name))
+            except OSError:
+                pass
+
+
+def _evict_locked():
+    """
+    Drops least recently used entries until the cache fits in CACHE_MAX_BYTES.
+    """
+    entries = {}
+    total = 0
+    for sub in os.listdir(CACHE_DIR):
+        sub_dir = os.path.join(CACHE_DIR, sub)
+        if not os.path.isdir(sub_dir):
+            continue
+        for name in os.listdir(sub_dir):
+            if name.startswith("."):
+                continue  # in-progress atomic write
+            path = os.path.join(sub_dir, name)
+            key = name.split("_")[0].split(".")[0]
+            try:
+                st_info = os.stat(path)
+            except OSError:
+                continue
+            entry = entries.setdefault(key, {"size": 0, "atime": 0})
+            entry["size"] += st_info.st_size
+            if name.endswith(".json"):
+                entry["atime"] = st_info.st_mtime
+            total += st_info.st_size
+
+    if total <= CACHE_MAX_BYTES:
+        return
+
+    for key, entry in sorted(entries.items(), key=lambda kv: kv[1]["atime"]):
+        _remove_entry(key)
+        total -= entry["size"]
+        if total <= CACHE_MAX_BYTES:
+            break
+
+
+def clear_cache():
+    with _lock:
+        if os.path.exists(CACHE_DIR):
+            for sub in os.listdir(CACHE_DIR):
+                sub_dir = os.path.join(CACHE_DIR, sub)
+                if os.path.isdir(sub_dir):
+                    for name in os.listdir(sub_dir):
+                        try:
+                            os.remove(os.path.join(sub_dir, name))
+                        except OSError:
+                            pass
@@ -0,0 +1,220 @@
+import time
+import itertools
+import threading
+
+# Requests per minute allowed per (API key, model); models not listed use DEFAULT_RPM
+DEFAULT_RPM = 30
+MODEL_RPM = {
+    "gemini-2.5-pro": 30,
+    "nano-banana-pro-preview": 20,
+}
+BURST = 3                # Calls that may start back to back after an idle period
+THROTTLE_BACKOFF = 15    # Seconds a bucket stays empty after the API reported a quota error
+QUEUE_TIMEOUT = 180      # Seconds a call may wait for its turn before giving up
+
+# Lower runs first. Speculative drafts only use capacity nobody else is asking for.
+PRIORITIES = {"final": 0, "refine": 0, "draft": 1, "struct": 2, "retake": 2, "speculative": 3}
+DEFAULT_PRIORITY = 2
+
+
+class QueueTimeout(RuntimeError):
+    """
+    The call waited longer than QUEUE_TIMEOUT for a free slot.
+    """
+
+
+class CallCancelled(RuntimeError):
+    """
+    The caller no longer needs the result (e.g. another hedged attempt already won).
+    """
+
+
+class TokenBucket:
+    def __init__(self, rpm, burst=None):
+        self.rate = rpm / 60.0
+        self.capacity = float(burst or BURST)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        if now < self.blocked_until:
+            self.updated = now
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """
+        Seconds until one token is available (0 if one is available now).
+        """
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def drain(self, seconds):
+        self.tokens = 0.0
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class _Ticket:
+    __slots__ = ("bucket_key", "priority", "tag", "seq", "session", "owner", "cancelled")
+
+    def __init__(self, bucket_key, priority, tag, seq, session, owner):
+        self.bucket_key = bucket_key
+        self.priority = priority
+        self.tag = tag
+        self.seq = seq
+        self.session = session
+        self.owner = owner
+        self.cancelled = False
+
+    def order(self):
+        return (self.priority, self.tag, self.seq)
+
+
+_cond = threading.Condition()
+_buckets = {}     # (key_id, model) -> TokenBucket
+_waiting = []     # queued _Tickets across all buckets
+_vtime = {}       # bucket_key -> fair-queuing tag of the last dispatched ticket
+_last_tag = {}    # (bucket_key, session) -> tag of that session's newest queued ticket
+_promoted = {}    # owner -> priority raised by promote (until cancel(owner))
+_seq = itertools.count()
+
+
+def priority_for(phase):
+    return PRIORITIES.get(phase, DEFAULT_PRIORITY)
+
+
+def _bucket(bucket_key):
+    bucket = _buckets.get(bucket_key)
+    if bucket is None:
+        bucket = TokenBucket(MODEL_RPM.get(bucket_key[1], DEFAULT_RPM))
+        _buckets[bucket_key] = bucket
+    return bucket
+
+
+def _position(ticket):
+    # 1-based place in line for the ticket's bucket
+    order = ticket.order()
+    return 1 + sum(1 for t in _waiting if t.bucket_key == ticket.bucket_key and t.order() < order)
+
+
+def acquire(key_id, model_name, phase=None, session="default", owner=None, priority=None, on_wait=None, timeout=QUEUE_TIMEOUT):
+    """
+    Blocks until this call may hit the API: it must be first in line for its (key, model)
+    bucket and the bucket must have a token. Within a priority class sessions are served
+    round robin (start-time fair queuing), so one busy session cannot starve the others.
+
+    on_wait(position) is called from this thread whenever the place in line changes.
+    priority is a number or a PRIORITIES name (default: the phase's).
+    """
+    bucket_key = (key_id, model_name)
+    if priority is None or isinstance(priority, str):
+        priority = priority_for(priority or phase)  # a PRIORITIES name such as "speculative"
+    deadline = time.monotonic() + timeout
+    last_pos = None
+
+    with _cond:
+        if owner is not None and owner in _promoted:
+            priority = min(priority, _promoted[owner])
+        session_key = (bucket_key, session)
+        tag = max(_vtime.get(bucket_key, 0), _last_tag.get(session_key, 0)) + 1
+        _last_tag[session_key] = tag
+        ticket = _Ticket(bucket_key, priority, tag, next(_seq), session, owner)
+        _waiting.append(ticket)
+        _cond.notify_all()
+
+        try:
+            while True:
+                if ticket.cancelled:
+                    raise CallCancelled(f"{model_name}: cancelled while queued")
+                now = time.monotonic()
+                pos = _position(ticket)
+                if pos == 1:
+                    bucket = _bucket(bucket_key)
+                    delay = bucket.wait_time(now)
+                    if delay == 0:
+                        bucket.take()
+                        _vtime[bucket_key] = ticket.tag
+                        return
+                else:
+                    delay = None
+                if now >= deadline:
+                    raise QueueTimeout(f"{model_name}: waited {timeout}s in the request queue")
+
+                if on_wait and pos != last_pos:
+                    last_pos = pos
+                    _cond.release()
+                    try:
+                        on_wait(pos)
+                    finally:
+                        _cond.acquire()
+                    continue
+
+                remaining = deadline - now
+                _cond.wait(remaining if delay is None else min(delay, remaining))
+        finally:
+            _waiting.remove(ticket)
+            if _last_tag.get(session_key) == ticket.tag:
+                del _last_tag[session_key]  # nothing newer queued for this session
+            _cond.notify_all()
+
+
+def cancel(owner):
+    """
+    Withdraws every queued call belonging to owner.
+    """
+    with _cond:
+        _promoted.pop(owner, None)
+        for t in _waiting:
+            if t.owner is owner:
+                t.cancelled = True
+        _cond.notify_all()
+
+
+def promote(owner, priority):
+    """
+    Raises owner's queued calls, and any it queues later, to priority (a speculative job
+    the user is now waiting for).
+    """
+    with _cond:
+        _promoted[owner] = min(priority, _promoted.get(owner, priority))
+        for t in _waiting:
+            if t.owner is owner and t.priority > priority:
+                t.priority = priority
+        _cond.notify_all()
+
+
+def report_throttled(key_id, model_name, backoff=THROTTLE_BACKOFF):
+    """
+    The API answered with a quota error: stop dispatching to this bucket for a while.
+    """
+    with _cond:
+        _bucket((key_id, model_name)).drain(backoff)
+        _cond.notify_all()
+
+
+def is_throttle_error(e):
+    name = type(e).__name__
+    return name in ("ResourceExhausted", "TooManyRequests") or "429" in str(e)
+
+
+def queue_position(owner):
+    """
+    Best place in line among owner's queued calls, or None if none are waiting.
+    """
+    with _cond:
+        positions = [_position(t) for t in _waiting if t.owner is owner]
+    return min(positions) if positions else None
+
+
+def queue_length():
+    with _cond:
+        return len(_waiting)
@@ -0,0 +1,88 @@
+import hashlib
+import threading
+from collections import OrderedDict
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+
+MAX_KEYS = 64  # Distinct API keys kept configured at once (least recently used dropped)
+
+_lock = threading.Lock()
+_managers = OrderedDict()  # key_id -> per-key client manager (owns that key's connections)
+_models = {}               # (key_id, model_name) -> GenerativeModel bound to that key's client
+_factory = None            # Optional (model_name, api_key) -> model object replacing the SDK
+
+
+def key_id(api_key):
+    """
+    Stable, non-reversible identifier for an API key (the raw key is never used as a dict key or logged).
+    """
+    if not api_key:
+        return "default"
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def _manager(api_key):
+    # Caller holds _lock
+    kid = key_id(api_key)
+    manager = _managers.get(kid)
+    if manager is None:
+        # A private manager per key instead of the process-global genai.configure
+        manager = genai_client._ClientManager()
+        manager.configure(api_key=api_key)
+        _managers[kid] = manager
+        while len(_managers) > MAX_KEYS:
+            old_kid, _ = _managers.popitem(last=False)
+            for k in [k for k in _models if k[0] == old_kid]:
+                del _models[k]
+    _managers.move_to_end(kid)
+    return manager
+
+
+def get_model(model_name, api_key=None):
+    """
+    Returns a shared GenerativeModel for (api key, model). Without a key the SDK's
+    default configuration (environment variables / genai.configure) is used.
+    """
+    kid = key_id(api_key)
+    with _lock:
+        model = _models.get((kid, model_name))
+        if model is None:
+            if _factory is not None:
+                model = _factory(model_name, api_key)
+            else:
+                model = genai.GenerativeModel(model_name)
+                if api_key:
+                    model._client = _manager(api_key).get_default_client("generative")
+            _models[(kid, model_name)] = model
+        elif api_key and kid in _managers:
+            _managers.move_to_end(kid)
+    return model
+
+
+def set_model_factory(factory):
+    """
+    Serves get_model from factory(model_name, api_key) instead of the SDK; None restores the SDK.
+    Used by benchmark.py to run the pipeline against a local fake backend.
+    """
+    global _factory
+    with _lock:
+        _factory = factory
+        _models.clear()
+
+
+def list_model_names(api_key):
+    """
+    Names of the models that support generateContent, listed with this key's own client.
+    """
+    with _lock:
+        model_client = _manager(api_key).get_default_client("model")
+    names = []
+    for m in genai.list_models(client=model_client):
+        if 'generateContent' in m.supported_generation_methods:
+            names.append(m.name.replace("models/", ""))
+    return names
+
+
+def pool_size():
+    with _lock:
+        return {"keys": len(_managers), "models": len(_models)}
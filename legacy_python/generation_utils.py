@@ -0,0 +1,344 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import streamlit as st
+import cache_utils
+import client_pool
+import model_health
+import call_scheduler
+import metrics_utils
+import single_flight
+from image_utils import EncodedImage, to_model_part
+
+QUEUE_POLL = 1.0  # Seconds between queue-position updates while a call is waiting for its turn
+
+
+def parse_image_response(response):
+    """
+    Returns the first inline image of the response as an EncodedImage (original bytes, lazy decode).
+    """
+    try:
+        if hasattr(response, 'parts') and response.parts:
+            for part in response.parts:
+                inline = getattr(part, "inline_data", None)
+                if inline is not None and inline.data:
+                    return EncodedImage(inline.data, inline.mime_type or None)
+            raise ValueError("Response has no inline image data.")
+        if hasattr(response, 'text'):
+            raise ValueError("Response is text, not image.")
+    except Exception as e:
+        raise RuntimeError(f"Failed to parse image from response: {e}")
+
+
+def _payload_bytes(prompt):
+    total = 0
+    for p in (prompt if isinstance(prompt, (list, tuple)) else [prompt]):
+        if isinstance(p, str):
+            total += len(p.encode("utf-8"))
+        elif isinstance(p, EncodedImage):
+            total += len(p.data)
+    return total
+
+
+def _response_bytes(response):
+    total = 0
+    for part in getattr(response, "parts", None) or []:
+        inline = getattr(part, "inline_data", None)
+        if inline is not None and inline.data:
+            total += len(inline.data)
+        else:
+            total += len((getattr(part, "text", "") or "").encode("utf-8"))
+    return total
+
+
+class _Admission:
+    """
+    Model admission of one fallback chain, shared by the batch and streaming paths.
+    Models come in circuit-breaker order and each is admitted right before its attempt,
+    so a half-open circuit's single trial is only taken by a call that actually goes out.
+    If every circuit is open they are tried anyway rather than failing without a call.
+    Admitted models are counted as attempts / fallbacks in rec.
+    """
+    def __init__(self, model_names, rec):
+        self.queue = model_health.order_models(model_names)
+        self.skipped = []
+        self.forced = False
+        self.rec = rec
+        rec["attempts"] = 0
+
+    def has_more(self):
+        return bool(self.queue or self.skipped)
+
+    def next_model(self):
+        name = self._admit()
+        if name is not None:
+            self.rec["attempts"] += 1
+            self.rec["fallbacks"] = self.rec["attempts"] - 1
+        return name
+
+    def _admit(self):
+        while self.queue:
+            name = self.queue.pop(0)
+            if self.forced or model_health.allow_request(name):
+                return name
+            self.skipped.append(name)
+        if self.skipped and not self.forced:
+            self.forced = True
+            self.queue = self.skipped[:]
+            self.skipped.clear()
+            return self.queue.pop(0)
+        return None
+
+
+def _acquire(key_id, model_name, phase, session, owner=None, priority=None, on_wait=None):
+    """
+    Waits for the model's turn in the shared scheduler. An attempt that never goes out
+    (cancelled or timed out in the queue) hands back the half-open trial it was admitted with:
+    it is neither a success nor a failure of the model.
+    """
+    try:
+        call_scheduler.acquire(key_id, model_name, phase, session=session, owner=owner, priority=priority, on_wait=on_wait)
+    except (call_scheduler.CallCancelled, call_scheduler.QueueTimeout):
+        model_health.release_trial(model_name)
+        raise
+
+
+def _call_model(model_name, prompt, api_key=None, phase=None, session="default", owner=None, priority=None, trace=None):
+    """
+    One upstream call, with the outcome fed into the model's health statistics.
+    Waits for its turn in the shared scheduler first; queue time is not counted as latency.
+    """
+    key_id = client_pool.key_id(api_key)
+    with metrics_utils.span("attempt", trace, phase=phase, model=model_name) as rec:
+        _acquire(key_id, model_name, phase, session, owner, priority)
+        start = time.time()
+        rec["queue_wait"] = round(start - rec["start"], 3)
+        try:
+            model = client_pool.get_model(model_name, api_key)
+            if isinstance(prompt, (list, tuple)):
+                prompt = [to_model_part(p) for p in prompt]
+            response = model.generate_content(prompt)
+        except Exception as e:
+            model_health.record_failure(model_name, time.time() - start)
+            if call_scheduler.is_throttle_error(e):
+                call_scheduler.report_throttled(key_id, model_name)
+            raise
+        model_health.record_success(model_name, time.time() - start)
+        rec["latency"] = round(time.time() - start, 3)
+        rec["response_bytes"] = _response_bytes(response)
+    return response
+
+
+def generate_with_fallback(model_names, prompt, phase=None, use_cache=None, hedge=None, api_key=None,
+                           session=None, priority=None, on_queue=None, trace=None, owner=None):
+    """
+    Calls the models in fallback order and returns (response, model_name).
+
+    The chain is reordered by circuit-breaker state, so models that keep failing are
+    tried last. With hedging on, a model that has not answered within its latency
+    percentile deadline gets the next model started alongside it; the first success wins.
+
+    Every attempt goes through call_scheduler (per-model rate limit, priority by phase,
+    fair share per session). on_queue(position) is called from this thread while an
+    attempt is waiting in line, and with None once nothing is queued any more. owner
+    identifies the attempts' tickets for call_scheduler.promote / queue_position (a new
+    object per call by default).
+
+    With the cache on, identical requests (same model chain and prompt) that arrive while
+    one is in flight wait for it and share its response instead of calling the models again
+    (single_flight); their span is marked coalesced.
+
+    The call and each model attempt are recorded as metrics_utils spans (into trace, the
+    session's Trace, when given).
+    """
+    if not model_names:
+        raise ValueError("No models available.")
+    if use_cache is None:
+        use_cache = st.session_state.get("use_response_cache", True)
+    if hedge is None:
+        hedge = st.session_state.get("use_hedging", True)
+    if api_key is None:
+        api_key = st.session_state.get("api_key") or None
+    if session is None:
+        session = st.session_state.get("client_id") or "default"
+    if trace is None:
+        trace = st.session_state.get("trace")
+
+    with metrics_utils.span("generate", trace, phase=phase, request_bytes=_payload_bytes(prompt)) as rec:
+        run = lambda: _run_chain(model_names, prompt, phase, use_cache, hedge, api_key, session, priority, on_queue, trace, rec, owner)
+        if use_cache:
+            (response, used), shared = single_flight.run(cache_utils.make_request_key(model_names, prompt), run)
+            if shared:
+                rec["coalesced"] = 1
+        else:
+            response, used = run()
+        rec["model"] = used
+        rec["response_bytes"] = _response_bytes(response)
+    return response, used
+
+
+def _run_chain(model_names, prompt, phase, use_cache, hedge, api_key, session, priority, on_queue, trace, rec, owner=None):
+    # generate_with_fallback without the argument defaults; rec collects the span attributes
+    if use_cache:
+        for model_name in model_names:
+            cached = cache_utils.get_cached(model_name, prompt, phase)
+            if cached is not None:
+                rec["cache_hit"] = 1
+                return cached, model_name
+
+    models = _Admission(model_names, rec)
+    # Not used as a context manager: a hung losing call must not block the winner.
+    pool = ThreadPoolExecutor(max_workers=len(model_names))
+    owner = owner or object()  # Identifies this call's tickets in the scheduler
+    pending = {}
+    last_error = None
+    launch_next = True
+    hedge_at = None
+    last_pos = None
+
+    def launch(name):
+        nonlocal hedge_at
+        pending[pool.submit(_call_model, name, prompt, api_key, phase, session, owner, priority, trace)] = name
+        hedge_at = time.monotonic() + model_health.hedge_delay(name)
+
+    try:
+        while True:
+            if launch_next:
+                launch_next = False
+                name = models.next_model()
+                if name is not None:
+                    launch(name)
+            if not pending:
+                break
+
+            timeout = max(0.0, hedge_at - time.monotonic()) if (hedge and models.has_more()) else None
+            if on_queue:
+                timeout = QUEUE_POLL if timeout is None else min(timeout, QUEUE_POLL)
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if on_queue:
+                pos = call_scheduler.queue_position(owner)
+                if pos != last_pos:
+                    last_pos = pos
+                    on_queue(pos)
+
+            if not done:
+                if hedge and models.has_more() and time.monotonic() >= hedge_at:
+                    # Deadline passed without an answer: hedge with the next model
+                    name = models.next_model()
+                    if name is not None:
+                        launch(name)
+                continue
+
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    response = future.result()
+                except call_scheduler.CallCancelled:
+                    # The owner withdrew the request (discarded speculative job): no fallback
+                    raise
+                except Exception as e:
+                    # Failed outright: move on to the next model without waiting for a deadline
+                    last_error = e
+                    launch_next = True
+                    continue
+                if use_cache:
+                    cache_utils.put_cached(name, prompt, response, phase)
+                return response, name
+    finally:
+        call_scheduler.cancel(owner)
+        pool.shutdown(wait=False, cancel_futures=True)
+        if on_queue and last_pos is not None:
+            on_queue(None)
+
+    raise last_error
+
+
+def stream_with_fallback(model_names, prompt, new_consumer, phase=None, use_cache=None, api_key=None,
+                         session=None, priority=None, on_queue=None, trace=None, hedge=None):
+    """
+    Streaming variant for text phases. For every model attempt new_consumer(model_name)
+    returns a callable that receives text chunks as they arrive; if it raises (e.g. the
+    output is already malformed) the stream is abandoned and the next model is tried
+    without paying for the rest of the response. Returns (response, model_name).
+    Attempts are sequential (hedge is accepted for the shared options but ignored), but feed
+    the same circuit-breaker statistics, wait for their turn in call_scheduler and are
+    recorded like generate_with_fallback. Identical in-flight requests are coalesced the same
+    way; a waiter's consumer gets the whole text at once, as on a cache hit.
+    """
+    if not model_names:
+        raise ValueError("No models available.")
+    if use_cache is None:
+        use_cache = st.session_state.get("use_response_cache", True)
+    if api_key is None:
+        api_key = st.session_state.get("api_key") or None
+    if session is None:
+        session = st.session_state.get("client_id") or "default"
+    if trace is None:
+        trace = st.session_state.get("trace")
+
+    with metrics_utils.span("generate", trace, phase=phase, request_bytes=_payload_bytes(prompt), stream=True) as rec:
+        run = lambda: _run_stream_chain(model_names, prompt, new_consumer, phase, use_cache, api_key, session, priority, on_queue, trace, rec)
+        if use_cache:
+            (response, used), shared = single_flight.run(cache_utils.make_request_key(model_names, prompt, "stream"), run)
+            if shared:
+                rec["coalesced"] = 1
+                new_consumer(used)(response.text)
+        else:
+            response, used = run()
+        rec["model"] = used
+        rec["response_bytes"] = _response_bytes(response)
+    return response, used
+
+
+def _run_stream_chain(model_names, prompt, new_consumer, phase, use_cache, api_key, session, priority, on_queue, trace, rec):
+    if use_cache:
+        for model_name in model_names:
+            cached = cache_utils.get_cached(model_name, prompt, phase)
+            if cached is not None:
+                rec["cache_hit"] = 1
+                new_consumer(model_name)(cached.text)
+                return cached, model_name
+
+    models = _Admission(model_names, rec)
+    parts = [to_model_part(p) for p in prompt] if isinstance(prompt, (list, tuple)) else prompt
+    key_id = client_pool.key_id(api_key)
+    last_error = None
+    for model_name in iter(models.next_model, None):
+        with metrics_utils.span("attempt", trace, phase=phase, model=model_name, stream=True) as attempt:
+            try:
+                _acquire(key_id, model_name, phase, session, priority=priority, on_wait=on_queue)
+            except call_scheduler.QueueTimeout as e:
+                attempt.update(status="error", error=type(e).__name__)
+                last_error = e
+                continue
+            finally:
+                if on_queue:
+                    on_queue(None)
+            consume = new_consumer(model_name)
+            start = time.time()
+            attempt["queue_wait"] = round(start - attempt["start"], 3)
+            try:
+                model = client_pool.get_model(model_name, api_key)
+                response = model.generate_content(parts, stream=True)
+                for chunk in response:
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        continue  # chunk without text parts (e.g. safety metadata)
+                    attempt.setdefault("first_chunk", round(time.time() - start, 3))
+                    consume(text)
+                response.resolve()
+            except Exception as e:
+                model_health.record_failure(model_name, time.time() - start)
+                if call_scheduler.is_throttle_error(e):
+                    call_scheduler.report_throttled(key_id, model_name)
+                attempt.update(status="error", error=type(e).__name__)
+                last_error = e
+                continue
+            model_health.record_success(model_name, time.time() - start)
+            attempt["latency"] = round(time.time() - start, 3)
+            attempt["response_bytes"] = _response_bytes(response)
+        if use_cache:
+            cache_utils.put_cached(model_name, prompt, response, phase)
+        return response, model_name
+    raise last_error
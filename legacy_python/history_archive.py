@@ -0,0 +1,320 @@
+import io
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import tarfile
+import argparse
+import tempfile
+import history_index
+import history_writer
+import blob_store
+
+ARCHIVE_VERSION = 1
+HEADER_NAME = "archive.json"
+MANIFEST_NAME = "manifest.jsonl"   # Last member: one line per exported session
+CONFLICT_POLICIES = ("skip", "replace", "keep_both")
+INDEX_BATCH = 500                  # Imported sessions per index transaction
+
+SESSION_ID_RE = re.compile(r"^[\w\-]+$")
+BLOB_NAME_RE = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]+$")
+
+
+def _add_bytes(tar, name, data, mtime=None):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = mtime or time.time()
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _add_file(tar, name, path):
+    info = tarfile.TarInfo(name)
+    info.size = os.path.getsize(path)
+    info.mtime = os.path.getmtime(path)
+    with open(path, "rb") as f:
+        tar.addfile(info, f)
+
+
+def _iter_session_ids(history_dir, session_ids=None):
+    if session_ids is not None:
+        yield from session_ids
+        return
+    # scandir instead of listdir + sort: tens of thousands of entries, nothing held in memory
+    with os.scandir(history_dir) as entries:
+        for entry in entries:
+            if entry.is_dir() and os.path.isfile(os.path.join(entry.path, "metadata.json")):
+                yield entry.name
+
+
+def _session_files(history_dir, session_id, meta):
+    """
+    (meta in blob layout, [(blob name, source path)]) for a session of either layout.
+    Per-folder sessions (older saves, the Next.js copy in public/history_data) are
+    converted on the fly; their files are hashed to get content-addressed names.
+    """
+    if "images" in meta:
+        names = history_index.blobs_from_meta(meta)
+        return meta, [(name, blob_store.blob_path(history_dir, name)) for name in names]
+
+    found = blob_store.legacy_files(os.path.join(history_dir, session_id))
+    files = []
+
+    def name_of(path):
+        name = f"{blob_store.file_digest(path)}.{path.rsplit('.', 1)[-1].lower()}"
+        files.append((name, path))
+        return name
+
+    meta = dict(meta)
+    meta["images"] = {
+        "ref_images": [name_of(p) for p in found["ref_images"]],
+        "final_output": name_of(found["final_output"]) if found["final_output"] else None,
+        "draft_output": name_of(found["draft_output"]) if found["draft_output"] else None,
+    }
+    meta["images"]["formats"] = {name: name.rsplit(".", 1)[-1] for name, _ in files}
+    thumbnail = meta.pop("thumbnail", None)  # backfilled into the blob store already
+    if thumbnail:
+        meta["images"]["thumbnail"] = thumbnail
+        meta["images"]["formats"][thumbnail] = "webp"
+        files.append((thumbnail, blob_store.blob_path(history_dir, thumbnail)))
+    return meta, files
+
+
+def export_archive(history_dir, out, session_ids=None, compress=False):
+    """
+    Streams sessions (all, or session_ids) into a tar archive written to the binary file
+    object out, member by member, so memory use does not grow with the history size:
+      archive.json                 header (version, source, time)
+      blobs/<sha256>.<ext>         every image once, before the first session using it
+      sessions/<id>/metadata.json  metadata in the blob-store layout
+      manifest.jsonl               one line per session (id, title, blobs, metadata sha256)
+    Sources may use the blob store or the per-session folder layout.
+    Returns {"sessions", "blobs", "failed"}.
+    """
+    # Blobs already written and the manifest lines live on disk, not in memory
+    seen = sqlite3.connect("")
+    seen.execute("CREATE TABLE blobs (name TEXT PRIMARY KEY)")
+    manifest = tempfile.TemporaryFile()
+    sessions = blobs = 0
+    failed = []
+
+    with tarfile.open(fileobj=out, mode="w|gz" if compress else "w|") as tar:
+        header = {"version": ARCHIVE_VERSION, "created": time.strftime("%Y%m%d_%H%M%S"), "source": os.path.abspath(history_dir)}
+        _add_bytes(tar, HEADER_NAME, json.dumps(header, ensure_ascii=False).encode("utf-8"))
+
+        for session_id in _iter_session_ids(history_dir, session_ids):
+            try:
+                with open(os.path.join(history_dir, session_id, "metadata.json"), "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                meta, files = _session_files(history_dir, session_id, meta)
+                for name, path in files:
+                    if seen.execute("SELECT 1 FROM blobs WHERE name = ?", (name,)).fetchone():
+                        continue
+                    _add_file(tar, f"blobs/{name}", path)
+                    seen.execute("INSERT INTO blobs (name) VALUES (?)", (name,))
+                    blobs += 1
+                data = json.dumps(meta, ensure_ascii=False, indent=2).encode("utf-8")
+                _add_bytes(tar, f"sessions/{session_id}/metadata.json", data)
+            except Exception as e:
+                print(f"Failed to export {session_id}: {e}", file=sys.stderr)  # stdout may be the archive
+                failed.append(session_id)
+                continue
+            entry = {
+                "id": session_id,
+                "title": meta.get("input_text", ""),
+                "timestamp": meta.get("timestamp", ""),
+                "blobs": len(files),
+                "sha256": hashlib.sha256(data).hexdigest(),
+            }
+            manifest.write(json.dumps(entry, ensure_ascii=False).encode("utf-8") + b"\n")
+            sessions += 1
+
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = manifest.tell()
+        info.mtime = time.time()
+        manifest.seek(0)
+        tar.addfile(info, manifest)
+
+    manifest.close()
+    seen.close()
+    return {"sessions": sessions, "blobs": blobs, "failed": failed}
+
+
+def validate_meta(meta, history_dir):
+    """
+    Raises ValueError unless meta is a blob-layout session whose images are all in the store.
+    """
+    if not isinstance(meta, dict) or not isinstance(meta.get("images"), dict):
+        raise ValueError("metadata has no images section")
+    if not isinstance(meta.get("timestamp"), str):
+        raise ValueError("metadata has no timestamp")
+    if not isinstance(meta["images"].get("ref_images") or [], list):
+        raise ValueError("ref_images is not a list")
+    for name in history_index.blobs_from_meta(meta):
+        if not BLOB_NAME_RE.match(name):
+            raise ValueError(f"invalid blob name {name!r}")
+        if not os.path.exists(blob_store.blob_path(history_dir, name)):
+            raise ValueError(f"missing image {name}")
+
+
+def _ingest_session(history_dir, session_id, data, on_conflict, pending, released):
+    # Returns "imported", "replaced", "duplicate" or "conflict" (kept the existing version).
+    # Written sessions are appended to pending for the next batched index update; blobs
+    # only the replaced version used go to released, freed once that update is in.
+    meta = json.loads(data.decode("utf-8"))
+    validate_meta(meta, history_dir)
+    # The app may be saving into the same session from another worker
+    with history_writer.session_lock(history_dir, session_id):
+        return _place_session(history_dir, session_id, data, meta, on_conflict, pending, released)
+
+
+def _place_session(history_dir, session_id, data, meta, on_conflict, pending, released):
+    meta_path = os.path.join(history_dir, session_id, "metadata.json")
+    status = "imported"
+    if os.path.exists(meta_path):
+        with open(meta_path, "rb") as f:
+            existing = f.read()
+        old_meta = json.loads(existing.decode("utf-8"))
+        if existing == data or old_meta == meta:
+            return "duplicate"
+        if on_conflict == "skip":
+            return "conflict"
+        if on_conflict == "keep_both":
+            session_id = f"{session_id}_import_{hashlib.sha256(data).hexdigest()[:8]}"
+            meta_path = os.path.join(history_dir, session_id, "metadata.json")
+            if os.path.exists(meta_path):
+                return "duplicate"  # this exact version was imported before
+        else:
+            status = "replaced"
+            released.extend(set(history_index.blobs_from_meta(old_meta)) - set(history_index.blobs_from_meta(meta)))
+    os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+    history_writer.atomic_write_bytes(meta_path, data)
+    pending.append((session_id, meta))
+    return status
+
+
+def import_archive(history_dir, src, on_conflict="skip"):
+    """
+    Reads an archive written by export_archive from the binary file object src as a
+    stream and ingests it into history_dir (blob store layout). Every blob is verified
+    against its content hash and stored once; a session is only written after its
+    metadata validates and all its images are present. Sessions already present with the
+    same content are skipped; on_conflict decides about different ones with the same id
+    ("skip", "replace", or "keep_both" under a new id); blobs only a replaced version used
+    are freed. Nothing is extracted by path, so member names cannot escape history_dir.
+    Returns counts plus manifest sessions that never arrived (truncated archive).
+    """
+    if on_conflict not in CONFLICT_POLICIES:
+        raise ValueError(f"on_conflict must be one of {CONFLICT_POLICIES}")
+    os.makedirs(history_dir, exist_ok=True)
+    if not history_index.index_exists(history_dir):
+        history_index.rebuild_index(history_dir)
+
+    # Session ids seen in the stream, on disk so memory stays flat
+    seen = sqlite3.connect("")
+    seen.execute("CREATE TABLE sessions (id TEXT PRIMARY KEY, sha256 TEXT)")
+    result = {"imported": 0, "replaced": 0, "duplicate": 0, "conflict": 0, "invalid": [], "blobs_written": 0, "blobs_present": 0, "blobs_released": 0, "missing": []}
+    header = None
+    pending = []
+    released = []
+
+    def flush_index():
+        history_index.upsert_sessions(history_dir, pending)
+        pending.clear()
+        # Only now do the refcounts reflect the replacements (release_blobs skips a dirty index)
+        if released:
+            result["blobs_released"] += blob_store.release_blobs(history_dir, released)[0]
+            released.clear()
+
+    with tarfile.open(fileobj=src, mode="r|*") as tar:
+        try:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                parts = member.name.split("/")
+                f = tar.extractfile(member)
+                if member.name == HEADER_NAME:
+                    header = json.loads(f.read().decode("utf-8"))
+                    if header.get("version", 0) > ARCHIVE_VERSION:
+                        raise ValueError(f"Archive version {header.get('version')} is newer than supported ({ARCHIVE_VERSION})")
+                elif len(parts) == 2 and parts[0] == "blobs" and BLOB_NAME_RE.match(parts[1]):
+                    try:
+                        if blob_store.put_blob_file(history_dir, parts[1], f):
+                            result["blobs_written"] += 1
+                        else:
+                            result["blobs_present"] += 1
+                    except ValueError as e:
+                        print(f"Skipping blob: {e}")
+                elif len(parts) == 3 and parts[0] == "sessions" and parts[2] == "metadata.json" and SESSION_ID_RE.match(parts[1]):
+                    data = f.read()
+                    seen.execute("INSERT OR REPLACE INTO sessions (id, sha256) VALUES (?, ?)", (parts[1], hashlib.sha256(data).hexdigest()))
+                    try:
+                        result[_ingest_session(history_dir, parts[1], data, on_conflict, pending, released)] += 1
+                    except Exception as e:
+                        print(f"Skipping session {parts[1]}: {e}")
+                        result["invalid"].append(parts[1])
+                    if len(pending) >= INDEX_BATCH:
+                        flush_index()
+                elif member.name == MANIFEST_NAME:
+                    # Cross-check: everything the manifest lists must have arrived intact
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        entry = json.loads(line.decode("utf-8"))
+                        row = seen.execute("SELECT sha256 FROM sessions WHERE id = ?", (entry["id"],)).fetchone()
+                        if row is None or row[0] != entry["sha256"]:
+                            result["missing"].append(entry["id"])
+                else:
+                    print(f"Ignoring unexpected archive member {member.name!r}")
+        finally:
+            # Also on a truncated archive: sessions already written must be listed
+            flush_index()
+
+    seen.close()
+    if header is None:
+        raise ValueError("Not a history archive (no archive.json)")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export / import history sessions as a streamed tar archive")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_exp = sub.add_parser("export", help="Write sessions to an archive ('-' for stdout)")
+    p_exp.add_argument("archive")
+    p_exp.add_argument("--dir", default="history_data", help="History directory (public/history_data works too)")
+    p_exp.add_argument("--sessions", help="Comma separated session ids, or @file with one id per line (default: all)")
+    p_exp.add_argument("--gzip", action="store_true", help="Compress the archive (images are already compressed)")
+    p_imp = sub.add_parser("import", help="Read an archive ('-' for stdin) into a history directory")
+    p_imp.add_argument("archive")
+    p_imp.add_argument("--dir", default="history_data", help="History directory")
+    p_imp.add_argument("--on-conflict", choices=CONFLICT_POLICIES, default="skip", help="Same id, different content")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        ids = None
+        if args.sessions:
+            if args.sessions.startswith("@"):
+                with open(args.sessions[1:], "r", encoding="utf-8") as f:
+                    ids = [line.strip() for line in f if line.strip()]
+            else:
+                ids = [s.strip() for s in args.sessions.split(",") if s.strip()]
+        out = sys.stdout.buffer if args.archive == "-" else open(args.archive, "wb")
+        try:
+            result = export_archive(args.dir, out, ids, compress=args.gzip)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+        print(f"Exported {result['sessions']} sessions, {result['blobs']} images, {len(result['failed'])} failed", file=sys.stderr)
+    else:
+        src = sys.stdin.buffer if args.archive == "-" else open(args.archive, "rb")
+        try:
+            result = import_archive(args.dir, src, on_conflict=args.on_conflict)
+        finally:
+            if src is not sys.stdin.buffer:
+                src.close()
+        print(f"Imported {result['imported']}, replaced {result['replaced']}, skipped {result['duplicate']} duplicates "
+              f"and {result['conflict']} conflicting, {len(result['invalid'])} invalid; images written {result['blobs_written']}, already present {result['blobs_present']}")
+        if result["missing"]:
+            print(f"{len(result['missing'])} sessions listed in the manifest did not arrive intact")
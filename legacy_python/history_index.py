@@ -0,0 +1,489 @@
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import argparse
+import unicodedata
+
+INDEX_FILE = "index.db"
+DIRTY_FILE = "index.dirty"  # Present while an index write failed and blob_refs may miss references
+# WAL lets app workers read while another process writes. Set BLUEPRINT_INDEX_JOURNAL=DELETE
+# when the history directory is on a network filesystem (WAL needs shared memory on one host).
+JOURNAL_MODE = os.environ.get("BLUEPRINT_INDEX_JOURNAL", "WAL")
+BUSY_TIMEOUT = 30  # Seconds a connection waits for another process's write lock
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    timestamp TEXT NOT NULL,
+    title TEXT,
+    style TEXT,
+    archetype TEXT,
+    thumbnail TEXT,
+    pinned INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_timestamp ON sessions (timestamp DESC);
+CREATE TABLE IF NOT EXISTS session_access (
+    session_id TEXT PRIMARY KEY,
+    last_access REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blob_refs (
+    session_id TEXT NOT NULL,
+    blob TEXT NOT NULL,
+    PRIMARY KEY (session_id, blob)
+);
+CREATE INDEX IF NOT EXISTS idx_blob_refs_blob ON blob_refs (blob);
+"""
+SESSION_COLUMNS = ("id", "timestamp", "title", "style", "archetype", "thumbnail", "pinned")
+# Columns added after the first release, created on open for older index files
+ADDED_COLUMNS = {"thumbnail": "TEXT", "pinned": "INTEGER NOT NULL DEFAULT 0"}
+_SELECT_SESSIONS = f"SELECT {', '.join(SESSION_COLUMNS)} FROM sessions"
+_UPSERT_SESSION = f"INSERT OR REPLACE INTO sessions ({', '.join(SESSION_COLUMNS)}) VALUES ({', '.join('?' * len(SESSION_COLUMNS))})"
+
+# Full-text search. Japanese has no spaces, so text is stored pre-split into overlapping
+# character bigrams (Latin words and numbers stay whole) and unicode61 just splits on spaces.
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS sessions_fts USING fts5(
+    session_id UNINDEXED,
+    title,
+    body,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+FTS_VERSION = 1  # PRAGMA user_version; bumped when stored search rows change shape
+_INSERT_FTS = "INSERT INTO sessions_fts (rowid, session_id, title, body) VALUES (?, ?, ?, ?)"
+FTS_WEIGHTS = (0.0, 10.0, 1.0)  # bm25 weights per column: session_id, title, body
+SEARCH_LIMIT = 50
+
+_fts_available = True  # False when this SQLite build lacks FTS5 (search falls back to LIKE)
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff66-\uff9f\uac00-\ud7af"
+_RUN_RE = re.compile(f"([{_CJK}]+)|[^\\W_{_CJK}]+")
+
+
+def index_path(history_dir):
+    return os.path.join(history_dir, INDEX_FILE)
+
+
+def index_exists(history_dir):
+    return os.path.exists(index_path(history_dir))
+
+
+def mark_dirty(history_dir):
+    # A file, so GC in other worker processes sees it too
+    try:
+        with open(os.path.join(history_dir, DIRTY_FILE), "a"):
+            pass
+    except OSError as e:
+        print(f"Failed to mark the history index dirty: {e}")
+
+
+def is_dirty(history_dir):
+    return os.path.exists(os.path.join(history_dir, DIRTY_FILE))
+
+
+def _connect(history_dir):
+    os.makedirs(history_dir, exist_ok=True)
+    conn = sqlite3.connect(index_path(history_dir), timeout=BUSY_TIMEOUT)
+    conn.row_factory = sqlite3.Row
+    try:
+        # Persistent in the file after the first switch; NORMAL sync is crash-safe under WAL
+        conn.execute(f"PRAGMA journal_mode = {JOURNAL_MODE}")
+        if JOURNAL_MODE.upper() == "WAL":
+            conn.execute("PRAGMA synchronous = NORMAL")
+    except sqlite3.OperationalError as e:
+        print(f"Failed to set index journal mode: {e}")
+    conn.executescript(SCHEMA)
+    _ensure_fts(conn)
+    columns = {r["name"] for r in conn.execute("PRAGMA table_info(sessions)")}
+    for name, decl in ADDED_COLUMNS.items():
+        if name not in columns:
+            # Older index file; rebuild_index fills the column in
+            conn.execute(f"ALTER TABLE sessions ADD COLUMN {name} {decl}")
+    return conn
+
+
+def _ensure_fts(conn):
+    global _fts_available
+    if not _fts_available:
+        return
+    try:
+        conn.executescript(FTS_SCHEMA)
+    except sqlite3.OperationalError as e:
+        print(f"Full-text search unavailable, falling back to title search: {e}")
+        _fts_available = False
+        return
+    if conn.execute("PRAGMA user_version").fetchone()[0] < FTS_VERSION:
+        # Rows from before rowids were derived from session ids; search_history refills them
+        with conn:
+            conn.execute("DELETE FROM sessions_fts")
+            conn.execute(f"PRAGMA user_version = {FTS_VERSION}")
+
+
+def _fts_rowid(session_id):
+    # Stable rowid per session so updates delete by key (session_id is UNINDEXED, a lookup by it scans the table)
+    return int.from_bytes(hashlib.sha256(session_id.encode("utf-8")).digest()[:8], "big") >> 1
+
+
+def _fts_row(doc):
+    return (_fts_rowid(doc[0]),) + tuple(doc)
+
+
+def _runs(text):
+    # (run, is_cjk) for each word / CJK run of the normalized text
+    for m in _RUN_RE.finditer(unicodedata.normalize("NFKC", text or "").lower()):
+        yield m.group(0), m.group(1) is not None
+
+
+def _bigrams(run):
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def search_tokens(text):
+    """
+    Splits text into search terms: Latin words / numbers as-is, kanji / kana runs as
+    overlapping bigrams plus the run's last character (so every character starts some
+    term and one-character queries find it). NFKC folds full-width forms first.
+    """
+    terms = []
+    for run, cjk in _runs(text):
+        if cjk and len(run) > 1:
+            terms.extend(_bigrams(run))
+            terms.append(run[-1])
+        else:
+            terms.append(run)
+    return terms
+
+
+def match_query(query):
+    """
+    FTS5 MATCH expression for a user query; every word must match. CJK runs become
+    phrases of their bigrams (so they match contiguously), and single characters and
+    Latin words match as prefixes so results appear while typing. None if nothing to search.
+    """
+    parts = []
+    for run, cjk in _runs(query):
+        if cjk and len(run) > 1:
+            parts.append('"' + " ".join(_bigrams(run)) + '"')
+        else:
+            parts.append(f'"{run}"*')
+    return " ".join(parts) or None
+
+
+def _search_doc(session_id, meta):
+    """
+    (session_id, title, body) row for the full-text table, already split into search terms.
+    """
+    draft = meta.get("draft_data") or {}
+    texts = [draft.get("summary", "")]
+    for step in draft.get("steps") or []:
+        if isinstance(step, dict):
+            texts += [step.get("label", ""), step.get("visual_desc", "")]
+    texts += [meta.get("archetype", ""), meta.get("selected_style", ""), meta.get("additional_inst", "")]
+    texts += [r.get("modification") or "" for r in meta.get("revisions") or []]
+    body = " ".join(search_tokens(" ".join(t for t in texts if isinstance(t, str))))
+    return session_id, " ".join(search_tokens(meta.get("input_text", ""))), body
+
+
+def _row_from_meta(session_id, meta):
+    return (
+        session_id,
+        meta.get("timestamp", ""),
+        meta.get("input_text", "No Title"),
+        meta.get("selected_style", ""),
+        meta.get("archetype", ""),
+        (meta.get("images") or {}).get("thumbnail") or meta.get("thumbnail"),
+        1 if meta.get("pinned") else 0,
+    )
+
+
+def blobs_from_meta(meta):
+    """
+    Blob names a session references (metadata "images" section written by the blob store,
+    or the top-level thumbnail of a per-folder session).
+    """
+    images = meta.get("images") or {}
+    names = list(images.get("ref_images") or [])
+    if meta.get("thumbnail"):
+        names.append(meta["thumbnail"])
+    names += [images[k] for k in ("final_output", "draft_output", "thumbnail") if images.get(k)]
+    for revision in meta.get("revisions") or []:
+        names += [revision[k] for k in ("final_output", "thumbnail") if revision.get(k)]
+    return sorted(set(names))
+
+
+def upsert_session(history_dir, session_id, meta):
+    """
+    Adds or refreshes one session row (blob references and search entry too) from its metadata dict.
+    """
+    upsert_sessions(history_dir, [(session_id, meta)])
+
+
+def upsert_sessions(history_dir, items):
+    """
+    upsert_session for many (session_id, meta) pairs in one transaction (bulk import).
+    On failure the index is marked dirty: metadata.json is already written, and blob GC must
+    not trust blob_refs until rebuild_index has run.
+    """
+    try:
+        _upsert_sessions(history_dir, items)
+    except Exception:
+        mark_dirty(history_dir)
+        raise
+
+
+def _upsert_sessions(history_dir, items):
+    conn = _connect(history_dir)
+    try:
+        with conn:
+            for session_id, meta in items:
+                conn.execute(_UPSERT_SESSION, _row_from_meta(session_id, meta))
+                conn.execute("DELETE FROM blob_refs WHERE session_id = ?", (session_id,))
+                conn.executemany(
+                    "INSERT INTO blob_refs (session_id, blob) VALUES (?, ?)",
+                    [(session_id, name) for name in blobs_from_meta(meta)],
+                )
+                if _fts_available:
+                    conn.execute("DELETE FROM sessions_fts WHERE rowid = ?", (_fts_rowid(session_id),))
+                    conn.execute(_INSERT_FTS, _fts_row(_search_doc(session_id, meta)))
+    finally:
+        conn.close()
+
+
+def remove_session(history_dir, session_id):
+    """
+    Drops the session row and its blob references. Returns the blobs it referenced.
+    """
+    conn = _connect(history_dir)
+    try:
+        with conn:
+            blobs = [r["blob"] for r in conn.execute("SELECT blob FROM blob_refs WHERE session_id = ?", (session_id,))]
+            conn.execute("DELETE FROM blob_refs WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            conn.execute("DELETE FROM session_access WHERE session_id = ?", (session_id,))
+            if _fts_available:
+                conn.execute("DELETE FROM sessions_fts WHERE rowid = ?", (_fts_rowid(session_id),))
+    finally:
+        conn.close()
+    return blobs
+
+
+def blob_refcounts(history_dir, names=None):
+    """
+    {blob: number of sessions referencing it}; limited to names when given (unreferenced -> 0).
+    """
+    conn = _connect(history_dir)
+    try:
+        if names is None:
+            rows = conn.execute("SELECT blob, COUNT(*) AS n FROM blob_refs GROUP BY blob").fetchall()
+            return {r["blob"]: r["n"] for r in rows}
+        counts = {}
+        for name in names:
+            counts[name] = conn.execute("SELECT COUNT(*) FROM blob_refs WHERE blob = ?", (name,)).fetchone()[0]
+        return counts
+    finally:
+        conn.close()
+
+
+def _session_dict(r):
+    return {"id": r["id"], "timestamp": r["timestamp"], "title": r["title"], "style": r["style"], "archetype": r["archetype"],
+            "thumbnail": r["thumbnail"], "pinned": bool(r["pinned"])}
+
+
+def sessions_referencing(history_dir, names):
+    """
+    Ids of the sessions that reference any of the given blobs.
+    """
+    conn = _connect(history_dir)
+    try:
+        found = set()
+        for name in names:
+            found.update(r["session_id"] for r in conn.execute("SELECT session_id FROM blob_refs WHERE blob = ?", (name,)))
+        return sorted(found)
+    finally:
+        conn.close()
+
+
+def query_sessions(history_dir, limit=None, offset=0):
+    """
+    Returns sessions newest first, in the same shape get_history_list always used
+    (plus the thumbnail blob name, None for sessions without one).
+    """
+    conn = _connect(history_dir)
+    try:
+        rows = conn.execute(
+            _SELECT_SESSIONS + " "
+            "ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?",
+            (-1 if limit is None else limit, offset),
+        ).fetchall()
+    finally:
+        conn.close()
+    return [_session_dict(r) for r in rows]
+
+
+def search_sessions(history_dir, query, limit=SEARCH_LIMIT):
+    """
+    Sessions matching query, best bm25 rank first (title hits weigh more than body hits),
+    in the same shape as query_sessions.
+    """
+    expr = match_query(query)
+    if expr is None:
+        return []
+    conn = _connect(history_dir)
+    try:
+        if _fts_available:
+            # Rank inside the FTS table first; joining before the LIMIT costs a lookup per match
+            rows = conn.execute(
+                f"SELECT {', '.join('s.' + c for c in SESSION_COLUMNS)} FROM ("
+                f"SELECT session_id, bm25(sessions_fts, {', '.join(map(str, FTS_WEIGHTS))}) AS score FROM sessions_fts "
+                "WHERE sessions_fts MATCH ? ORDER BY score LIMIT ?"
+                ") f JOIN sessions s ON s.id = f.session_id ORDER BY f.score, s.timestamp DESC",
+                (expr, limit),
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                _SELECT_SESSIONS + " "
+                "WHERE title LIKE ? ORDER BY timestamp DESC LIMIT ?",
+                (f"%{query.strip()}%", limit),
+            ).fetchall()
+    finally:
+        conn.close()
+    return [_session_dict(r) for r in rows]
+
+
+def search_index_complete(history_dir):
+    """
+    False when sessions are missing from the search table (index created before search existed).
+    """
+    if not _fts_available:
+        return True
+    conn = _connect(history_dir)
+    try:
+        indexed = conn.execute("SELECT COUNT(*) FROM sessions_fts").fetchone()[0]
+        return indexed >= conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def touch_session(history_dir, session_id, when=None):
+    """
+    Records that the session was restored or saved just now (drives LRU retention).
+    """
+    conn = _connect(history_dir)
+    try:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO session_access (session_id, last_access) VALUES (?, ?)",
+                (session_id, time.time() if when is None else when),
+            )
+    finally:
+        conn.close()
+
+
+def retention_candidates(history_dir):
+    """
+    Every session with its last use (restore / save, else its own timestamp), pin flag and
+    blobs, least recently used first. Feeds history_retention.
+    """
+    conn = _connect(history_dir)
+    try:
+        sessions = conn.execute(
+            "SELECT s.id, s.timestamp, s.pinned, a.last_access FROM sessions s "
+            "LEFT JOIN session_access a ON a.session_id = s.id"
+        ).fetchall()
+        blobs = {}
+        for r in conn.execute("SELECT session_id, blob FROM blob_refs"):
+            blobs.setdefault(r["session_id"], []).append(r["blob"])
+    finally:
+        conn.close()
+    rows = []
+    for r in sessions:
+        last_used = r["last_access"] if r["last_access"] is not None else _timestamp_seconds(r["timestamp"])
+        rows.append({"id": r["id"], "pinned": bool(r["pinned"]), "last_used": last_used, "blobs": blobs.get(r["id"], [])})
+    return sorted(rows, key=lambda r: r["last_used"])
+
+
+def _timestamp_seconds(timestamp):
+    # Session timestamps are "%Y%m%d_%H%M%S" local time; unparsable ones sort first
+    try:
+        return time.mktime(time.strptime(timestamp, "%Y%m%d_%H%M%S"))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def count_sessions(history_dir):
+    conn = _connect(history_dir)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def rebuild_index(history_dir):
+    """
+    Reconciles the index with the session directories on disk and clears the dirty mark.
+    Returns (added_or_updated, removed).
+    """
+    # Cleared before the scan, so a write that fails meanwhile leaves the mark set
+    try:
+        os.remove(os.path.join(history_dir, DIRTY_FILE))
+    except FileNotFoundError:
+        pass
+    try:
+        return _rebuild_index(history_dir)
+    except Exception:
+        mark_dirty(history_dir)
+        raise
+
+
+def _rebuild_index(history_dir):
+    on_disk = {}
+    if os.path.exists(history_dir):
+        for item in os.listdir(history_dir):
+            meta_path = os.path.join(history_dir, item, "metadata.json")
+            if os.path.isfile(meta_path):
+                try:
+                    with open(meta_path, "r", encoding="utf-8") as f:
+                        on_disk[item] = json.load(f)
+                except Exception as e:
+                    print(f"Skipping unreadable session {item}: {e}")
+
+    conn = _connect(history_dir)
+    try:
+        indexed = {r["id"]: tuple(r) for r in conn.execute(_SELECT_SESSIONS)}
+        stale = [sid for sid in indexed if sid not in on_disk]
+        changed = [_row_from_meta(sid, meta) for sid, meta in on_disk.items() if indexed.get(sid) != _row_from_meta(sid, meta)]
+        with conn:
+            conn.executemany("DELETE FROM sessions WHERE id = ?", [(sid,) for sid in stale])
+            conn.executemany("DELETE FROM session_access WHERE session_id = ?", [(sid,) for sid in stale])
+            conn.executemany(_UPSERT_SESSION, changed)
+            # Blob references are cheap to derive, so they are always rebuilt in full
+            conn.execute("DELETE FROM blob_refs")
+            conn.executemany(
+                "INSERT INTO blob_refs (session_id, blob) VALUES (?, ?)",
+                [(sid, name) for sid, meta in on_disk.items() for name in blobs_from_meta(meta)],
+            )
+            if _fts_available:
+                # Search entries: only rewrite the ones whose text changed
+                searchable = {r["session_id"]: tuple(r) for r in conn.execute("SELECT session_id, title, body FROM sessions_fts")}
+                docs = [_search_doc(sid, meta) for sid, meta in on_disk.items()]
+                outdated = [doc for doc in docs if searchable.get(doc[0]) != doc]
+                gone = [sid for sid in searchable if sid not in on_disk]
+                conn.executemany("DELETE FROM sessions_fts WHERE rowid = ?", [(_fts_rowid(sid),) for sid in [d[0] for d in outdated] + gone])
+                conn.executemany(_INSERT_FTS, [_fts_row(doc) for doc in outdated])
+    finally:
+        conn.close()
+    return len(changed), len(stale)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild / repair the history index")
+    parser.add_argument("--dir", default="history_data", help="History directory")
+    parser.add_argument("--rebuild", action="store_true", help="Reconcile the index with the session directories")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        added, removed = rebuild_index(args.dir)
+        print(f"Index rebuilt: {added} added/updated, {removed} removed")
+    print(f"{count_sessions(args.dir)} sessions indexed in {index_path(args.dir)}")
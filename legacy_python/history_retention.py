@@ -0,0 +1,172 @@
+import os
+import time
+import shutil
+import argparse
+import threading
+import history_index
+import history_writer
+import blob_store
+import metrics_utils
+
+# Deployment policy, the same for every history directory (shared root and user namespaces).
+# Unset or 0 disables a limit, so nothing is evicted unless the operator sets one.
+# Pinned sessions are never evicted.
+MAX_BYTES = int(float(os.environ.get("BLUEPRINT_RETENTION_MAX_GB") or 0) * 1024 ** 3) or None  # Image bytes in the blob store
+MAX_AGE_DAYS = float(os.environ.get("BLUEPRINT_RETENTION_MAX_AGE_DAYS") or 0) or None          # Evict sessions not restored / saved for this long
+MAX_SESSIONS = int(os.environ.get("BLUEPRINT_RETENTION_MAX_SESSIONS") or 0) or None            # Keep at most this many sessions
+MIN_IDLE = 3600             # Seconds since last use before a session may be evicted (it may be open in a browser)
+RUN_INTERVAL = 60           # Minimum seconds between background runs
+
+_lock = threading.Lock()
+_wakeup = threading.Event()
+_pending = set()            # history_dirs with a requested run
+_worker = None
+_last_result = None
+
+
+def default_policy():
+    return {"max_bytes": MAX_BYTES, "max_age_days": MAX_AGE_DAYS, "max_sessions": MAX_SESSIONS}
+
+
+def enabled(policy=None):
+    return any(v is not None for v in (policy or default_policy()).values())
+
+
+def delete_session(history_dir, session_id):
+    """
+    Removes a session folder and its index entry, then frees the blobs nothing else references.
+    Returns (blobs_removed, bytes_freed).
+    """
+    session_dir = os.path.join(history_dir, session_id)
+    with history_writer.session_lock(history_dir, session_id):
+        if os.path.isdir(session_dir):
+            shutil.rmtree(session_dir)
+        blobs = history_index.remove_session(history_dir, session_id)
+    return blob_store.release_blobs(history_dir, blobs)
+
+
+def plan_eviction(history_dir, max_bytes=MAX_BYTES, max_age_days=MAX_AGE_DAYS, max_sessions=MAX_SESSIONS, now=None):
+    """
+    Picks the sessions to evict, least recently used first, until the age, count and byte
+    limits all hold. A session only frees the blobs no surviving session shares, so bytes
+    are tracked through reference counts. Returns (session_ids, estimated_bytes_freed).
+    """
+    now = time.time() if now is None else now
+    rows = history_index.retention_candidates(history_dir)
+    sizes = {}
+    total = 0
+    for name, path in blob_store.iter_blobs(history_dir):
+        try:
+            sizes[name] = os.path.getsize(path)
+        except OSError:
+            continue
+        total += sizes[name]
+    refcounts = {}
+    for r in rows:
+        for name in r["blobs"]:
+            refcounts[name] = refcounts.get(name, 0) + 1
+
+    remaining = len(rows)
+    evict = []
+    freed = 0
+    for r in rows:
+        if r["pinned"] or now - r["last_used"] < MIN_IDLE:
+            continue
+        too_old = max_age_days is not None and now - r["last_used"] > max_age_days * 86400
+        too_many = max_sessions is not None and remaining > max_sessions
+        too_big = max_bytes is not None and total - freed > max_bytes
+        if not (too_old or too_many or too_big):
+            continue
+        evict.append(r["id"])
+        remaining -= 1
+        for name in r["blobs"]:
+            refcounts[name] -= 1
+            if refcounts[name] == 0:
+                freed += sizes.get(name, 0)
+    return evict, freed
+
+
+def enforce(history_dir, policy=None):
+    """
+    Evicts sessions until the policy holds. Returns {"evicted", "blobs_removed", "bytes_freed"}.
+    Runs of other worker processes on the same directory wait for each other.
+    """
+    global _last_result
+    policy = dict(default_policy(), **(policy or {}))
+    with history_writer.store_lock(history_dir, "retention"), metrics_utils.span("history_retention") as rec:
+        # Orphaned blobs (e.g. left in the grace period by the previous run) would count against the budget
+        removed, freed = blob_store.collect_garbage(history_dir)
+        session_ids, _ = plan_eviction(history_dir, **policy)
+        for session_id in session_ids:
+            try:
+                r, f = delete_session(history_dir, session_id)
+            except Exception as e:
+                print(f"Failed to evict {session_id}: {e}")
+                continue
+            removed += r
+            freed += f
+        # Blobs of evicted sessions still inside the GC grace period are swept on the next run
+        result = {"evicted": len(session_ids), "blobs_removed": removed, "bytes_freed": freed}
+        rec["bytes_freed"] = freed
+        rec["evicted"] = len(session_ids)
+    _last_result = dict(result, finished=time.time())
+    return result
+
+
+def _run():
+    while True:
+        _wakeup.wait()
+        time.sleep(RUN_INTERVAL)  # Debounce: a burst of saves causes one run
+        with _lock:
+            _wakeup.clear()
+            jobs = list(_pending)
+            _pending.clear()
+        for history_dir in jobs:
+            try:
+                enforce(history_dir)
+            except Exception as e:
+                print(f"Retention run failed ({history_dir}): {e}")
+
+
+def schedule(history_dir):
+    """
+    Requests a background retention run under the deployment policy; returns immediately.
+    Calls within RUN_INTERVAL are coalesced. Does nothing while no limit is configured.
+    """
+    global _worker
+    if not enabled():
+        return
+    with _lock:
+        _pending.add(history_dir)
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name="history-retention", daemon=True)
+            _worker.start()
+    _wakeup.set()
+
+
+def last_result():
+    return _last_result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evict least recently used history sessions")
+    parser.add_argument("--dir", default="history_data", help="History directory")
+    parser.add_argument("--max-gb", type=float, default=(MAX_BYTES or 0) / 1024 ** 3, help="Image storage budget (GB, 0 = no limit; default BLUEPRINT_RETENTION_MAX_GB)")
+    parser.add_argument("--max-age-days", type=float, default=MAX_AGE_DAYS or 0, help="Evict sessions unused for this many days (0 = no limit; default BLUEPRINT_RETENTION_MAX_AGE_DAYS)")
+    parser.add_argument("--max-sessions", type=int, default=MAX_SESSIONS or 0, help="Keep at most this many sessions (0 = no limit; default BLUEPRINT_RETENTION_MAX_SESSIONS)")
+    parser.add_argument("--dry-run", action="store_true", help="Only list what would be evicted")
+    args = parser.parse_args()
+
+    policy = {
+        "max_bytes": int(args.max_gb * 1024 ** 3) or None,
+        "max_age_days": args.max_age_days or None,
+        "max_sessions": args.max_sessions or None,
+    }
+    if args.dry_run:
+        session_ids, freed = plan_eviction(args.dir, **policy)
+        for session_id in session_ids:
+            print(session_id)
+        print(f"Would evict {len(session_ids)} sessions (~{freed / 1e6:.1f} MB)")
+    else:
+        result = enforce(args.dir, policy)
+        print(f"Evicted {result['evicted']} sessions, removed {result['blobs_removed']} blobs ({result['bytes_freed'] / 1e6:.1f} MB)")
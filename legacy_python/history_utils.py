@@ -1,30 +1,111 @@
 import os
+import io
+import copy
 import json
-import shutil
+import uuid
+import hashlib
+import threading
 from datetime import datetime
 import streamlit as st
-from PIL import Image
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+import history_index
+import history_writer
+import blob_store
+import history_retention
+import metrics_utils
+import image_utils
+from image_utils import EncodedImage, FileImage
 
-HISTORY_DIR = "history_data"
+# Absolute so every worker process resolves the same store; point it at a shared volume
+# to share history between hosts (the volume must support POSIX locks)
+HISTORY_DIR = os.path.abspath(os.environ.get("BLUEPRINT_HISTORY_DIR", "history_data"))
+NAMESPACE_DIR = "users"  # Per-user histories: HISTORY_DIR/users/<namespace>
+# Request header carrying the user identity, set by a trusted auth proxy (e.g. X-Forwarded-Email)
+USER_HEADER = os.environ.get("BLUEPRINT_USER_HEADER")
 
-def init_history():
-    if not os.path.exists(HISTORY_DIR):
-        os.makedirs(HISTORY_DIR)
+_thumbnail_requests = set()  # (history_dir, session_id) already queued for a thumbnail backfill
+_thumbnail_lock = threading.Lock()
 
-def save_session(session_state, final_image=None):
+def resolve_namespace():
     """
-    Saves the current session state and valid images to a history folder.
+    History namespace of the current browser user: the identity from USER_HEADER, else the
+    st.login account. None when the user is anonymous; they share the HISTORY_DIR root.
+    """
+    identity = None
+    try:
+        if USER_HEADER:
+            identity = st.context.headers.get(USER_HEADER)
+        if not identity and st.user.get("is_logged_in"):
+            identity = st.user.get("email") or st.user.get("sub")
+    except Exception as e:
+        print(f"Failed to resolve history namespace: {e}")
+    if not identity:
+        return None
+    # Hashed: the directory name does not reveal the address and is always path-safe
+    return "u_" + hashlib.sha256(identity.strip().lower().encode("utf-8")).hexdigest()[:16]
+
+def namespace_dir(namespace=None):
+    if not namespace:
+        return HISTORY_DIR
+    return os.path.join(HISTORY_DIR, NAMESPACE_DIR, namespace)
+
+def current_dir():
+    """
+    History directory of the running script's user. Headless callers (batch_runner,
+    benchmark) and background threads have no script context and get HISTORY_DIR.
+    """
+    if get_script_run_ctx() is None:
+        return HISTORY_DIR
+    return namespace_dir(st.session_state.get("history_namespace"))
+
+def init_history(history_dir=None):
+    history_dir = history_dir or current_dir()
+    os.makedirs(history_dir, exist_ok=True)
+    return history_dir
+
+def _snapshot_image(img):
+    # EncodedImage is immutable bytes and can be shared; PIL images are copied
+    return img if isinstance(img, EncodedImage) else img.copy()
+
+def _image_bytes(img):
+    """
+    Returns (bytes, ext). Encoded images keep their original bytes; PIL images become PNG.
+    """
+    if isinstance(img, EncodedImage):
+        return img.data, img.ext
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue(), "png"
+
+def new_session_id():
+    # Timestamp for readability, random suffix so saves within the same second never collide
+    return f"session_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+
+def _revisions_of(meta):
+    """
+    The session's revision chain. Sessions saved before revisions existed count as one revision.
+    """
+    if meta.get("revisions"):
+        return list(meta["revisions"])
+    images = meta.get("images") or {}
+    if images.get("final_output") or "images" not in meta:
+        return [{"rev": 1, "timestamp": meta.get("timestamp", ""), "style": meta.get("selected_style", ""),
+                 "modification": None, "parent": None, "final_output": images.get("final_output")}]
+    return []
+
+def snapshot_session(session_state, final_image=None, session_id=None, draft_image=None, modification=None):
+    """
+    Captures everything save_session needs, so the write can happen off the UI thread.
+    session_state may be st.session_state or a plain dict (batch runs).
+    Saves into the project's existing session (history_session_id) when there is one;
+    the final image then becomes a new revision of it.
     """
-    init_history()
-    
-    # Create a unique ID for this save
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    session_id = f"session_{timestamp}"
-    session_dir = os.path.join(HISTORY_DIR, session_id)
-    os.makedirs(session_dir, exist_ok=True)
+    session_id = session_id or session_state.get("history_session_id") or new_session_id()
+    current = _current_revision(session_state)
 
-    # 1. Save Meta Data (Text Inputs, Settings)
-    meta_data = {
+    # Meta Data (Text Inputs, Settings) - deep copied so later edits don't leak in
+    meta_data = copy.deepcopy({
         "timestamp": timestamp,
         "input_text": session_state.get("draft_data", {}).get("main_title", "Untitled") or "Untitled",
         "phase": session_state.get("phase", "input"),
@@ -34,94 +115,433 @@ def save_session(session_state, final_image=None):
         "final_prompt": session_state.get("final_prompt", ""),
         "is_ref_mandatory": session_state.get("is_ref_mandatory", False),
         "additional_inst": session_state.get("additional_inst", "")
+    })
+    # Phase / model-attempt spans recorded for this session so far
+    trace = session_state.get("trace")
+    if trace is not None:
+        meta_data["timings"] = trace.snapshot()
+
+    return {
+        "session_id": session_id,
+        "meta": meta_data,
+        # Per-revision delta; the output blob name is filled in by the writer
+        # Revision numbers are assigned by the writer from the on-disk chain; the id ties the
+        # UI's entry to the written one, and parent_id resolves to the parent's number there
+        "revision": {
+            "id": uuid.uuid4().hex[:12],
+            "timestamp": timestamp,
+            "style": meta_data["selected_style"],
+            "modification": modification or None,
+            "parent": session_state.get("current_revision"),
+            "parent_id": (current or {}).get("id"),
+        },
+        "ref_images": [_snapshot_image(img) for img in (session_state.get("ref_images") or [])],
+        "final_image": _snapshot_image(final_image) if final_image else None,
+        "draft_image": _snapshot_image(draft_image) if draft_image else None,
+        # Storage codec for lossless images (encoded by the writer, off the UI thread)
+        "codec": session_state.get("storage_codec") or "original",
+        "quality": session_state.get("storage_quality") or image_utils.STORAGE_QUALITY,
+        # Resolved now: the writer thread cannot see whose session this is
+        "history_dir": namespace_dir(session_state.get("history_namespace")),
     }
-    
-    with open(os.path.join(session_dir, "metadata.json"), "w", encoding="utf-8") as f:
-        json.dump(meta_data, f, ensure_ascii=False, indent=2)
-
-    # 2. Save Reference Images
-    if "ref_images" in session_state and session_state.ref_images:
-        ref_dir = os.path.join(session_dir, "ref_images")
-        os.makedirs(ref_dir, exist_ok=True)
-        for i, img in enumerate(session_state.ref_images):
-            try:
-                img.save(os.path.join(ref_dir, f"ref_{i}.png"))
-            except Exception as e:
-                print(f"Failed to save ref image {i}: {e}")
-
-    # 3. Save Final Image (if exists)
-    if final_image:
+
+def write_snapshot(snapshot):
+    """
+    Writes a snapshot. Images go to the content-addressed blob store (identical bytes are
+    stored once) and metadata.json references them by name. If the session already exists
+    the final image is appended to its revision chain instead of starting a new session.
+    Every file goes through temp file + rename, and metadata.json is written last so a
+    session only becomes visible once complete. The session lock keeps other threads and
+    worker processes from interleaving their read-modify-write of the same metadata.json.
+    """
+    history_dir = init_history(snapshot.get("history_dir") or HISTORY_DIR)
+    with metrics_utils.span("history_write") as rec, history_writer.session_lock(history_dir, snapshot["session_id"]):
+        rec["bytes_written"] = _write_snapshot(snapshot, history_dir)
+
+def _write_snapshot(snapshot, history_dir):
+    # Returns the number of image bytes actually written (deduplicated blobs cost nothing)
+    session_id = snapshot["session_id"]
+    session_dir = os.path.join(history_dir, session_id)
+    meta_path = os.path.join(session_dir, "metadata.json")
+    os.makedirs(session_dir, exist_ok=True)
+    failures = []
+    written = 0
+
+    # Existing project: keep its revision chain (old per-folder layouts are moved to blobs first)
+    previous = None
+    if os.path.exists(meta_path):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+        if "images" not in previous:
+            blob_store.migrate_session(history_dir, session_id)
+            with open(meta_path, "r", encoding="utf-8") as f:
+                previous = json.load(f)
+    revisions = _revisions_of(previous) if previous else []
+
+    # Format of every stored file; entries of earlier revisions are carried over
+    formats = dict(((previous or {}).get("images") or {}).get("formats") or {})
+
+    def store(img):
+        nonlocal written
+        if isinstance(img, FileImage):
+            # Restored from history: the blob is normally still there, so skip reading it
+            name = f"{img.digest}.{img.ext}"
+            if blob_store.touch_blob(history_dir, name):
+                formats.setdefault(name, image_utils.storage_format(img))
+                return name
+        if not isinstance(img, EncodedImage):
+            data, _ = _image_bytes(img)  # bare PIL image: PNG, which the codec may then convert
+            img = EncodedImage(data, "image/png")
+        img, label = image_utils.encode_for_storage(img, snapshot.get("codec"), snapshot.get("quality", image_utils.STORAGE_QUALITY))
+        name, created = blob_store.put_blob(history_dir, img.data, img.ext, img.digest)
+        if created:
+            written += len(img.data)
+        formats[name] = label
+        return name
+
+    images = {"ref_images": [], "final_output": None, "draft_output": None, "thumbnail": None}
+
+    # 1. Save Reference Images (normalized upload bytes are persisted as-is)
+    for i, img in enumerate(snapshot["ref_images"]):
         try:
-            final_image.save(os.path.join(session_dir, "final_output.png"))
+            images["ref_images"].append(store(img))
         except Exception as e:
-            print(f"Failed to save final image: {e}")
-            
-    return session_id
+            failures.append(f"ref image {i}: {e}")
 
-def load_session(session_id):
+    # 2. Save Final Image (if exists) - model bytes are written as-is, no re-encode
+    if snapshot["final_image"]:
+        try:
+            images["final_output"] = store(snapshot["final_image"])
+        except Exception as e:
+            failures.append(f"final image: {e}")
+
+    if snapshot.get("draft_image"):
+        try:
+            images["draft_output"] = store(snapshot["draft_image"])
+        except Exception as e:
+            failures.append(f"draft image: {e}")
+
+    # Small WebP preview for the history grid (of the new output, else the draft)
+    previous_thumb = ((previous or {}).get("images") or {}).get("thumbnail")
+    preview = snapshot["final_image"] or (None if previous_thumb else snapshot.get("draft_image"))
+    if preview is not None:
+        try:
+            images["thumbnail"] = blob_store.put_thumbnail(history_dir, preview)[0]
+            formats[images["thumbnail"]] = "webp"
+        except Exception as e:
+            failures.append(f"thumbnail: {e}")
+    else:
+        images["thumbnail"] = previous_thumb
+
+    # 3. Append the revision (only the delta: style, instruction and the new output)
+    if images["final_output"]:
+        revision = dict(snapshot.get("revision") or {}, final_output=images["final_output"], thumbnail=images["thumbnail"])
+        revision["rev"] = max([r["rev"] for r in revisions], default=0) + 1
+        parent_id = revision.pop("parent_id", None)
+        if parent_id:
+            revision["parent"] = next((r["rev"] for r in revisions if r.get("id") == parent_id), revision.get("parent"))
+        revisions.append(revision)
+    elif previous:
+        images["final_output"] = (previous.get("images") or {}).get("final_output")
+
+    # 4. Save Meta Data
+    created = (previous or {}).get("created") or (previous or {}).get("timestamp") or snapshot["meta"]["timestamp"]
+    meta = dict(snapshot["meta"], images=images, revisions=revisions, created=created)
+    referenced = set(history_index.blobs_from_meta(meta))
+    images["formats"] = {name: label for name, label in formats.items() if name in referenced}
+    if (previous or {}).get("pinned"):
+        meta["pinned"] = True
+    history_writer.atomic_write_json(meta_path, meta)
+
+    try:
+        if history_index.index_exists(history_dir):
+            history_index.upsert_session(history_dir, session_id, meta)
+        else:
+            # First save into an unindexed folder: index everything, not just this session
+            history_index.rebuild_index(history_dir)
+        history_index.touch_session(history_dir, session_id)
+    except Exception as e:
+        failures.append(f"index: {e}")
+
+    if failures:
+        raise RuntimeError(f"{session_id} saved with errors: " + "; ".join(failures))
+    return written
+
+def save_session(session_state, final_image=None, background=True, modification=None):
     """
-    Loads a session from history into st.session_state.
+    Saves the current session state and valid images to a history folder.
+    By default the write is queued on the background writer and this returns immediately.
+    Repeated saves of one project become revisions of the same session; session_state
+    keeps history_session_id / revisions / current_revision in step with what is written.
+    """
+    with metrics_utils.span("history_snapshot", session_state.get("trace")):
+        snapshot = snapshot_session(session_state, final_image, modification=modification)
+    session_state["history_session_id"] = snapshot["session_id"]
+    if final_image:
+        # Provisional number until sync_revisions reads the one the writer assigned
+        revisions = list(session_state.get("revisions") or [])
+        rev = max([r["rev"] for r in revisions], default=0) + 1
+        revisions.append(dict(snapshot["revision"], rev=rev))
+        session_state["revisions"] = revisions
+        session_state["current_revision"] = rev
+    if background:
+        history_writer.submit(write_snapshot, snapshot, label=snapshot["session_id"])
+    else:
+        write_snapshot(snapshot)
+        sync_revisions(session_state)
+    history_retention.schedule(snapshot["history_dir"])
+    return snapshot["session_id"]
+
+def read_session(session_id):
     """
-    session_dir = os.path.join(HISTORY_DIR, session_id)
+    Reads a saved session without touching st.session_state (also used headless by benchmark.py).
+    Returns {"meta", "ref_images", "final_image"} or None if the session does not exist.
+    Images are lazy FileImage handles; no image file is read here.
+    """
+    history_dir = current_dir()
+    session_dir = os.path.join(history_dir, session_id)
     if not os.path.exists(session_dir):
+        return None
+
+    # 1. Load Metadata
+    with open(os.path.join(session_dir, "metadata.json"), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+
+    # Sessions written by the blob store
+    images = meta.get("images")
+    if images is not None:
+        return {
+            "meta": meta,
+            "ref_images": [blob_store.read_blob(history_dir, name) for name in images.get("ref_images") or []],
+            "final_image": blob_store.read_blob(history_dir, images["final_output"]) if images.get("final_output") else None,
+        }
+
+    # 2. Load Reference Images (per-session layout from before the blob store)
+    ref_dir = os.path.join(session_dir, "ref_images")
+    ref_images = []
+    if os.path.exists(ref_dir):
+        files = sorted(os.listdir(ref_dir))
+        for file in files:
+            if file.startswith("ref_") and file.endswith((".png", ".jpg", ".webp")):
+                try:
+                    ref_images.append(FileImage(os.path.join(ref_dir, file)))
+                except: pass
+
+    # 3. Load Final Image (any of the pass-through formats)
+    final_image = None
+    for ext in ("png", "jpg", "webp"):
+        final_img_path = os.path.join(session_dir, f"final_output.{ext}")
+        if os.path.exists(final_img_path):
+            final_image = FileImage(final_img_path)
+            break
+
+    return {"meta": meta, "ref_images": ref_images, "final_image": final_image}
+
+def _current_revision(session_state):
+    current = session_state.get("current_revision")
+    return next((r for r in session_state.get("revisions") or [] if r["rev"] == current), None)
+
+def sync_revisions(session_state):
+    """
+    Replaces session_state's revision chain by the one in metadata.json, whose numbers the
+    writer assigned (and which includes saves from other tabs / workers and excludes failed
+    ones), keeping current_revision on the same output. Returns False while saves are still
+    queued or the session is not on disk yet; the provisional chain is kept then.
+    """
+    session_id = session_state.get("history_session_id")
+    if not session_id or history_writer.get_status()["pending"]:
         return False
-        
     try:
-        # 1. Load Metadata
-        with open(os.path.join(session_dir, "metadata.json"), "r", encoding="utf-8") as f:
+        with open(os.path.join(current_dir(), session_id, "metadata.json"), "r", encoding="utf-8") as f:
             meta = json.load(f)
-            
+    except (OSError, ValueError):
+        return False
+    revisions = _revisions_of(meta)
+    current = _current_revision(session_state)
+    match = None
+    if current is not None:
+        match = next((r for r in revisions if current.get("id") and r.get("id") == current["id"]), None)
+        if match is None and not current.get("id"):
+            match = next((r for r in revisions if r["rev"] == current["rev"]), None)
+    session_state["revisions"] = revisions
+    session_state["current_revision"] = (match or (revisions[-1] if revisions else {})).get("rev")
+    return True
+
+def load_revision(session_id, rev, revision_id=None):
+    """
+    Returns (final_image, revision) for one revision of a saved session, looked up by its
+    id when given (provisional numbers in session_state may differ from the written ones).
+    """
+    history_dir = current_dir()
+    with open(os.path.join(history_dir, session_id, "metadata.json"), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    for revision in _revisions_of(meta):
+        if (revision.get("id") == revision_id) if revision_id else (revision["rev"] == rev):
+            if revision.get("final_output"):
+                return blob_store.read_blob(history_dir, revision["final_output"]), revision
+            # Pre-blob session: its only revision is the folder's final image
+            return read_session(session_id)["final_image"], revision
+    raise KeyError(f"{session_id} has no revision {revision_id or rev}")
+
+def load_session(session_id):
+    """
+    Loads a session from history into st.session_state.
+    """
+    try:
+        with metrics_utils.span("history_load", st.session_state.get("trace")):
+            data = read_session(session_id)
+        if data is None:
+            return False
+        meta = data["meta"]
+
         st.session_state.phase = "design" # Jump to design/result view usually
         st.session_state.draft_data = meta.get("draft_data", {})
         st.session_state.final_prompt = meta.get("final_prompt", "")
         st.session_state.selected_style_key = meta.get("selected_style", "ビジネス・プロ (Business Pro)")
         st.session_state.is_ref_mandatory = meta.get("is_ref_mandatory", False)
         st.session_state.additional_inst = meta.get("additional_inst", "")
+        st.session_state.style_renders = {}
+        st.session_state.ref_images = data["ref_images"]
+        if data["final_image"] is not None:
+            st.session_state.final_image = data["final_image"]
+
+        # Restores drive LRU retention
+        try:
+            history_index.touch_session(current_dir(), session_id)
+        except Exception as e:
+            print(f"Failed to record access to {session_id}: {e}")
+
+        # Later saves continue this project's revision chain
+        st.session_state.history_session_id = session_id
+        st.session_state.revisions = _revisions_of(meta)
+        st.session_state.current_revision = st.session_state.revisions[-1]["rev"] if st.session_state.revisions else None
 
-        # 2. Load Reference Images
-        ref_dir = os.path.join(session_dir, "ref_images")
-        st.session_state.ref_images = []
-        if os.path.exists(ref_dir):
-            files = sorted(os.listdir(ref_dir))
-            for file in files:
-                if file.startswith("ref_") and (file.endswith(".png") or file.endswith(".jpg")):
-                    try:
-                        img = Image.open(os.path.join(ref_dir, file))
-                        st.session_state.ref_images.append(img)
-                    except: pass
-
-        # 3. Load Final Image
-        final_img_path = os.path.join(session_dir, "final_output.png")
-        if os.path.exists(final_img_path):
-            st.session_state.final_image = Image.open(final_img_path)
-            
         return True
     except Exception as e:
         st.error(f"Failed to load session: {e}")
         return False
 
-def get_history_list():
+def get_history_list(limit=None, offset=0):
     """
-    Returns list of saved sessions sorted by new.
+    Returns list of saved sessions sorted by new (served from the SQLite index).
     """
-    init_history()
-    sessions = []
-    for item in os.listdir(HISTORY_DIR):
-        full_path = os.path.join(HISTORY_DIR, item)
-        if os.path.isdir(full_path):
-            meta_path = os.path.join(full_path, "metadata.json")
-            if os.path.exists(meta_path):
-                try:
-                    with open(meta_path, "r", encoding="utf-8") as f:
-                        meta = json.load(f)
-                        sessions.append({
-                            "id": item,
-                            "timestamp": meta.get("timestamp", ""),
-                            "title": meta.get("input_text", "No Title"),
-                            "style": meta.get("selected_style", "")
-                        })
-                except: pass
-    
-    # Sort by timestamp desc
-    sessions.sort(key=lambda x: x["timestamp"], reverse=True)
-    return sessions
+    with metrics_utils.span("history_list"):
+        history_dir = init_history()
+        if not history_index.index_exists(history_dir):
+            # First run against an existing history folder: build the index once
+            history_index.rebuild_index(history_dir)
+        return history_index.query_sessions(history_dir, limit=limit, offset=offset)
+
+def search_history(query, limit=history_index.SEARCH_LIMIT):
+    """
+    Full-text search over titles, steps, style, archetype and instructions, best match first.
+    """
+    with metrics_utils.span("history_search"):
+        history_dir = init_history()
+        if not history_index.index_exists(history_dir) or not history_index.search_index_complete(history_dir):
+            # Index predates search (or does not exist yet): fill the search table once
+            history_index.rebuild_index(history_dir)
+        return history_index.search_sessions(history_dir, query, limit=limit)
+
+def read_thumbnail(name):
+    """
+    WebP bytes of a history thumbnail, or None if it is missing.
+    """
+    try:
+        with open(blob_store.blob_path(current_dir(), name), "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def request_thumbnails(items):
+    """
+    Queues a thumbnail backfill on the background writer for listed sessions saved
+    before thumbnails existed. Only the thumbnail is added: browsing never converts the
+    session layout (optimize_storage does). Each session is tried once per process.
+    """
+    history_dir = current_dir()
+    with _thumbnail_lock:
+        missing = [item["id"] for item in items if not item.get("thumbnail") and (history_dir, item["id"]) not in _thumbnail_requests]
+        _thumbnail_requests.update((history_dir, session_id) for session_id in missing)
+    for session_id in missing:
+        history_writer.submit(blob_store.backfill_thumbnail, history_dir, session_id, label=session_id)
+    return len(missing)
+
+def detach_images(session_state):
+    """
+    Replaces file-backed images in session_state by in-memory copies (before their files are deleted).
+    """
+    for key in ("final_image", "draft_image"):
+        img = session_state.get(key)
+        if isinstance(img, FileImage):
+            session_state[key] = img.materialize()
+    if session_state.get("ref_images"):
+        session_state["ref_images"] = [img.materialize() if isinstance(img, FileImage) else img for img in session_state["ref_images"]]
+
+def count_history():
+    history_dir = init_history()
+    if not history_index.index_exists(history_dir):
+        history_index.rebuild_index(history_dir)
+    return history_index.count_sessions(history_dir)
+
+def delete_session(session_id):
+    """
+    Removes a session folder and its index entry, then frees the blobs nothing else references.
+    Returns the number of blobs removed.
+    """
+    removed, _ = history_retention.delete_session(init_history(), session_id)
+    return removed
+
+def _write_pinned(history_dir, session_id, pinned):
+    meta_path = os.path.join(history_dir, session_id, "metadata.json")
+    with history_writer.session_lock(history_dir, session_id):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        meta["pinned"] = bool(pinned)
+        history_writer.atomic_write_json(meta_path, meta)
+        history_index.upsert_session(history_dir, session_id, meta)
+
+def set_pinned(session_id, pinned):
+    """
+    Pins (protects from retention) or unpins a session. Runs on the background writer so it
+    cannot race a save of the same session; waits briefly so the list shows the new state.
+    """
+    history_writer.submit(_write_pinned, current_dir(), session_id, pinned, label=session_id)
+    return history_writer.flush(5)
+
+def enforce_retention():
+    """
+    Runs retention under the deployment policy now (settings button).
+    Returns the result dict of history_retention.enforce.
+    """
+    history_dir = init_history()
+    flush_saves(10)
+    return history_retention.enforce(history_dir)
+
+def optimize_storage():
+    """
+    Migrates old per-session image files into the blob store and sweeps unreferenced blobs.
+    Returns (sessions_migrated, blobs_removed, bytes_freed).
+    """
+    history_dir = init_history()
+    migrated, _, _ = blob_store.migrate_history(history_dir)
+    removed, freed = blob_store.collect_garbage(history_dir)
+    return migrated, removed, freed
+
+def rebuild_history_index():
+    """
+    Reconciles the index with the session folders (use when they drift apart).
+    """
+    return history_index.rebuild_index(init_history())
+
+def get_save_status():
+    """
+    Pending count and recent failures of the background writer, for the UI.
+    """
+    return history_writer.get_status()
+
+def clear_save_errors():
+    history_writer.clear_errors()
+
+def flush_saves(timeout=None):
+    return history_writer.flush(timeout)
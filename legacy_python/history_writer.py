@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import queue
+import atexit
+import hashlib
+import tempfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: locks only cover threads of this process
+    fcntl = None
+
+FLUSH_TIMEOUT = 30.0  # Seconds to wait for pending saves at interpreter shutdown
+LOCK_DIR = ".locks"   # Lock files inside the history directory
+LOCK_STRIPES = 256    # Sessions share this many lock files, so the directory stays small
+
+_queue = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+_status_lock = threading.Lock()
+_status = {
+    "last_saved": None,
+    "errors": deque(maxlen=10),  # (timestamp, label, message)
+}
+_held = threading.local()   # Lock files this thread holds (file_lock is re-entrant)
+_thread_locks = {}          # path -> threading.Lock, used where fcntl is missing
+
+
+def atomic_write_bytes(path, data):
+    """
+    Writes to a temp file in the same directory and renames it over the target,
+    so readers never see a half-written file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_write_json(path, obj):
+    atomic_write_bytes(path, json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8"))
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Exclusive lock on path (created if missing) that serializes threads and processes,
+    including other app workers on the same host. Re-entrant within a thread.
+    """
+    held = _held.__dict__.setdefault("paths", set())
+    if path in held:
+        yield
+        return
+    if fcntl is None:
+        with _worker_lock:
+            lock = _thread_locks.setdefault(path, threading.Lock())
+        with lock:
+            held.add(path)
+            try:
+                yield
+            finally:
+                held.discard(path)
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        held.add(path)
+        yield
+    finally:
+        held.discard(path)
+        os.close(fd)  # Releases the lock
+
+
+def session_lock(history_dir, session_id):
+    """
+    Lock guarding the read-modify-write of one session's metadata.json.
+    """
+    stripe = int(hashlib.sha256(session_id.encode("utf-8")).hexdigest()[:8], 16) % LOCK_STRIPES
+    return file_lock(os.path.join(history_dir, LOCK_DIR, f"session_{stripe:03d}.lock"))
+
+
+def store_lock(history_dir, name):
+    """
+    Store-wide lock for maintenance jobs (retention runs) that must not overlap.
+    """
+    return file_lock(os.path.join(history_dir, LOCK_DIR, f"{name}.lock"))
+
+
+def _run():
+    while True:
+        fn, args, label = _queue.get()
+        try:
+            fn(*args)
+            with _status_lock:
+                _status["last_saved"] = label
+        except Exception as e:
+            print(f"Background save failed ({label}): {e}")
+            with _status_lock:
+                _status["errors"].append((time.time(), label, str(e)))
+        finally:
+            _queue.task_done()
+
+
+def _ensure_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name="history-writer", daemon=True)
+            _worker.start()
+
+
+def submit(fn, *args, label=""):
+    """
+    Queues fn(*args) for the persistence worker. Args must already be snapshots.
+    """
+    _ensure_worker()
+    _queue.put((fn, args, label))
+
+
+def flush(timeout=None):
+    """
+    Waits until every queued save has been written. Returns False on timeout.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    while _queue.unfinished_tasks:
+        if deadline is not None and time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def get_status():
+    with _status_lock:
+        return {
+            "pending": _queue.unfinished_tasks,
+            "last_saved": _status["last_saved"],
+            "errors": list(_status["errors"]),
+        }
+
+
+def clear_errors():
+    with _status_lock:
+        _status["errors"].clear()
+
+
+atexit.register(flush, FLUSH_TIMEOUT)
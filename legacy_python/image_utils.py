@@ -0,0 +1,311 @@
+import io
+import hashlib
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageOps
+
+MIME_EXTENSIONS = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/webp": "webp",
+    "image/gif": "gif",
+    "image/avif": "avif",
+}
+EXTENSION_MIMES = {"png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg", "webp": "image/webp", "gif": "image/gif", "avif": "image/avif"}
+MODEL_MIMES = ("image/png", "image/jpeg", "image/webp")  # Inline image types the model accepts as-is
+
+RENDITION_CACHE_SIZE = 16  # Encoded download renditions kept in memory (LRU)
+DOWNLOAD_FORMATS = (("PNG", 95), ("JPEG", 95))
+
+# Reference image normalization (Step 1 upload)
+REF_MAX_EDGE = 1536               # Longest edge after downscale (px)
+REF_MAX_PIXELS = 1536 * 1024      # Pixel budget on top of the edge limit (caps square-ish images below edge²)
+REF_QUALITY = 88                  # JPEG / WebP quality for normalized references
+
+# History thumbnails (written next to every saved output)
+THUMB_EDGE = 256                  # Longest edge (px)
+THUMB_QUALITY = 75                # WebP quality
+
+# History storage codecs: name -> (PIL format, MIME type, save options). "original" keeps the
+# bytes as received. Only lossless sources (PNG / GIF) are re-encoded; JPEG and WebP stay as-is.
+STORAGE_CODECS = {
+    "original": None,
+    "webp_lossless": ("WEBP", "image/webp", {"lossless": True, "quality": 80, "method": 4}),
+    "webp": ("WEBP", "image/webp", {"method": 4}),
+    "avif": ("AVIF", "image/avif", {}),
+}
+STORAGE_QUALITY = 85              # Quality of the lossy codecs
+LOSSLESS_MIMES = ("image/png", "image/gif")
+
+_renditions = OrderedDict()
+_renditions_lock = threading.Lock()
+
+
+def sniff_mime(data):
+    """
+    Guesses the MIME type from the file signature.
+    """
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[4:12] in (b"ftypavif", b"ftypavis"):
+        return "image/avif"
+    return "application/octet-stream"
+
+
+class EncodedImage:
+    """
+    An image kept in its original encoded form (bytes + MIME type).
+    The PIL image is decoded only when something actually needs pixels.
+    """
+    def __init__(self, data, mime_type=None):
+        self.data = bytes(data)
+        self.mime_type = mime_type or sniff_mime(self.data)
+        self._image = None
+        self._digest = None
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        ext = path.rsplit(".", 1)[-1].lower()
+        return cls(data, EXTENSION_MIMES.get(ext) or sniff_mime(data))
+
+    @property
+    def ext(self):
+        return MIME_EXTENSIONS.get(self.mime_type, "png")
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.data).hexdigest()
+        return self._digest
+
+    @property
+    def image(self):
+        if self._image is None:
+            img = Image.open(io.BytesIO(self.data))
+            img.load()
+            self._image = img
+        return self._image
+
+    def save(self, path_without_ext):
+        """
+        Writes the original bytes unchanged; returns the path with the matching extension.
+        """
+        path = f"{path_without_ext}.{self.ext}"
+        with open(path, "wb") as f:
+            f.write(self.data)
+        return path
+
+
+class FileImage(EncodedImage):
+    """
+    An EncodedImage backed by a file that is only read when the bytes are needed
+    (display, model request, download). Used for images restored from history, so
+    browsing and loading sessions does not pull full-resolution files into memory.
+    """
+    def __init__(self, path, mime_type=None, digest=None):
+        self.path = path
+        ext = path.rsplit(".", 1)[-1].lower()
+        self.mime_type = mime_type or EXTENSION_MIMES.get(ext) or "application/octet-stream"
+        self._image = None
+        self._digest = digest
+
+    @property
+    def data(self):
+        # Not kept on the object: the OS page cache makes repeated reads cheap
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def materialize(self):
+        """
+        In-memory copy, for when the backing file is about to be deleted.
+        """
+        return EncodedImage(self.data, self.mime_type)
+
+
+def make_thumbnail(img, max_edge=THUMB_EDGE, quality=THUMB_QUALITY):
+    """
+    Small WebP preview of an image for the history grid. Returns the encoded bytes.
+    """
+    if isinstance(img, EncodedImage):
+        pil_img = Image.open(io.BytesIO(img.data))
+        # JPEG can decode at reduced scale directly, which skips most of the work
+        pil_img.draft("RGB", (max_edge, max_edge))
+    else:
+        pil_img = img.copy()
+    pil_img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    if pil_img.mode not in ("RGB", "RGBA"):
+        pil_img = pil_img.convert("RGBA" if "transparency" in pil_img.info or pil_img.mode in ("LA", "PA") else "RGB")
+    buf = io.BytesIO()
+    pil_img.save(buf, format="WEBP", quality=quality)
+    return buf.getvalue()
+
+
+def prepare_reference_image(file, max_edge=REF_MAX_EDGE, max_pixels=REF_MAX_PIXELS, quality=REF_QUALITY):
+    """
+    One-time normalization of an uploaded reference image: EXIF orientation, downscale to
+    the edge / pixel budget, re-encode compactly (JPEG, or WebP when there is alpha).
+    The returned EncodedImage is what every later request and save_session reuse.
+    """
+    img = Image.open(file)
+    img = ImageOps.exif_transpose(img)
+
+    w, h = img.size
+    scale = min(1.0, max_edge / max(w, h), (max_pixels / float(w * h)) ** 0.5)
+    if scale < 1.0:
+        img = img.resize((max(1, int(w * scale)), max(1, int(h * scale))), Image.LANCZOS)
+
+    has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+    buf = io.BytesIO()
+    if has_alpha:
+        img.convert("RGBA").save(buf, format="WEBP", quality=quality)
+        mime_type = "image/webp"
+    else:
+        img.convert("RGB").save(buf, format="JPEG", quality=quality, optimize=True)
+        mime_type = "image/jpeg"
+    return EncodedImage(buf.getvalue(), mime_type)
+
+
+def codec_available(codec):
+    spec = STORAGE_CODECS.get(codec)
+    if spec is None:
+        return codec == "original"
+    Image.init()
+    return spec[0] in Image.SAVE
+
+
+def storage_format(img):
+    """
+    Format label recorded in metadata for stored bytes ("png", "jpg", "webp", "avif", ...).
+    """
+    return img.ext if isinstance(img, EncodedImage) else "png"
+
+
+def encode_for_storage(img, codec, quality=STORAGE_QUALITY):
+    """
+    Returns (EncodedImage, format_label) to write into the history store. Lossless sources
+    are converted to codec; everything else (and unavailable codecs) passes through.
+    """
+    spec = STORAGE_CODECS.get(codec)
+    if spec is None or not codec_available(codec) or img.mime_type not in LOSSLESS_MIMES:
+        return img, storage_format(img)
+    pil_format, mime_type, options = spec
+    pil_img = img.image
+    if pil_img.mode not in ("RGB", "RGBA"):
+        has_alpha = pil_img.mode in ("LA", "PA") or "transparency" in pil_img.info
+        pil_img = pil_img.convert("RGBA" if has_alpha else "RGB")
+    # For lossless WebP "quality" is compression effort, so the codec's own value wins
+    options = dict({"quality": quality}, **options)
+    buf = io.BytesIO()
+    pil_img.save(buf, format=pil_format, **options)
+    return EncodedImage(buf.getvalue(), mime_type), codec
+
+
+def to_model_part(part):
+    """
+    Prompt part as the SDK expects it: EncodedImage becomes an inline blob (no re-encode
+    unless it is stored in a type the model does not accept, e.g. AVIF, which becomes PNG).
+    """
+    if isinstance(part, EncodedImage):
+        if part.mime_type not in MODEL_MIMES:
+            buf = io.BytesIO()
+            part.image.save(buf, format="PNG")
+            return {"mime_type": "image/png", "data": buf.getvalue()}
+        return {"mime_type": part.mime_type, "data": part.data}
+    return part
+
+
+def to_pil(img):
+    """
+    Accepts an EncodedImage or a PIL image and returns the PIL image.
+    """
+    return img.image if isinstance(img, EncodedImage) else img
+
+
+def display_source(img):
+    """
+    What to hand to st.image: encoded bytes when available (no re-encode), else the PIL image.
+    """
+    return img.data if isinstance(img, EncodedImage) else img
+
+
+def encode_for_download(img, fmt, quality=95):
+    """
+    Returns (bytes, mime_type, ext) for the download button.
+    The stored bytes are served as-is when they are already in the requested format.
+    """
+    if fmt == "PNG":
+        mime_type, ext = "image/png", "png"
+    else:
+        mime_type, ext = "image/jpeg", "jpg"
+
+    if isinstance(img, EncodedImage) and img.mime_type == mime_type:
+        return img.data, mime_type, ext
+
+    pil_img = to_pil(img)
+    buf = io.BytesIO()
+    if fmt == "PNG":
+        pil_img.save(buf, format="PNG")
+    else:
+        if pil_img.mode in ("RGBA", "P", "LA"):
+            pil_img = pil_img.convert("RGB")
+        pil_img.save(buf, format="JPEG", quality=quality)
+    return buf.getvalue(), mime_type, ext
+
+
+def _image_key(img):
+    # Content digest for encoded images; pixel hash for bare PIL images (an id() could be
+    # reused by a different image once the original is garbage collected)
+    if isinstance(img, EncodedImage):
+        return img.digest
+    h = hashlib.sha256(f"{img.mode}:{img.size}".encode("utf-8"))
+    h.update(img.tobytes())
+    if img.mode == "P":
+        h.update(bytes(img.getpalette() or []))
+    return "pil:" + h.hexdigest()
+
+
+def get_download_bytes(img, fmt, quality=95):
+    """
+    Same result as encode_for_download, but each (image, format, quality) is encoded
+    at most once; reruns that did not change the image reuse the cached bytes.
+    """
+    target_mime = "image/png" if fmt == "PNG" else "image/jpeg"
+    if isinstance(img, EncodedImage) and img.mime_type == target_mime:
+        # Pass-through: nothing to encode or cache
+        return encode_for_download(img, fmt, quality)
+
+    key = (_image_key(img), fmt, quality)
+    with _renditions_lock:
+        if key in _renditions:
+            _renditions.move_to_end(key)
+            return _renditions[key]
+
+    result = encode_for_download(img, fmt, quality)
+    with _renditions_lock:
+        _renditions[key] = result
+        _renditions.move_to_end(key)
+        while len(_renditions) > RENDITION_CACHE_SIZE:
+            _renditions.popitem(last=False)
+    return result
+
+
+def precompute_renditions(img, formats=DOWNLOAD_FORMATS):
+    """
+    Encodes the download renditions in a background thread right after generation.
+    """
+    def work():
+        for fmt, quality in formats:
+            try:
+                get_download_bytes(img, fmt, quality)
+            except Exception as e:
+                print(f"Failed to precompute {fmt} rendition: {e}")
+
+    threading.Thread(target=work, daemon=True).start()
@@ -0,0 +1,176 @@
+import os
+import time
+import atexit
+import threading
+from collections import deque
+from contextlib import contextmanager
+import history_writer
+
+METRICS_FILE = os.path.join("metrics", "blueprint_metrics.prom")  # Prometheus text format (textfile collector)
+FLUSH_INTERVAL = 15.0   # Seconds between rewrites of METRICS_FILE
+WINDOW_SIZE = 200       # Recent durations kept per series for the quantiles
+MAX_TRACE_SPANS = 200   # Spans kept per session trace (oldest dropped)
+
+LABEL_KEYS = ("phase", "model", "status")
+COUNTER_ATTRS = ("request_bytes", "response_bytes", "bytes_written", "bytes_freed", "fallbacks", "cache_hit", "coalesced")
+QUANTILES = (0.5, 0.9, 0.99)
+
+_lock = threading.Lock()
+_series = {}   # (span name, labels) -> {"count", "sum", "recent": deque}
+_counters = {} # (attr, span name, labels) -> total
+_dirty = False
+_flusher = None
+
+
+class Trace:
+    """
+    Spans of one browser session or batch job. Safe to share with worker threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spans = deque(maxlen=MAX_TRACE_SPANS)
+
+    def add(self, rec):
+        with self._lock:
+            self._spans.append(rec)
+
+    def snapshot(self):
+        with self._lock:
+            return [dict(s) for s in self._spans]
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
+
+
+@contextmanager
+def span(name, trace=None, **attrs):
+    """
+    Times the block and records it. Yields the span dict so the block can add attributes
+    (model, payload sizes, ...). Exceptions are recorded as status "error" and re-raised.
+    """
+    rec = {"name": name, "start": round(time.time(), 3)}
+    rec.update(attrs)
+    t0 = time.perf_counter()
+    try:
+        yield rec
+        rec.setdefault("status", "ok")
+    except BaseException as e:
+        rec["status"] = "error"
+        rec["error"] = type(e).__name__
+        raise
+    finally:
+        rec["duration"] = round(time.perf_counter() - t0, 4)
+        record(rec, trace)
+
+
+def record(rec, trace=None):
+    global _dirty
+    if trace is not None:
+        trace.add(rec)
+    labels = tuple((k, str(rec[k])) for k in LABEL_KEYS if rec.get(k) not in (None, ""))
+    with _lock:
+        series = _series.get((rec["name"], labels))
+        if series is None:
+            series = {"count": 0, "sum": 0.0, "recent": deque(maxlen=WINDOW_SIZE)}
+            _series[(rec["name"], labels)] = series
+        series["count"] += 1
+        series["sum"] += rec["duration"]
+        series["recent"].append(rec["duration"])
+        for attr in COUNTER_ATTRS:
+            value = rec.get(attr)
+            if value:
+                key = (attr, rec["name"], labels)
+                _counters[key] = _counters.get(key, 0) + int(value)
+        _dirty = True
+    _ensure_flusher()
+
+
+def _quantile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def get_summary():
+    """
+    Per-series latency summary for the diagnostics panel, slowest p90 first.
+    """
+    rows = []
+    with _lock:
+        for (name, labels), series in _series.items():
+            recent = sorted(series["recent"])
+            row = {"span": name}
+            row.update(dict(labels))
+            row.update({
+                "count": series["count"],
+                "mean": round(series["sum"] / series["count"], 3),
+                "p50": round(_quantile(recent, 0.5), 3),
+                "p90": round(_quantile(recent, 0.9), 3),
+            })
+            rows.append(row)
+    return sorted(rows, key=lambda r: r["p90"], reverse=True)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_str(pairs):
+    return ",".join(f'{k}="{_escape(v)}"' for k, v in pairs)
+
+
+def render_prometheus():
+    lines = [
+        "# HELP blueprint_span_duration_seconds Duration of instrumented spans (quantiles over the recent window)",
+        "# TYPE blueprint_span_duration_seconds summary",
+    ]
+    with _lock:
+        for (name, labels), series in sorted(_series.items()):
+            base = (("span", name),) + labels
+            recent = sorted(series["recent"])
+            for q in QUANTILES:
+                lines.append(f"blueprint_span_duration_seconds{{{_label_str(base + (('quantile', q),))}}} {_quantile(recent, q):.4f}")
+            lines.append(f"blueprint_span_duration_seconds_sum{{{_label_str(base)}}} {series['sum']:.4f}")
+            lines.append(f"blueprint_span_duration_seconds_count{{{_label_str(base)}}} {series['count']}")
+        for attr in COUNTER_ATTRS:
+            rows = [(k, v) for k, v in sorted(_counters.items()) if k[0] == attr]
+            if not rows:
+                continue
+            lines.append(f"# TYPE blueprint_{attr}_total counter")
+            for (_, name, labels), value in rows:
+                lines.append(f"blueprint_{attr}_total{{{_label_str((('span', name),) + labels)}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def flush_metrics():
+    """
+    Rewrites METRICS_FILE if anything was recorded since the last write.
+    """
+    global _dirty
+    with _lock:
+        if not _dirty:
+            return
+        _dirty = False
+    try:
+        os.makedirs(os.path.dirname(METRICS_FILE) or ".", exist_ok=True)
+        history_writer.atomic_write_bytes(METRICS_FILE, render_prometheus().encode("utf-8"))
+    except Exception as e:
+        print(f"Failed to write metrics: {e}")
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush_metrics()
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+    with _lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, name="metrics-flusher", daemon=True)
+            _flusher.start()
+
+
+atexit.register(flush_metrics)
@@ -0,0 +1,150 @@
+import time
+import threading
+from collections import deque
+
+# Rolling statistics window per model
+WINDOW_SIZE = 20            # Most recent calls kept per model
+MIN_SAMPLES = 3             # Calls needed before latency percentiles are trusted
+
+# Circuit breaker
+FAILURE_RATE_THRESHOLD = 0.5  # Open when at least this share of the window failed...
+MIN_CALLS_TO_TRIP = 4         # ...and the window has at least this many calls
+CONSECUTIVE_FAILURES_TO_TRIP = 3
+OPEN_COOLDOWN = 30.0          # Seconds before an open circuit lets one trial call through
+
+# Hedging
+HEDGE_PERCENTILE = 0.9        # Start the next model once the primary exceeds this latency percentile
+HEDGE_MIN_DELAY = 3.0
+HEDGE_DEFAULT_DELAY = 30.0    # Used until enough samples exist
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_lock = threading.Lock()
+_stats = {}
+
+
+class ModelStats:
+    def __init__(self):
+        self.calls = deque(maxlen=WINDOW_SIZE)  # (timestamp, ok, latency)
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+
+    def latencies(self):
+        return sorted(lat for _, ok, lat in self.calls if ok)
+
+    def error_rate(self):
+        if not self.calls:
+            return 0.0
+        return sum(1 for _, ok, _ in self.calls if not ok) / len(self.calls)
+
+
+def _get(model_name):
+    if model_name not in _stats:
+        _stats[model_name] = ModelStats()
+    return _stats[model_name]
+
+
+def _refresh_state(stats):
+    if stats.state == OPEN and time.time() - stats.opened_at >= OPEN_COOLDOWN:
+        stats.state = HALF_OPEN
+        stats.trial_in_flight = False
+
+
+def record_success(model_name, latency):
+    with _lock:
+        stats = _get(model_name)
+        stats.calls.append((time.time(), True, latency))
+        stats.consecutive_failures = 0
+        stats.state = CLOSED
+        stats.trial_in_flight = False
+
+
+def release_trial(model_name):
+    """
+    Hands back a half-open trial admitted for an attempt that never called the model
+    (cancelled or timed out in the request queue), so the next call can take it.
+    """
+    with _lock:
+        _get(model_name).trial_in_flight = False
+
+
+def record_failure(model_name, latency):
+    with _lock:
+        stats = _get(model_name)
+        stats.calls.append((time.time(), False, latency))
+        stats.consecutive_failures += 1
+        stats.trial_in_flight = False
+
+        tripped = stats.consecutive_failures >= CONSECUTIVE_FAILURES_TO_TRIP or (
+            len(stats.calls) >= MIN_CALLS_TO_TRIP and stats.error_rate() >= FAILURE_RATE_THRESHOLD
+        )
+        if stats.state == HALF_OPEN or tripped:
+            stats.state = OPEN
+            stats.opened_at = time.time()
+
+
+def allow_request(model_name):
+    """
+    Whether a call to this model may go out now. A half-open circuit admits a single trial call.
+    """
+    with _lock:
+        stats = _get(model_name)
+        _refresh_state(stats)
+        if stats.state == CLOSED:
+            return True
+        if stats.state == HALF_OPEN and not stats.trial_in_flight:
+            stats.trial_in_flight = True
+            return True
+        return False
+
+
+def order_models(model_names):
+    """
+    Reorders the fallback chain: healthy models keep the user's order, half-open ones
+    follow, open circuits go last (still tried if nothing else is left).
+    """
+    rank = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+    with _lock:
+        states = {}
+        for name in model_names:
+            stats = _get(name)
+            _refresh_state(stats)
+            states[name] = stats.state
+    indexed = list(enumerate(model_names))
+    indexed.sort(key=lambda item: (rank[states[item[1]]], item[0]))
+    return [name for _, name in indexed]
+
+
+def hedge_delay(model_name):
+    """
+    Seconds to wait on this model before hedging with the next one.
+    """
+    with _lock:
+        lat = _get(model_name).latencies()
+    if len(lat) < MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    idx = min(len(lat) - 1, int(round(HEDGE_PERCENTILE * (len(lat) - 1))))
+    return max(HEDGE_MIN_DELAY, lat[idx])
+
+
+def get_health_snapshot():
+    """
+    Returns per-model state, error rate and median latency for display.
+    """
+    snapshot = []
+    with _lock:
+        for name, stats in _stats.items():
+            _refresh_state(stats)
+            lat = stats.latencies()
+            snapshot.append({
+                "model": name,
+                "state": stats.state,
+                "calls": len(stats.calls),
+                "error_rate": round(stats.error_rate(), 2),
+                "p50_latency": round(lat[len(lat) // 2], 2) if lat else None,
+            })
+    return snapshot
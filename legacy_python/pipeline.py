@@ -0,0 +1,283 @@
+import json
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import call_scheduler
+from generation_utils import QUEUE_POLL, generate_with_fallback, stream_with_fallback, parse_image_response
+from struct_stream import StructStreamParser, MalformedStreamError
+from struct_patch import apply_patch, validate_structure, PatchError
+
+# --- Constants ---
+STYLE_PROMPTS = {
+    "ビジネス・プロ (Business Pro)": "Style: Professional Corporate Vector Art. Features: Clean lines, trustworthy blue and grey color palette, sans-serif typography. Vibe: Reliable, efficient.",
+    "テック・フューチャー (Tech Future)": "Style: Futuristic Cyberpunk. Features: Neon glowing lines (cyan/magenta), dark grid background, holographic effects. Vibe: High-tech, data-driven.",
+    "フラット・モダン (Flat Modern)": "Style: Vibrant Flat Design. Features: Bright and bold colors, high contrast, simple geometric shapes, flat shading. Vibe: Energetic, infographic style.",
+    "ホワイトボード (Whiteboard Sketch)": "Style: Whiteboard Marker Sketch. Features: Organic shaky lines, handwritten fonts, white background, casual marker strokes. Vibe: Friendly, brainstorming.",
+    "ミニマル・ライン (Minimal Line)": "Style: Sophisticated Line Art. Features: Ultra-thin lines, generous whitespace, monochrome or limited pastel palette. Vibe: Elegant, modern.",
+    "3Dアイソメトリック (3D Isometric)": "Style: 3D Isometric Render. Features: Orthographic projection, soft lighting, floating elements. Vibe: Tech startup, playful but structural.",
+    "コミック・ストーリー (Comic Style)": "Style: Japanese Black & White Manga. Features: Ink lines, screentones, speed lines, comic bubbles. Vibe: Impactful, storytelling.",
+    "クレイ・3D (Clay 3D)": "Style: 3D Claymorphism. Features: Soft rounded shapes, plastic/clay texture, warm lighting. Vibe: Warm, tactile, playful.",
+    "ピクセル・レトロ (Pixel Retro)": "Style: 8-bit Pixel Art. Features: Low resolution pixels, limited color palette. Vibe: Nostalgic, digital retro.",
+    "アーティスティック (Watercolor)": "Style: Watercolor Illustration. Features: Soft color bleeding, textured paper background. Vibe: Organic, artistic."
+}
+
+ARCHETYPES = [
+    "AIにおまかせ (自動最適化)",
+    "プロセスフロー (手順・流れ)",
+    "比較・対比 (A vs B)",
+    "構造・解剖図 (構成要素)",
+    "タイムライン (時系列)",
+    "サイクル図 (循環)",
+    "マインドマップ (放射状)",
+    "ピラミッド階層 (構造)"
+]
+
+DEFAULT_STYLE = "ビジネス・プロ (Business Pro)"
+
+SPECULATIVE_WORKERS = 2  # Background draft renders shared by all sessions of this process
+
+_speculative_pool = ThreadPoolExecutor(max_workers=SPECULATIVE_WORKERS, thread_name_prefix="speculative-draft")
+
+
+# --- Prompt Builders ---
+
+def build_struct_content(input_text, archetype, additional_inst="", ref_images=None, is_ref_mandatory=False):
+    """
+    Step 1 prompt: asks the text model for the structure JSON.
+    """
+    base_prompt_text = f"""
+    あなたは優秀な情報デザイナーです。以下のテキストを可視化・図解するための構成案を作成し、
+    **JSON形式のみ** で出力してください。
+
+    【テキスト】
+    {input_text}
+
+    【指定構造】
+    {archetype}
+
+    【追加指示】
+    {additional_inst}
+    """
+
+    if ref_images:
+        base_prompt_text += "\n\n【参考画像】\n添付された画像を参考に、その雰囲気や構造要素を取り入れてください。"
+        is_madatory_str = "必須" if is_ref_mandatory else "任意"
+        base_prompt_text += f"\n(画像の要素反映は「{is_madatory_str}」です)"
+
+    base_prompt_text += f"""
+
+    【出力JSON】
+    {{
+        "main_title": "タイトル",
+        "summary": "要約(1文)",
+        "recommended_style": "デザイン指示",
+        "archetype_name": "{archetype}",
+        "steps": [
+            {{ "label": "見出し", "visual_desc": "絵の指示" }}
+        ]
+    }}
+    """
+
+    # Prepare Content
+    content = [base_prompt_text]
+    if ref_images:
+        content.extend(ref_images)
+    return content
+
+
+def parse_struct_response(text):
+    cleaned = text.replace("```json", "").replace("```", "").strip()
+    return json.loads(cleaned)
+
+
+def build_retake_content(draft_data, instruction):
+    """
+    Full regeneration prompt for the Step 2 retake (the model returns the whole JSON).
+    """
+    return f"修正指示: {instruction}\n現在のJSON: {json.dumps(draft_data, ensure_ascii=False)}"
+
+
+def build_retake_patch_content(draft_data, instruction):
+    """
+    Retake prompt that asks only for the changes, as JSON Patch operations.
+    """
+    return f"""修正指示: {instruction}
+現在のJSON: {json.dumps(draft_data, ensure_ascii=False)}
+
+上記JSONを修正指示どおりに変更するための JSON Patch (RFC 6902) の配列 **のみ** を出力してください。
+使用できる op は add / remove / replace / move / copy です。
+path の例: "/main_title", "/summary", "/steps/0/label", "/steps/2", "/steps/-" (末尾に追加)。
+変更のない項目は含めないでください。
+
+【出力例】
+[{{"op": "replace", "path": "/steps/0/label", "value": "新しい見出し"}}]
+"""
+
+
+def parse_patch_response(text):
+    cleaned = text.replace("```json", "").replace("```", "").strip()
+    ops = json.loads(cleaned)
+    if isinstance(ops, dict) and isinstance(ops.get("patch"), list):
+        ops = ops["patch"]
+    return ops
+
+
+def build_final_prompt(draft_data):
+    """
+    Step 2 -> 3: flattens the (edited) structure into the image prompt.
+    """
+    steps = draft_data.get("steps", [])
+    steps_str = "\n".join([f"{i+1}. {s['label']}: {s['visual_desc']}" for i, s in enumerate(steps)])
+    return f"Title: {draft_data.get('main_title', '')}\nSummary: {draft_data.get('summary', '')}\nStyle: {draft_data.get('recommended_style')}\nStructure: {draft_data.get('archetype_name')}\nSteps:\n{steps_str}\nTarget Language: Japanese."
+
+
+def build_draft_content(final_prompt, ref_images=None, is_ref_mandatory=False, layout_feedback=""):
+    fb = f" Fix layout: {layout_feedback}" if layout_feedback else ""
+    override = " [DRAFT MODE] Simple Black & White sketch wireframe."
+
+    # Construct Content with Images
+    prompt_content = [final_prompt + fb + override]
+    if ref_images:
+        prompt_content.extend(ref_images)
+        if is_ref_mandatory:
+            prompt_content[0] += "\n\nIMPORTANT: You MUST include the character/style from the attached reference images in this draft sketch."
+    return prompt_content
+
+
+def build_final_content(final_prompt, style_key, ref_images=None, is_ref_mandatory=False, modification=None):
+    """
+    Builds the final render prompt (text + reference images) for a style.
+    """
+    style_instr = STYLE_PROMPTS[style_key]
+    prompt_text = f"{final_prompt}\n[FINAL STYLE] {style_instr}"
+    if modification:
+        prompt_text += f"\n[MODIFICATION] {modification}"
+    prompt_text += "\nHigh Quality Render."
+
+    # Construct Content with Images
+    prompt_content = [prompt_text]
+    if ref_images:
+        prompt_content.extend(ref_images)
+        # Add emphasis if mandatory
+        if is_ref_mandatory:
+            prompt_content[0] += "\n\nCRITICAL: The character/object from the reference images MUST appear in the final output as the main subject."
+    return prompt_content
+
+
+# --- Phases ---
+# Extra keyword arguments (use_cache, hedge, ...) are passed through to generate_with_fallback.
+
+def run_structure(model_names, input_text, archetype, additional_inst="", ref_images=None, is_ref_mandatory=False, **gen_options):
+    content = build_struct_content(input_text, archetype, additional_inst, ref_images, is_ref_mandatory)
+    res, used = generate_with_fallback(model_names, content, phase="struct", **gen_options)
+    return parse_struct_response(res.text), used
+
+
+def run_structure_stream(model_names, input_text, archetype, additional_inst="", ref_images=None, is_ref_mandatory=False, on_event=None, **gen_options):
+    """
+    Streams Step 1: on_event(event) is called with StructStreamParser events
+    ("field" / "step") as they complete, plus ("restart", model_name) before each attempt.
+    Malformed output aborts that model early and moves on to the next one.
+    """
+    content = build_struct_content(input_text, archetype, additional_inst, ref_images, is_ref_mandatory)
+    parsers = []
+
+    def new_consumer(model_name):
+        parser = StructStreamParser()
+        parsers.append(parser)
+        if on_event:
+            on_event(("restart", model_name))
+
+        def consume(text):
+            for event in parser.feed(text):
+                if on_event:
+                    on_event(event)
+        return consume
+
+    res, used = stream_with_fallback(model_names, content, new_consumer, phase="struct", **gen_options)
+    try:
+        return parsers[-1].result(), used
+    except MalformedStreamError:
+        return parse_struct_response(res.text), used
+
+
+def run_retake(model_names, draft_data, instruction, **gen_options):
+    """
+    Step 2 retake. Asks for a compact patch first and applies it locally; only if the
+    patch is unusable does it fall back to regenerating the whole structure.
+    Returns (new_draft_data, model_name, mode) with mode "patch" or "full".
+    """
+    try:
+        res, used = generate_with_fallback(model_names, build_retake_patch_content(draft_data, instruction), phase="retake", **gen_options)
+        patched = validate_structure(apply_patch(draft_data, parse_patch_response(res.text)))
+        return patched, used, "patch"
+    except (PatchError, ValueError) as e:
+        print(f"Retake patch unusable, regenerating full structure: {e}")
+
+    res, used = generate_with_fallback(model_names, build_retake_content(draft_data, instruction), phase="retake", **gen_options)
+    return parse_struct_response(res.text), used, "full"
+
+
+def run_draft(model_names, final_prompt, ref_images=None, is_ref_mandatory=False, layout_feedback="", **gen_options):
+    content = build_draft_content(final_prompt, ref_images, is_ref_mandatory, layout_feedback)
+    res, used = generate_with_fallback(model_names, content, phase="draft", **gen_options)
+    return parse_image_response(res), used
+
+
+def run_final(model_names, final_prompt, style_key, ref_images=None, is_ref_mandatory=False, modification=None, **gen_options):
+    content = build_final_content(final_prompt, style_key, ref_images, is_ref_mandatory, modification)
+    res, used = generate_with_fallback(model_names, content, phase="refine" if modification else "final", **gen_options)
+    return parse_image_response(res), used
+
+
+def start_speculative_draft(model_names, draft_data, ref_images=None, is_ref_mandatory=False, layout_feedback="", **gen_options):
+    """
+    Starts the draft render for an unedited structure in the background.
+    Returns a job dict; the draft phase uses its future only if the prompt still matches.
+    """
+    final_prompt = build_final_prompt(draft_data)
+    owner = object()  # Its scheduler tickets, for adopt_speculative_draft
+    future = _speculative_pool.submit(
+        run_draft, list(model_names), final_prompt, ref_images, is_ref_mandatory, layout_feedback, owner=owner, **gen_options)
+    return {"final_prompt": final_prompt, "layout_feedback": layout_feedback, "future": future, "owner": owner}
+
+
+def adopt_speculative_draft(job, on_queue=None):
+    """
+    Waits for a speculative draft the user now needs: its queued calls (and any fallback it
+    still makes) move up to draft priority, and on_queue(position) reports its place in line
+    like generate_with_fallback does. Returns (image, model_name) or raises the job's error.
+    """
+    if not job["future"].done():
+        call_scheduler.promote(job["owner"], call_scheduler.priority_for("draft"))
+    last_pos = None
+    try:
+        while True:
+            try:
+                return job["future"].result(timeout=QUEUE_POLL)
+            except TimeoutError:
+                pass
+            if on_queue:
+                pos = call_scheduler.queue_position(job["owner"])
+                if pos != last_pos:
+                    last_pos = pos
+                    on_queue(pos)
+    finally:
+        if job["future"].done():
+            # Drops the promotion in case the job finished between the check above and promote
+            call_scheduler.cancel(job["owner"])
+        if on_queue and last_pos is not None:
+            on_queue(None)
+
+
+def speculative_matches(job, final_prompt, layout_feedback=""):
+    return bool(job) and job["final_prompt"] == final_prompt and job["layout_feedback"] == (layout_feedback or "")
+
+
+def discard_speculative_draft(job):
+    """
+    Cancels the job: not started, it never runs; running, its calls still waiting in the
+    scheduler are withdrawn and no fallback is tried. A call already sent is left to finish
+    and ignored.
+    """
+    if job:
+        job["future"].cancel()
+        call_scheduler.cancel(job["owner"])
@@ -0,0 +1,62 @@
+import threading
+
+RETRIES = 1  # Times a waiter re-runs the request (coalesced again) after the shared call failed
+
+_lock = threading.Lock()
+_inflight = {}  # key -> _Call
+_stats = {"calls": 0, "shared": 0, "retried": 0}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+def run(key, fn):
+    """
+    Runs fn() unless a call with the same key is already in flight in this process; then
+    waits for that call and shares its result. Returns (result, shared).
+
+    Failures are not shared: they may belong to the caller that ran the call (its API key,
+    a stopped script), so each waiter runs the request itself, coalescing with the other
+    waiters again. After RETRIES such rounds the last error is raised.
+    """
+    for _ in range(RETRIES + 1):
+        with _lock:
+            call = _inflight.get(key)
+            leader = call is None
+            if leader:
+                call = _inflight[key] = _Call()
+                _stats["calls"] += 1
+            else:
+                call.waiters += 1
+        if leader:
+            try:
+                call.result = fn()
+                return call.result, False
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with _lock:
+                    del _inflight[key]
+                call.done.set()
+        call.done.wait()
+        with _lock:
+            if call.error is None:
+                _stats["shared"] += 1
+                return call.result, True
+            _stats["retried"] += 1
+    raise call.error
+
+
+def get_stats():
+    """
+    Counters since start: calls actually run, results shared (= upstream calls saved),
+    waiters that had to retry, and calls / waiters in flight right now.
+    """
+    with _lock:
+        return dict(_stats, in_flight=len(_inflight), waiting=sum(c.waiters for c in _inflight.values()))
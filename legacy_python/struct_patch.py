@@ -0,0 +1,142 @@
+import copy
+
+
+class PatchError(ValueError):
+    """
+    The patch is malformed or does not apply to the current structure.
+    """
+
+
+def _parse_pointer(path):
+    if path == "":
+        return []
+    if not isinstance(path, str) or not path.startswith("/"):
+        raise PatchError(f"Invalid path: {path!r}")
+    return [token.replace("~1", "/").replace("~0", "~") for token in path[1:].split("/")]
+
+
+def _index(container, token, allow_end=False):
+    if token == "-" and allow_end:
+        return len(container)
+    if not token.isdigit():
+        raise PatchError(f"Invalid array index: {token!r}")
+    idx = int(token)
+    limit = len(container) + (1 if allow_end else 0)
+    if idx >= limit:
+        raise PatchError(f"Array index out of range: {idx}")
+    return idx
+
+
+def _parent(doc, tokens):
+    target = doc
+    for token in tokens[:-1]:
+        if isinstance(target, list):
+            target = target[_index(target, token)]
+        elif isinstance(target, dict):
+            if token not in target:
+                raise PatchError(f"Path not found: {token!r}")
+            target = target[token]
+        else:
+            raise PatchError(f"Cannot descend into {type(target).__name__}")
+    return target
+
+
+def _get(doc, tokens):
+    if not tokens:
+        return doc
+    parent = _parent(doc, tokens)
+    last = tokens[-1]
+    if isinstance(parent, list):
+        return parent[_index(parent, last)]
+    if isinstance(parent, dict) and last in parent:
+        return parent[last]
+    raise PatchError(f"Path not found: {last!r}")
+
+
+def _add(doc, tokens, value):
+    parent = _parent(doc, tokens)
+    last = tokens[-1]
+    if isinstance(parent, list):
+        parent.insert(_index(parent, last, allow_end=True), value)
+    elif isinstance(parent, dict):
+        parent[last] = value
+    else:
+        raise PatchError("Add target is not a container")
+
+
+def _remove(doc, tokens):
+    parent = _parent(doc, tokens)
+    last = tokens[-1]
+    if isinstance(parent, list):
+        return parent.pop(_index(parent, last))
+    if isinstance(parent, dict) and last in parent:
+        return parent.pop(last)
+    raise PatchError(f"Path not found: {last!r}")
+
+
+def _replace(doc, tokens, value):
+    # In place, so dict key order and list positions are kept
+    parent = _parent(doc, tokens)
+    last = tokens[-1]
+    if isinstance(parent, list):
+        parent[_index(parent, last)] = value
+    elif isinstance(parent, dict) and last in parent:
+        parent[last] = value
+    else:
+        raise PatchError(f"Path not found: {last!r}")
+
+
+def apply_patch(doc, ops):
+    """
+    Applies JSON Patch (RFC 6902) operations to a copy of doc and returns the copy.
+    Supports add / remove / replace / move / copy / test. The whole document may not be replaced.
+    """
+    if not isinstance(ops, list):
+        raise PatchError("Patch must be a list of operations")
+    result = copy.deepcopy(doc)
+    for op in ops:
+        if not isinstance(op, dict) or "op" not in op or "path" not in op:
+            raise PatchError(f"Invalid operation: {op!r}")
+        tokens = _parse_pointer(op["path"])
+        if not tokens:
+            raise PatchError("Operations on the document root are not allowed")
+        kind = op["op"]
+        if kind in ("add", "replace", "test") and "value" not in op:
+            raise PatchError(f"'{kind}' needs a value")
+
+        if kind == "add":
+            _add(result, tokens, copy.deepcopy(op["value"]))
+        elif kind == "remove":
+            _remove(result, tokens)
+        elif kind == "replace":
+            _replace(result, tokens, copy.deepcopy(op["value"]))
+        elif kind in ("move", "copy"):
+            from_tokens = _parse_pointer(op.get("from", ""))
+            if not from_tokens:
+                raise PatchError(f"'{kind}' needs a from path")
+            value = _remove(result, from_tokens) if kind == "move" else copy.deepcopy(_get(result, from_tokens))
+            _add(result, tokens, value)
+        elif kind == "test":
+            if _get(result, tokens) != op["value"]:
+                raise PatchError(f"Test failed at {op['path']}")
+        else:
+            raise PatchError(f"Unknown op: {kind!r}")
+    return result
+
+
+def validate_structure(data):
+    """
+    Checks that a patched structure still has the shape the Step 2 form expects.
+    """
+    if not isinstance(data, dict):
+        raise PatchError("Structure must be an object")
+    for key in ("main_title", "summary"):
+        if key in data and not isinstance(data[key], str):
+            raise PatchError(f"{key} must be a string")
+    steps = data.get("steps", [])
+    if not isinstance(steps, list):
+        raise PatchError("steps must be a list")
+    for i, step in enumerate(steps):
+        if not isinstance(step, dict) or not isinstance(step.get("label"), str) or not isinstance(step.get("visual_desc"), str):
+            raise PatchError(f"steps[{i}] needs string label and visual_desc")
+    return data
@@ -0,0 +1,175 @@
+import json
+
+WHITESPACE = " \t\r\n"
+PRIMITIVE_CHARS = set("0123456789+-.eEtruefalsn")
+MAX_PREAMBLE = 32  # Characters tolerated before the opening '{' (code fence, "json" tag)
+
+
+class MalformedStreamError(ValueError):
+    """
+    Raised as soon as the streamed text can no longer become the structure JSON.
+    """
+
+
+class StructStreamParser:
+    """
+    Incremental parser for the Step 1 structure JSON.
+
+    feed() takes text chunks as they arrive and returns the events completed by that chunk:
+        ("field", key, value)   a top-level member such as main_title or summary
+        ("step", index, step)   one entry of the "steps" array
+    Markdown code fences around the object are tolerated, anything else is reported early.
+    """
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.started = False
+        self.finished = False
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.string_start = 0
+        self.expect = None          # What comes next at depth 1: key / colon / value / comma (nested, primitive while inside one)
+        self.key = None
+        self.value_start = None
+        self.primitive = False
+        self.step_start = None
+        self.step_index = 0
+
+    def feed(self, text):
+        self.buffer += text
+        events = []
+        while self.pos < len(self.buffer) and not self.finished:
+            self._step(self.buffer[self.pos], events)
+            self.pos += 1
+        return events
+
+    def result(self):
+        """
+        The complete structure; only valid once the stream has ended.
+        """
+        if not self.finished:
+            raise MalformedStreamError("Stream ended before the JSON object was closed.")
+        start = self.buffer.index("{")
+        return json.loads(self.buffer[start:self.pos])
+
+    # --- internals ---
+
+    def _fail(self, msg):
+        raise MalformedStreamError(f"{msg} (at char {self.pos})")
+
+    def _step(self, ch, events):
+        if not self.started:
+            if ch == "{":
+                self.started = True
+                self.stack.append("{")
+                self.expect = "key"
+            elif self.pos >= MAX_PREAMBLE or ch not in WHITESPACE + "`json":
+                self._fail("Response does not start with a JSON object")
+            return
+
+        if self.in_string:
+            if self.escape:
+                self.escape = False
+            elif ch == "\\":
+                self.escape = True
+            elif ch == '"':
+                self.in_string = False
+                self._string_closed(events)
+            return
+
+        depth = len(self.stack)
+
+        # A bare primitive (number / true / false / null) ends at the next delimiter
+        if self.primitive:
+            if ch in PRIMITIVE_CHARS:
+                return
+            self.primitive = False
+            self._emit_field(self.buffer[self.value_start:self.pos].strip(), events)
+
+        if ch in WHITESPACE:
+            return
+
+        if ch == '"':
+            self.in_string = True
+            self.string_start = self.pos
+            if depth == 1:
+                if self.expect == "key":
+                    return
+                if self.expect == "value":
+                    self.value_start = self.pos
+                    return
+                self._fail("Unexpected string")
+            return
+
+        if ch in "{[":
+            if depth == 1:
+                if self.expect != "value":
+                    self._fail(f"Unexpected '{ch}'")
+                self.value_start = self.pos
+                self.expect = "nested"
+            if ch == "{" and self.key == "steps" and self.stack == ["{", "["]:
+                self.step_start = self.pos
+            self.stack.append(ch)
+            return
+
+        if ch in "}]":
+            opener = "{" if ch == "}" else "["
+            if not self.stack or self.stack[-1] != opener:
+                self._fail(f"Mismatched '{ch}'")
+            self.stack.pop()
+            if not self.stack:
+                if self.expect not in ("comma", "key"):
+                    self._fail("Object closed while a value was expected")
+                self.finished = True
+                return
+            if ch == "}" and self.step_start is not None and self.stack == ["{", "["]:
+                step = self._loads(self.buffer[self.step_start:self.pos + 1])
+                events.append(("step", self.step_index, step))
+                self.step_index += 1
+                self.step_start = None
+            if len(self.stack) == 1:
+                self._emit_field(self.buffer[self.value_start:self.pos + 1], events)
+            return
+
+        if depth == 1:
+            if ch == ":":
+                if self.expect != "colon":
+                    self._fail("Unexpected ':'")
+                self.expect = "value"
+                return
+            if ch == ",":
+                if self.expect != "comma":
+                    self._fail("Unexpected ','")
+                self.expect = "key"
+                return
+            if self.expect == "value" and ch in PRIMITIVE_CHARS:
+                self.value_start = self.pos
+                self.primitive = True
+                self.expect = "primitive"
+                return
+            self._fail(f"Unexpected character {ch!r}")
+
+        if ch not in ",:" and ch not in PRIMITIVE_CHARS:
+            self._fail(f"Unexpected character {ch!r}")
+
+    def _string_closed(self, events):
+        if len(self.stack) != 1:
+            return
+        raw = self.buffer[self.string_start:self.pos + 1]
+        if self.expect == "key":
+            self.key = self._loads(raw)
+            self.expect = "colon"
+        elif self.expect == "value":
+            self._emit_field(raw, events)
+
+    def _emit_field(self, raw, events):
+        events.append(("field", self.key, self._loads(raw)))
+        self.expect = "comma"
+        self.value_start = None
+
+    def _loads(self, raw):
+        try:
+            return json.loads(raw)
+        except json.JSONDecodeError as e:
+            self._fail(f"Invalid JSON value: {e}")
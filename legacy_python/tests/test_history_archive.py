@@ -0,0 +1,40 @@
+import io
+import os
+import sys
+import json
+import tarfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import blob_store
+import history_archive
+
+
+def _write_session(history_dir, session_id, meta):
+    os.makedirs(os.path.join(history_dir, session_id))
+    with open(os.path.join(history_dir, session_id, "metadata.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+
+def test_export_to_stdout_with_failed_session_is_valid_tar(tmp_path):
+    history_dir = str(tmp_path / "history")
+    name, _ = blob_store.put_blob(history_dir, b"final image", "png")
+    _write_session(history_dir, "good", {"timestamp": "20260101_000000", "input_text": "ok", "images": {"ref_images": [], "final_output": name}})
+    os.makedirs(os.path.join(history_dir, "broken"))
+    with open(os.path.join(history_dir, "broken", "metadata.json"), "w", encoding="utf-8") as f:
+        f.write("{not json")
+
+    proc = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "history_archive.py"), "export", "-", "--dir", history_dir],
+        capture_output=True, cwd=str(tmp_path), check=True,
+    )
+
+    assert b"Failed to export broken" in proc.stderr
+    assert b"Failed to export" not in proc.stdout
+    with tarfile.open(fileobj=io.BytesIO(proc.stdout), mode="r|") as tar:
+        members = [m.name for m in tar]
+    assert "sessions/good/metadata.json" in members
+    assert f"blobs/{name}" in members
+    assert members[-1] == history_archive.MANIFEST_NAME